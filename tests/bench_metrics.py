@@ -0,0 +1,74 @@
+# Per-machine against batched metric collection, over the real transport against a
+# stub collector. Run with: python -m tests.bench_metrics
+import argparse
+from statistics import median
+import tempfile
+import time
+
+from vboxui.metrics import split_metrics
+
+from .stubsoap import StubServer, StubVBox, login
+
+
+def per_vm(collector, handles: list[str]):
+    # One query_metrics_data round trip per machine, as VMList made before
+    metrics = {}
+    for handle in handles:
+        metrics.update(split_metrics(collector.query_metrics_data(None, [handle])))
+    return metrics
+
+
+def batched(collector, handles: list[str]):
+    # One round trip for every machine, as VMList.fetch_metrics makes now
+    return split_metrics(collector.query_metrics_data(None, handles))
+
+
+def run(machines: int, latency: float, window: int, rounds: int, cache_dir: str):
+    vbox = StubVBox(machines, window)
+    with StubServer(vbox, latency) as server:
+        api = login(server, cache_dir)
+        collector = api.performance_collector
+        handles = [str(vm.handle) for vm in api.machines]
+        for collect in (per_vm, batched):
+            calls = server.calls.get("IPerformanceCollector_queryMetricsData", 0)
+            timings = []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                metrics = collect(collector, handles)
+                timings.append(time.perf_counter() - started)
+            assert len(metrics) == machines
+            calls = server.calls["IPerformanceCollector_queryMetricsData"] - calls
+            yield collect.__name__, calls // rounds, median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m tests.bench_metrics")
+    parser.add_argument("--machines", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.001,
+        help="seconds the stub waits before each answer, a LAN round trip",
+    )
+    parser.add_argument(
+        "--window", type=int, default=60, help="samples per metric, as VMList asks for"
+    )
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'machines':>8}  {'method':<8} {'calls':>6} {'ms/tick':>9}  speedup")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for machines in args.machines:
+            results = list(
+                run(machines, args.latency, args.window, args.rounds, cache_dir)
+            )
+            slowest = results[0][2]
+            for method, calls, elapsed in results:
+                print(
+                    f"{machines:>8}  {method:<8} {calls:>6} {elapsed * 1000:>9.1f}  "
+                    f"{slowest / elapsed:.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
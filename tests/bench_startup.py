@@ -0,0 +1,87 @@
+# Startup with and without the WSDL cache, from launch and from the moment Login
+# is pressed to the machines being listed for the first VM list render, against a
+# stub serving a WSDL about as slow to parse as the real one.
+# Run with: python -m tests.bench_startup
+import argparse
+from pathlib import Path
+from statistics import median
+import tempfile
+import time
+
+from vboxui.transport import WSDL_CACHE
+
+from .stubsoap import StubServer, StubVBox, build_wsdl, cache_wsdl_in, login
+
+
+def start(server: StubServer, cache_dir: Path, think: float) -> tuple[float, float]:
+    # As start_app does: the cached WSDL is parsed while the user types a password
+    launched = time.perf_counter()
+    cache_wsdl_in(cache_dir)
+    WSDL_CACHE.preload()
+    time.sleep(think)
+    pressed = time.perf_counter()
+    api = login(server, cache_dir)
+    api.performance_collector
+    assert api.machines
+    listed = time.perf_counter()
+    return listed - pressed, listed - launched
+
+
+def run(padding: int, machines: int, latency: float, think: float, rounds: int):
+    with tempfile.TemporaryDirectory() as tmp, StubServer(
+        StubVBox(machines), latency
+    ) as server:
+        server.wsdl = build_wsdl(padding)
+        cached = Path(tmp, "cached")
+        start(server, cached, 0)  # Fills the cache
+        for name in ("uncached", "cached"):
+            timings = []
+            for round in range(rounds):
+                empty = Path(tmp, f"empty-{round}")
+                cache_dir = cached if name == "cached" else empty
+                timings.append(start(server, cache_dir, think))
+            yield (
+                name,
+                median(after for after, _ in timings),
+                median(total for _, total in timings),
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m tests.bench_startup")
+    parser.add_argument(
+        "--padding",
+        type=int,
+        default=1500,
+        help="operations added to the stub's WSDL, the real one has over a thousand",
+    )
+    parser.add_argument("--machines", type=int, default=10)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.001,
+        help="seconds the stub waits before each answer, a LAN round trip",
+    )
+    parser.add_argument(
+        "--think",
+        type=float,
+        nargs="+",
+        default=[0, 2],
+        help="seconds between launch and pressing Login",
+    )
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'think s':>7}  {'wsdl':<8} {'after login ms':>14} {'after launch ms':>15}")
+    for think in args.think:
+        for name, after_login, after_launch in run(
+            args.padding, args.machines, args.latency, think, args.rounds
+        ):
+            print(
+                f"{think:>7.1f}  {name:<8} {after_login * 1000:>14.0f} "
+                f"{after_launch * 1000:>15.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
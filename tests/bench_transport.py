@@ -0,0 +1,91 @@
+# Per-call latency of zeep's default transport, as build_api used before, against
+# the pooled one it builds now, which keeps to pool_size connections however many
+# workers call at once. Run with: python -m tests.bench_transport
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import time
+
+from vbox_api import SOAPInterface, VBoxAPI
+
+from vboxui.profile import percentile
+
+from .stubsoap import StubServer, StubVBox, login
+
+
+def plain(server: StubServer, cache_dir: str) -> VBoxAPI:
+    interface = SOAPInterface("127.0.0.1", server.port)
+    interface.connect()
+    api = VBoxAPI(interface)  # pyright: ignore [reportArgumentType]
+    api.login("stub", "stub")
+    return api
+
+
+def pooled(server: StubServer, cache_dir: str, pool_size: int = 8) -> VBoxAPI:
+    return login(server, cache_dir, pool_size=pool_size)
+
+
+def measure(api: VBoxAPI, workers: int, calls: int) -> list[float]:
+    # Every worker reads machine names, one round trip each
+    machines = api.machines
+
+    def read(worker: int) -> list[float]:
+        timings = []
+        for i in range(calls):
+            started = time.perf_counter()
+            machines[(worker + i) % len(machines)].name
+            timings.append(time.perf_counter() - started)
+        return timings
+
+    with ThreadPoolExecutor(workers) as pool:
+        return [t for timings in pool.map(read, range(workers)) for t in timings]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m tests.bench_transport")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--calls", type=int, default=200, help="calls per worker")
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.001,
+        help="seconds the stub waits before each answer, a LAN round trip",
+    )
+    parser.add_argument(
+        "--connect-latency",
+        type=float,
+        default=0.002,
+        help="seconds the stub waits on every new connection, a LAN handshake",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'transport':<9} {'workers':>7} {'p50 ms':>7} {'p99 ms':>7} "
+        f"{'calls/s':>8} {'connections':>11}"
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for connect in (plain, pooled):
+            for workers in args.workers:
+                with StubServer(
+                    StubVBox(machines=10), args.latency, args.connect_latency
+                ) as server:
+                    if connect is pooled:
+                        api = pooled(server, cache_dir, args.pool_size)
+                    else:
+                        api = plain(server, cache_dir)
+                    connections = server.connections
+                    started = time.perf_counter()
+                    timings = measure(api, workers, args.calls)
+                    elapsed = time.perf_counter() - started
+                    print(
+                        f"{connect.__name__:<9} {workers:>7} "
+                        f"{percentile(timings, 0.5) * 1000:>7.2f} "
+                        f"{percentile(timings, 0.99) * 1000:>7.2f} "
+                        f"{len(timings) / elapsed:>8.0f} "
+                        f"{server.connections - connections:>11}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
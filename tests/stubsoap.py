@@ -0,0 +1,712 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import queue
+from pathlib import Path
+import secrets
+import socket
+import threading
+import time
+import uuid
+
+from lxml import etree
+from vbox_api import VBoxAPI
+
+from vboxui.api import build_api
+from vboxui.transport import WSDL_CACHE
+
+NS = "http://www.virtualbox.org/"
+SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
+XSD = "http://www.w3.org/2001/XMLSchema"
+WSDL = "http://schemas.xmlsoap.org/wsdl/"
+WSDL_SOAP = "http://schemas.xmlsoap.org/wsdl/soap/"
+
+# The part of the vboxwebsrv API the stub answers, as input and output parameters
+# written "name:type", with "[]" after the type for a list
+OPERATIONS = {
+    "IWebsessionManager_logon": ("username:string password:string", "returnval:string"),
+    "IWebsessionManager_logoff": ("refIVirtualBox:string", ""),
+    "IWebsessionManager_getSessionObject": (
+        "refIVirtualBox:string",
+        "returnval:string",
+    ),
+    "IManagedObjectRef_getInterfaceName": ("_this:string", "returnval:string"),
+    "IManagedObjectRef_release": ("_this:string", ""),
+    "IVirtualBox_getVersion": ("_this:string", "returnval:string"),
+    "IVirtualBox_getMachines": ("_this:string", "returnval:string[]"),
+    "IVirtualBox_getPerformanceCollector": ("_this:string", "returnval:string"),
+    "IVirtualBox_getEventSource": ("_this:string", "returnval:string"),
+    "ISession_getState": ("_this:string", "returnval:string"),
+    "ISession_getMachine": ("_this:string", "returnval:string"),
+    "ISession_unlockMachine": ("_this:string", ""),
+    "IVirtualBox_findMachine": ("_this:string nameOrId:string", "returnval:string"),
+    "IMachine_lockMachine": ("_this:string session:string lockType:string", ""),
+    "IMachine_getId": ("_this:string", "returnval:string"),
+    "IMachine_getName": ("_this:string", "returnval:string"),
+    "IMachine_getState": ("_this:string", "returnval:string"),
+    "IMachine_getOSTypeId": ("_this:string", "returnval:string"),
+    "IMachine_getCPUCount": ("_this:string", "returnval:unsignedInt"),
+    "IMachine_getMemorySize": ("_this:string", "returnval:unsignedInt"),
+    "IMachine_getLastStateChange": ("_this:string", "returnval:long"),
+    "IMachine_getMediumAttachments": ("_this:string", "returnval:string[]"),
+    "IMachine_getNetworkAdapter": (
+        "_this:string slot:unsignedInt",
+        "returnval:string",
+    ),
+    "INetworkAdapter_getEnabled": ("_this:string", "returnval:boolean"),
+    "IMachine_getSnapshotCount": ("_this:string", "returnval:unsignedInt"),
+    "IMachine_getCurrentSnapshot": ("_this:string", "returnval:string"),
+    "IMachine_findSnapshot": ("_this:string nameOrId:string", "returnval:string"),
+    "ISnapshot_getId": ("_this:string", "returnval:string"),
+    "ISnapshot_getName": ("_this:string", "returnval:string"),
+    "ISnapshot_getDescription": ("_this:string", "returnval:string"),
+    "ISnapshot_getOnline": ("_this:string", "returnval:boolean"),
+    "ISnapshot_getTimeStamp": ("_this:string", "returnval:long"),
+    "ISnapshot_getChildrenCount": ("_this:string", "returnval:unsignedInt"),
+    "ISnapshot_getChildren": ("_this:string", "returnval:string[]"),
+    "IPerformanceCollector_setupMetrics": (
+        "_this:string metricNames:string[] objects:string[] period:unsignedInt "
+        "count:unsignedInt",
+        "returnval:string[]",
+    ),
+    "IPerformanceCollector_enableMetrics": (
+        "_this:string metricNames:string[] objects:string[]",
+        "returnval:string[]",
+    ),
+    "IPerformanceMetric_getMetricName": ("_this:string", "returnval:string"),
+    "IPerformanceCollector_queryMetricsData": (
+        "_this:string metricNames:string[] objects:string[]",
+        "returnval:int[] returnMetricNames:string[] returnObjects:string[] "
+        "returnUnits:string[] returnScales:unsignedInt[] "
+        "returnSequenceNumbers:unsignedInt[] returnDataIndices:unsignedInt[] "
+        "returnDataLengths:unsignedInt[]",
+    ),
+    "IEventSource_createListener": ("_this:string", "returnval:string"),
+    "IEventSource_registerListener": (
+        "_this:string listener:string interesting:string[] active:boolean",
+        "",
+    ),
+    "IEventSource_unregisterListener": ("_this:string listener:string", ""),
+    "IEventSource_getEvent": (
+        "_this:string listener:string timeout:int",
+        "returnval:string",
+    ),
+    "IEventListener_handleEvent": ("_this:string event:string", ""),
+    "IEvent_getType": ("_this:string", "returnval:string"),
+}
+
+# Attributes of the events the stub can fire, every one also has a type
+EVENTS = {
+    "IMachineStateChangedEvent": "machineId:string state:string",
+    "IMachineRegisteredEvent": "machineId:string registered:boolean",
+    "IMachineDataChangedEvent": "machineId:string temporary:boolean",
+    "IMediumRegisteredEvent": "mediumId:string mediumType:string registered:boolean",
+    "ISnapshotTakenEvent": "machineId:string snapshotId:string",
+    "ISnapshotDeletedEvent": "machineId:string snapshotId:string",
+}
+for interface, attributes in EVENTS.items():
+    for attribute in ["type:string", *attributes.split()]:
+        name, _, kind = attribute.partition(":")
+        OPERATIONS[f"{interface}_get{name[0].upper()}{name[1:]}"] = (
+            "_this:string",
+            f"returnval:{kind}",
+        )
+
+METRICS = {
+    "CPU/Load/User": "%",
+    "CPU/Load/Kernel": "%",
+    "CPU/Usage/Used": "kB",
+    "Disk/Usage/Used": "mB",
+    "Net/Rate/Rx": "B/s",
+    "Net/Rate/Tx": "B/s",
+}
+
+
+def parameters(spec: str) -> list[tuple[str, str, bool]]:
+    # "objects:string[]" -> ("objects", "string", True)
+    parsed = []
+    for entry in spec.split():
+        name, _, kind = entry.partition(":")
+        parsed.append((name, kind.removesuffix("[]"), kind.endswith("[]")))
+    return parsed
+
+
+def build_wsdl(padding: int = 0) -> bytes:
+    # Document/literal like the real one, so zeep builds the same kind of service.
+    # padding adds operations nothing calls, to make it as slow to parse as the real
+    # one, which has well over a thousand.
+    operations = dict(OPERATIONS)
+    for n in range(padding):
+        operations[f"IPadding_getValue{n}"] = ("_this:string", "returnval:string[]")
+    root = etree.Element(
+        f"{{{WSDL}}}definitions",
+        name="vbox",
+        targetNamespace=NS,
+        nsmap={None: WSDL, "soap": WSDL_SOAP, "xsd": XSD, "vbox": NS},
+    )
+    types = etree.SubElement(root, f"{{{WSDL}}}types")
+    schema = etree.SubElement(
+        types, f"{{{XSD}}}schema", targetNamespace=NS, elementFormDefault="qualified"
+    )
+    port_type = etree.Element(f"{{{WSDL}}}portType", name="vboxPortType")
+    binding = etree.Element(
+        f"{{{WSDL}}}binding", name="vboxBinding", type="vbox:vboxPortType"
+    )
+    etree.SubElement(
+        binding,
+        f"{{{WSDL_SOAP}}}binding",
+        style="document",
+        transport="http://schemas.xmlsoap.org/soap/http",
+    )
+    messages = []
+    for name, (inputs, outputs) in operations.items():
+        for element, spec in ((name, inputs), (f"{name}Response", outputs)):
+            node = etree.SubElement(schema, f"{{{XSD}}}element", name=element)
+            sequence = etree.SubElement(
+                etree.SubElement(node, f"{{{XSD}}}complexType"), f"{{{XSD}}}sequence"
+            )
+            for param, kind, many in parameters(spec):
+                etree.SubElement(
+                    sequence,
+                    f"{{{XSD}}}element",
+                    name=param,
+                    type=f"xsd:{kind}",
+                    minOccurs="0",
+                    maxOccurs="unbounded" if many else "1",
+                )
+        for suffix, element in (("RequestMsg", name), ("ResultMsg", f"{name}Response")):
+            message = etree.Element(f"{{{WSDL}}}message", name=name + suffix)
+            etree.SubElement(
+                message, f"{{{WSDL}}}part", name="parameters", element=f"vbox:{element}"
+            )
+            messages.append(message)
+        operation = etree.SubElement(port_type, f"{{{WSDL}}}operation", name=name)
+        etree.SubElement(operation, f"{{{WSDL}}}input", message=f"vbox:{name}RequestMsg")
+        etree.SubElement(operation, f"{{{WSDL}}}output", message=f"vbox:{name}ResultMsg")
+        operation = etree.SubElement(binding, f"{{{WSDL}}}operation", name=name)
+        etree.SubElement(operation, f"{{{WSDL_SOAP}}}operation", soapAction="")
+        for direction in ("input", "output"):
+            body = etree.SubElement(operation, f"{{{WSDL}}}{direction}")
+            etree.SubElement(body, f"{{{WSDL_SOAP}}}body", use="literal")
+    root.extend(messages)
+    root.append(port_type)
+    root.append(binding)
+    service = etree.SubElement(root, f"{{{WSDL}}}service", name="vboxService")
+    port = etree.SubElement(
+        service, f"{{{WSDL}}}port", name="vboxServicePort", binding="vbox:vboxBinding"
+    )
+    etree.SubElement(port, f"{{{WSDL_SOAP}}}address", location="http://localhost/")
+    return etree.tostring(root, xml_declaration=True, encoding="utf-8")
+
+
+class Fault(Exception):
+    pass
+
+
+class StubEvent:
+
+    def __init__(self, interface: str, type: str, **attributes):
+        self.interface = interface
+        self.attributes = {"type": type, **attributes}
+
+
+class StubMetric:
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class StubSession:
+
+    def __init__(self):
+        self.machine: StubMachine | None = None
+
+
+class StubListener:
+
+    def __init__(self):
+        self.interesting: set[str] = set()
+        self.events: queue.Queue[StubEvent] = queue.Queue()
+
+
+class StubSnapshot:
+
+    def __init__(self, name: str):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.time_stamp = int(time.time() * 1000)
+        self.children: list[StubSnapshot] = []
+
+
+class StubMachine:
+
+    def __init__(self, name: str, snapshots: int = 0):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.state = "PoweredOff"
+        self.os_type_id = "Debian_64"
+        self.cpu_count = 1
+        self.memory_size = 1024
+        self.last_state_change = int(time.time() * 1000)
+        self.adapters = [object() for _ in range(4)]
+        # A root snapshot with the rest as its children
+        self.snapshots: list[StubSnapshot] = []
+        for i in range(snapshots):
+            self.snapshots.append(StubSnapshot(f"{name}-snapshot{i}"))
+        if self.snapshots:
+            self.snapshots[0].children = self.snapshots[1:]
+
+
+# What vboxwebsrv keeps for its clients: sessions, and a managed object reference
+# per object handed out in a session, the same one each time until it's released
+class StubVBox:
+
+    def __init__(
+        self,
+        machines: int = 0,
+        window: int = 60,
+        snapshots: int = 0,
+        version: str = "7.1.0",
+    ):
+        self.version = version
+        self.window = window
+        self.machines = [StubMachine(f"vm{i}", snapshots) for i in range(machines)]
+        self.collector = object()
+        self.event_source = object()
+        self.listeners: list[StubListener] = []
+        self.sessions: dict[str, StubSession] = {}
+        self.released = 0
+        self.refs: dict[str, tuple[str, object]] = {}
+        self._handles: dict[tuple[str, int], str] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def ref(self, this: str, interface: str, obj) -> str:
+        session = this.partition("-")[0]
+        with self._lock:
+            handle = self._handles.get((session, id(obj)))
+            if handle is None:
+                handle = f"{session}-{next(self._ids):016x}"
+                self._handles[(session, id(obj))] = handle
+                self.refs[handle] = interface, obj
+            return handle
+
+    def object(self, handle: str):
+        with self._lock:
+            if handle not in self.refs:
+                raise Fault(f'Invalid managed object reference "{handle}"')
+            return self.refs[handle][1]
+
+    def live(self) -> int:
+        # References held for clients right now
+        with self._lock:
+            return len(self.refs)
+
+    def IWebsessionManager_logon(self, username, password):
+        # Random like vboxwebsrv's, so handles from different stubs never collide in
+        # vbox_api's registry of models
+        session = secrets.token_hex(8)
+        self.sessions[session] = StubSession()
+        return self.ref(session, "IVirtualBox", self)
+
+    def IWebsessionManager_logoff(self, refIVirtualBox):
+        session = refIVirtualBox.partition("-")[0]
+        with self._lock:
+            for handle in [h for h in self.refs if h.startswith(session)]:
+                del self.refs[handle]
+            for key in [k for k in self._handles if k[0] == session]:
+                del self._handles[key]
+            self.sessions.pop(session, None)
+
+    def IWebsessionManager_getSessionObject(self, refIVirtualBox):
+        # One ISession per login, as vboxwebsrv hands out
+        self.object(refIVirtualBox)
+        session = self.sessions[refIVirtualBox.partition("-")[0]]
+        return self.ref(refIVirtualBox, "ISession", session)
+
+    def ISession_getState(self, _this):
+        return "Locked" if self.object(_this).machine else "Unlocked"
+
+    def ISession_getMachine(self, _this):
+        # The mutable machine of a locked session, the same object in the stub
+        machine = self.object(_this).machine
+        if machine is None:
+            raise Fault("The session is not locked")
+        return self.ref(_this, "IMachine", machine)
+
+    def ISession_unlockMachine(self, _this):
+        self.object(_this).machine = None
+
+    def IMachine_lockMachine(self, _this, session, lockType):
+        machine, locked = self.object(_this), self.object(session)
+        if any(s.machine is machine for s in self.sessions.values()):
+            raise Fault(f"The machine '{machine.name}' is already locked")
+        locked.machine = machine
+
+    def IVirtualBox_findMachine(self, _this, nameOrId):
+        self.object(_this)
+        for machine in self.machines:
+            if nameOrId in (machine.id, machine.name):
+                return self.ref(_this, "IMachine", machine)
+        raise Fault(f"Could not find a registered machine named '{nameOrId}'")
+
+    def restart(self):
+        # Like restarting vboxwebsrv, every session and reference is forgotten
+        with self._lock:
+            self.refs.clear()
+            self._handles.clear()
+            self.sessions.clear()
+            self.listeners.clear()
+
+    def IManagedObjectRef_getInterfaceName(self, _this):
+        self.object(_this)
+        return self.refs[_this][0]
+
+    def IManagedObjectRef_release(self, _this):
+        obj = self.object(_this)
+        with self._lock:
+            del self.refs[_this]
+            del self._handles[(_this.partition("-")[0], id(obj))]
+            self.released += 1
+
+    def IVirtualBox_getVersion(self, _this):
+        self.object(_this)
+        return self.version
+
+    def IVirtualBox_getMachines(self, _this):
+        self.object(_this)
+        return [self.ref(_this, "IMachine", m) for m in self.machines]
+
+    def IVirtualBox_getPerformanceCollector(self, _this):
+        self.object(_this)
+        return self.ref(_this, "IPerformanceCollector", self.collector)
+
+    def IVirtualBox_getEventSource(self, _this):
+        self.object(_this)
+        return self.ref(_this, "IEventSource", self.event_source)
+
+    def IEventSource_createListener(self, _this):
+        self.object(_this)
+        return self.ref(_this, "IEventListener", StubListener())
+
+    def IEventSource_registerListener(self, _this, listener, interesting, active):
+        registered = self.object(listener)
+        registered.interesting = set(interesting)
+        self.listeners.append(registered)
+
+    def IEventSource_unregisterListener(self, _this, listener):
+        self.listeners.remove(self.object(listener))
+
+    def IEventSource_getEvent(self, _this, listener, timeout):
+        # A long poll, an empty reference if nothing was fired within timeout ms
+        try:
+            event = self.object(listener).events.get(timeout=max(timeout, 0) / 1000)
+        except queue.Empty:
+            return ""
+        return self.ref(_this, event.interface, event)
+
+    def IEvent_getType(self, _this):
+        return self.object(_this).attributes["type"]
+
+    def fire(self, interface: str, type: str, **attributes):
+        # Queued for every listener registered for the type
+        for listener in list(self.listeners):
+            if type in listener.interesting or "Any" in listener.interesting:
+                listener.events.put(StubEvent(interface, type, **attributes))
+
+    def __getattr__(self, name: str):
+        # The getters of EVENTS, "IMachineStateChangedEvent_getMachineId" answers
+        # the event's machineId
+        interface, _, method = name.partition("_")
+        if interface not in EVENTS or not method.startswith("get"):
+            raise AttributeError(name)
+        attribute = method[3].lower() + method[4:]
+        return lambda _this: self.object(_this).attributes[attribute]
+
+    def IMachine_getId(self, _this):
+        return self.object(_this).id
+
+    def IMachine_getName(self, _this):
+        return self.object(_this).name
+
+    def IMachine_getState(self, _this):
+        return self.object(_this).state
+
+    def IMachine_getOSTypeId(self, _this):
+        return self.object(_this).os_type_id
+
+    def IMachine_getCPUCount(self, _this):
+        return self.object(_this).cpu_count
+
+    def IMachine_getMemorySize(self, _this):
+        return self.object(_this).memory_size
+
+    def IMachine_getLastStateChange(self, _this):
+        return self.object(_this).last_state_change
+
+    def IMachine_getMediumAttachments(self, _this):
+        self.object(_this)
+        return []
+
+    def IMachine_getNetworkAdapter(self, _this, slot):
+        # Adapters are never enabled, so no further attributes are read
+        return self.ref(_this, "INetworkAdapter", self.object(_this).adapters[slot])
+
+    def INetworkAdapter_getEnabled(self, _this):
+        self.object(_this)
+        return False
+
+    def IMachine_getSnapshotCount(self, _this):
+        return len(self.object(_this).snapshots)
+
+    def IMachine_getCurrentSnapshot(self, _this):
+        snapshots = self.object(_this).snapshots
+        return self.ref(_this, "ISnapshot", snapshots[-1]) if snapshots else ""
+
+    def IMachine_findSnapshot(self, _this, nameOrId):
+        # The root snapshot for an empty name, as VirtualBox does
+        snapshots = self.object(_this).snapshots
+        for snapshot in snapshots:
+            if not nameOrId or nameOrId in (snapshot.id, snapshot.name):
+                return self.ref(_this, "ISnapshot", snapshot)
+        raise Fault(f"Could not find a snapshot named '{nameOrId}'")
+
+    def ISnapshot_getId(self, _this):
+        return self.object(_this).id
+
+    def ISnapshot_getName(self, _this):
+        return self.object(_this).name
+
+    def ISnapshot_getDescription(self, _this):
+        self.object(_this)
+        return ""
+
+    def ISnapshot_getOnline(self, _this):
+        self.object(_this)
+        return False
+
+    def ISnapshot_getTimeStamp(self, _this):
+        return self.object(_this).time_stamp
+
+    def ISnapshot_getChildrenCount(self, _this):
+        return len(self.object(_this).children)
+
+    def ISnapshot_getChildren(self, _this):
+        children = self.object(_this).children
+        return [self.ref(_this, "ISnapshot", child) for child in children]
+
+    def IPerformanceCollector_setupMetrics(
+        self, _this, metricNames, objects, period, count
+    ):
+        return self.IPerformanceCollector_enableMetrics(_this, metricNames, objects)
+
+    def IPerformanceCollector_enableMetrics(self, _this, metricNames, objects):
+        # A new IPerformanceMetric for every metric of every object, on each call
+        metrics = []
+        for handle in objects:
+            self.object(handle)
+            for name in metricNames or METRICS:
+                metrics.append(self.ref(_this, "IPerformanceMetric", StubMetric(name)))
+        return metrics
+
+    def IPerformanceMetric_getMetricName(self, _this):
+        return self.object(_this).name
+
+    def IPerformanceCollector_queryMetricsData(self, _this, metricNames, objects):
+        # A full window of samples for every metric of every object asked for
+        names = metricNames or list(METRICS)
+        handles = objects or self.IVirtualBox_getMachines(_this)
+        result = {
+            key: []
+            for key in (
+                "returnval returnMetricNames returnObjects returnUnits returnScales "
+                "returnSequenceNumbers returnDataIndices returnDataLengths"
+            ).split()
+        }
+        for handle in handles:
+            self.object(handle)
+            for name in names:
+                result["returnMetricNames"].append(name)
+                result["returnObjects"].append(handle)
+                result["returnUnits"].append(METRICS.get(name, ""))
+                result["returnScales"].append(100 if METRICS.get(name) == "%" else 1)
+                result["returnSequenceNumbers"].append(0)
+                result["returnDataIndices"].append(len(result["returnval"]))
+                result["returnDataLengths"].append(self.window)
+                result["returnval"].extend(range(self.window))
+        return result
+
+
+class SOAPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like vboxwebsrv
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately, without this every answer waits
+        # on the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.opened(self.connection)
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+    def finish(self):
+        super().finish()
+        self.server.closed(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.endswith("?wsdl") and self.server.wsdl is not None:
+            self.reply(200, self.server.wsdl)
+        else:
+            self.reply(404, b"")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.reply(*self.server.dispatch(body))
+
+    def reply(self, status: int, content: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# A local stand-in for vboxwebsrv: serves the WSDL and answers SOAP calls from a
+# StubVBox, waiting latency seconds before each answer, and connect_latency before
+# the first on a new connection, as a TCP handshake over the network would
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        vbox: StubVBox | None = None,
+        latency: float = 0,
+        connect_latency: float = 0,
+    ):
+        super().__init__(("127.0.0.1", 0), SOAPHandler)
+        self.vbox = vbox or StubVBox()
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.wsdl: bytes | None = build_wsdl()  # None answers 404
+        self.connections = 0
+        self._open: set[socket.socket] = set()
+        self.calls: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def __enter__(self) -> "StubServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        # Gone like a stopped vboxwebsrv, kept-alive connections included
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            for connection in self._open:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def opened(self, connection: socket.socket):
+        with self._lock:
+            self.connections += 1
+            self._open.add(connection)
+
+    def closed(self, connection: socket.socket):
+        with self._lock:
+            self._open.discard(connection)
+
+    def dispatch(self, body: bytes) -> tuple[int, bytes]:
+        request = etree.fromstring(body).find(f"{{{SOAP}}}Body")[0]
+        name = etree.QName(request).localname
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        inputs, outputs = OPERATIONS[name]
+        kwargs = {}
+        for param, kind, many in parameters(inputs):
+            values = [
+                parse(child.text, kind)
+                for child in request
+                if etree.QName(child).localname == param
+            ]
+            kwargs[param] = values if many else (values[0] if values else None)
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            result = getattr(self.vbox, name)(**kwargs)
+        except Fault as e:
+            return 500, fault(str(e))
+        return 200, response(name, outputs, result)
+
+
+def unused_port() -> int:
+    # A port nothing listens on, for a host that's down
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse(text: str | None, kind: str):
+    if kind in ("int", "unsignedInt", "long", "unsignedLong"):
+        return int(text or 0)
+    if kind == "boolean":
+        return text == "true"
+    return text or ""
+
+
+def envelope() -> tuple[etree._Element, etree._Element]:
+    root = etree.Element(f"{{{SOAP}}}Envelope", nsmap={"SOAP-ENV": SOAP, "vbox": NS})
+    return root, etree.SubElement(root, f"{{{SOAP}}}Body")
+
+
+def response(name: str, outputs: str, result) -> bytes:
+    root, body = envelope()
+    node = etree.SubElement(body, f"{{{NS}}}{name}Response")
+    params = parameters(outputs)
+    if len(params) == 1:
+        result = {params[0][0]: result}
+    for param, _, many in params:
+        values = result[param] if many else [result[param]]
+        for value in values:
+            child = etree.SubElement(node, f"{{{NS}}}{param}")
+            if isinstance(value, bool):
+                child.text = "true" if value else "false"
+            else:
+                child.text = str(value)
+    return etree.tostring(root, xml_declaration=True, encoding="utf-8")
+
+
+def fault(message: str) -> bytes:
+    root, body = envelope()
+    node = etree.SubElement(body, f"{{{SOAP}}}Fault")
+    etree.SubElement(node, "faultcode").text = "SOAP-ENV:Client"
+    etree.SubElement(node, "faultstring").text = message
+    return etree.tostring(root, xml_declaration=True, encoding="utf-8")
+
+
+def cache_wsdl_in(cache_dir: str | Path):
+    # Keeps the stub's WSDL apart from the user's cache, for every login made
+    # through build_api from then on, such as a fleet host's
+    WSDL_CACHE.directory = Path(cache_dir)
+
+
+def wait_for_listener(vbox: StubVBox, watcher: threading.Thread, timeout: float = 10):
+    # Events fired before the watcher registers its listener are lost
+    deadline = time.monotonic() + timeout
+    while not vbox.listeners:
+        assert watcher.is_alive(), "Event watcher stopped before it listened"
+        assert time.monotonic() < deadline, "Event watcher never registered"
+        time.sleep(0.01)
+
+
+def login(server: StubServer, cache_dir: str | Path, **kwargs) -> VBoxAPI:
+    cache_wsdl_in(cache_dir)
+    return build_api("stub", "stub", "127.0.0.1", server.port, **kwargs)
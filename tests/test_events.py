@@ -0,0 +1,74 @@
+import queue
+
+from vbox_api.constants import VBoxEventType
+
+from vboxui.events import WATCHED_EVENTS, EventWatcher
+from vboxui.models import MachineEvent
+
+from .stubsoap import StubServer, StubVBox, login, wait_for_listener
+
+
+def watch(api) -> tuple[EventWatcher, queue.Queue]:
+    received: queue.Queue[MachineEvent] = queue.Queue()
+    watcher = EventWatcher(api, received.put, timeout_ms=100)
+    watcher.start()
+    return watcher, received
+
+
+def test_events_reach_the_callback(tmp_path):
+    vbox = StubVBox(machines=2)
+    with StubServer(vbox) as server:
+        api = login(server, tmp_path)
+        watcher, received = watch(api)
+        try:
+            wait_for_listener(vbox, watcher)
+            assert vbox.listeners[0].interesting == set(WATCHED_EVENTS)
+
+            machine = vbox.machines[0]
+            vbox.fire(
+                "IMachineStateChangedEvent",
+                VBoxEventType.ON_MACHINE_STATE_CHANGED,
+                machineId=machine.id,
+                state="Running",
+            )
+            vbox.fire(
+                "IMediumRegisteredEvent",
+                VBoxEventType.ON_MEDIUM_REGISTERED,
+                mediumId="medium-1",
+                mediumType="HardDisk",
+                registered=True,
+            )
+            vbox.fire(
+                "ISnapshotTakenEvent",
+                VBoxEventType.ON_SNAPSHOT_TAKEN,
+                machineId=machine.id,
+                snapshotId="snapshot-1",
+            )
+
+            assert received.get(timeout=5) == MachineEvent(
+                VBoxEventType.ON_MACHINE_STATE_CHANGED, machine.id
+            )
+            # Medium events carry the medium's id in place of a machine's
+            assert received.get(timeout=5) == MachineEvent(
+                VBoxEventType.ON_MEDIUM_REGISTERED, "medium-1"
+            )
+            assert received.get(timeout=5) == MachineEvent(
+                VBoxEventType.ON_SNAPSHOT_TAKEN, machine.id
+            )
+        finally:
+            watcher.stop()
+            watcher.join(5)
+        assert not watcher.is_alive()
+        assert not vbox.listeners
+
+
+def test_watcher_exits_when_the_server_goes_away(tmp_path):
+    # VMList and the exporter poll again once the watcher is no longer alive
+    server = StubServer(StubVBox(machines=1))
+    with server:
+        api = login(server, tmp_path)
+        api.interface.interface.transport.retries = 0
+        watcher, _ = watch(api)
+        wait_for_listener(server.vbox, watcher)
+    watcher.join(10)
+    assert not watcher.is_alive()
@@ -0,0 +1,49 @@
+import asyncio
+from contextlib import ExitStack
+import time
+
+from textual.app import App
+
+from vboxui.fleet import FleetList, Host
+
+from .stubsoap import StubServer, StubVBox, cache_wsdl_in, unused_port
+
+
+async def wait_until(pilot, condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await pilot.pause(0.05)
+    return True
+
+
+def test_slow_and_dead_hosts_dont_hold_up_the_others(tmp_path):
+    with ExitStack() as stack:
+        fast = [stack.enter_context(StubServer(StubVBox(machines=3))) for _ in "ab"]
+        slow = stack.enter_context(StubServer(StubVBox(machines=1), latency=0.1))
+        cache_wsdl_in(tmp_path)
+        hosts = [Host("127.0.0.1", server.port) for server in [*fast, slow]]
+        hosts.append(Host("127.0.0.1", unused_port()))
+        fleet = FleetList(hosts, "stub", "stub")
+
+        async def run():
+            app = App()
+            async with app.run_test() as pilot:
+                await app.push_screen(fleet)
+                table = fleet.query_one("#fleet")
+                # Both fast hosts are listed while the slow one is still answering
+                # and the dead one is still being probed
+                assert await wait_until(pilot, lambda: table.row_count == 6, 10)
+                assert hosts[3].status == "connecting"
+                assert {table.get_row_at(i)[0] for i in range(6)} == {
+                    host.address for host in hosts[:2]
+                }
+
+                assert await wait_until(pilot, lambda: table.row_count == 7, 30)
+                assert await wait_until(
+                    pilot, lambda: hosts[3].status == "unreachable", 30
+                )
+                assert fleet.sub_title == "7 machines on 3/4 hosts"
+
+        asyncio.run(run())
@@ -0,0 +1,18 @@
+from .bench_metrics import batched, per_vm
+from .stubsoap import StubServer, StubVBox, login
+
+
+def test_one_query_covers_every_machine(tmp_path):
+    with StubServer(StubVBox(machines=5, window=3)) as server:
+        api = login(server, tmp_path)
+        collector = api.performance_collector
+        handles = [str(vm.handle) for vm in api.machines]
+
+        expected = per_vm(collector, handles)
+        calls = server.calls["IPerformanceCollector_queryMetricsData"]
+        metrics = batched(collector, handles)
+
+        assert server.calls["IPerformanceCollector_queryMetricsData"] == calls + 1
+        assert metrics == expected
+        assert set(metrics) == set(handles)
+        assert metrics[handles[0]]["CPU/Load/User"].values == [0, 1, 2]
@@ -0,0 +1,8 @@
+from vboxui.provision import DEFAULT_TEMPLATE, machine_names
+
+
+def test_unusable_name_patterns_give_no_names():
+    template = DEFAULT_TEMPLATE._replace(count=3)
+    assert machine_names(template) == ["worker-01", "worker-02", "worker-03"]
+    for pattern in ("{n:zz}", "{x}{n}", "{}", "{n[0]}", "{n.bad}"):
+        assert machine_names(template._replace(name_pattern=pattern)) == []
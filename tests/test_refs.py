@@ -0,0 +1,68 @@
+import queue
+
+from vbox_api.constants import VBoxEventType
+
+from vboxui.cache import SnapshotIndex
+from vboxui.events import EventWatcher
+from vboxui.metrics import setup_metrics
+from vboxui.refs import REFS, subsystem
+
+from .stubsoap import METRICS, StubServer, StubVBox, login, wait_for_listener
+
+ROUNDS = 20
+SNAPSHOTS = 4
+
+
+def test_server_references_stay_level(tmp_path):
+    # Snapshot walks, machines starting, metric queries and events for ROUNDS rounds,
+    # with the count of references vboxwebsrv holds taken after each
+    vbox = StubVBox(machines=3, window=1, snapshots=SNAPSHOTS)
+    with StubServer(vbox) as server:
+        api = login(server, tmp_path)
+        machines = api.machines
+        collector = api.performance_collector
+        index = SnapshotIndex()
+        received: queue.Queue = queue.Queue()
+        watcher = EventWatcher(api, received.put, timeout_ms=100)
+        watcher.start()
+        wait_for_listener(vbox, watcher)
+
+        live, outstanding = [], []
+        try:
+            for round in range(ROUNDS):
+                # The snapshot list opened on every machine, then closed
+                for machine in machines:
+                    machine_id = machine.id
+                    scope = f"snapshots:{machine_id}"
+                    with subsystem(scope):
+                        index.invalidate(machine_id)
+                        index.validate(machine, machine_id)
+                        root = index.fetch_level(machine, machine_id, None)
+                        index.fetch_level(machine, machine_id, root[0].id)
+                    REFS.release(scope)
+
+                # A machine started, its metrics are set up again as VM panes do
+                setup_metrics(api, collector, [machines[round % len(machines)]])
+                collector.query_metrics_data(None, [str(vm.handle) for vm in machines])
+
+                for machine in vbox.machines:
+                    vbox.fire(
+                        "IMachineStateChangedEvent",
+                        VBoxEventType.ON_MACHINE_STATE_CHANGED,
+                        machineId=machine.id,
+                        state="Running",
+                    )
+                for _ in vbox.machines:
+                    received.get(timeout=5)
+
+                live.append(vbox.live())
+                outstanding.append(REFS.outstanding())
+        finally:
+            watcher.stop()
+            watcher.join(5)
+
+    # Every snapshot and every event, and the metrics of both setup calls, each round
+    snapshots_and_events = len(machines) * (SNAPSHOTS + 1)
+    assert vbox.released == ROUNDS * (snapshots_and_events + 2 * len(METRICS))
+    assert len(set(live)) == 1, live
+    assert len(set(outstanding)) == 1, outstanding
@@ -0,0 +1,26 @@
+from vboxui.registry import Registry
+from vboxui.session import SessionManager
+
+from .stubsoap import StubServer, StubVBox, login
+
+
+def test_machines_lock_after_vboxwebsrv_restarts(tmp_path):
+    vbox = StubVBox(machines=2)
+    with StubServer(vbox) as server:
+        api = login(server, tmp_path)
+        machines = api.machines
+        registry = Registry()
+        registry.sync(machines)
+        manager = SessionManager(api, registry)
+        with machines[0].with_lock() as locked:
+            assert locked.name == "vm0"
+
+        vbox.restart()
+        assert manager.keepalive()
+
+        # The same Machine objects, on references and sessions of the new login
+        assert [machine.name for machine in machines] == ["vm0", "vm1"]
+        for machine in machines:
+            with machine.with_lock():
+                assert vbox.ISession_getState(str(machine.session.handle)) == "Locked"
+            assert not machine.session.is_locked
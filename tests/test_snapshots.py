@@ -0,0 +1,40 @@
+import asyncio
+
+from textual.app import App
+from textual.widgets import Input, Tree
+
+from vboxui.cache import SnapshotIndex
+from vboxui.snapshots import ListSnapshots
+
+from .stubsoap import StubServer, StubVBox, login
+from .test_fleet import wait_until
+
+
+def test_search_finds_snapshots_in_unopened_levels(tmp_path):
+    vbox = StubVBox(machines=1, snapshots=6)
+    with StubServer(vbox) as server:
+        api = login(server, tmp_path)
+        machine = api.machines[0]
+        index = SnapshotIndex()
+        screen = ListSnapshots(machine, vbox.machines[0].id, index)
+
+        async def run():
+            app = App()
+            async with app.run_test() as pilot:
+                await app.push_screen(screen)
+                tree = screen.query_one("#snapshots", Tree)
+                # Only the root snapshot is listed, its children are never opened
+                assert await wait_until(pilot, lambda: len(tree.root.children), 10)
+
+                search = screen.query_one("#snapshot-search", Input)
+                search.value = "snapshot4"
+                assert await wait_until(
+                    pilot,
+                    lambda: [node.data.name for node in tree.root.children]
+                    == ["vm0-snapshot4"],
+                    10,
+                )
+                assert await wait_until(pilot, lambda: not screen._indexing, 10)
+                assert index.unfetched(vbox.machines[0].id) == []
+
+        asyncio.run(run())
@@ -0,0 +1,37 @@
+import time
+
+from vboxui.metrics import MetricHistory
+from vboxui.models import MetricSamples
+from vboxui.store import MetricsStore
+
+
+def window(first: int, last: int) -> MetricSamples:
+    # The collector's window holds sequence numbers first up to last
+    return MetricSamples(list(range(first, last + 1)), 1, "%", first)
+
+
+def test_restarts_store_the_window_once(tmp_path):
+    path = str(tmp_path / "metrics.db")
+    now = float(int(time.time()))
+    store = MetricsStore(path, period=1)
+    store.record({"vm": {"CPU/Load/User": window(0, 9)}}, now)
+    store.close()
+
+    # Reopened a few seconds later, the window now overlaps what was stored
+    store = MetricsStore(path, period=1)
+    assert store.sequence("vm", "CPU/Load/User") == 10
+    store.record({"vm": {"CPU/Load/User": window(3, 12)}}, now + 3)
+
+    samples = store.history("vm", "CPU/Load/User", now - 100, now + 100)
+    assert [value for _, value in samples] == list(range(13))
+    rollups = store._db.execute("SELECT sum(count) FROM rollup_minute").fetchone()
+    assert rollups == (13,)
+
+    # A history loaded from the store only takes what's new from the next query
+    history = MetricHistory(size=20)
+    for _, value in samples:
+        history.append(value)
+    history.next_sequence = store.sequence("vm", "CPU/Load/User")
+    history.extend(window(5, 14))
+    assert history.values() == list(range(15))
+    store.close()
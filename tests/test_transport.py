@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from vboxui.api import ConnectionFailed
+from vboxui.transport import FairSlots
+
+from .bench_transport import measure
+from .stubsoap import StubServer, StubVBox, login
+
+
+def test_workers_share_the_pooled_connections(tmp_path):
+    with StubServer(StubVBox(machines=4)) as server:
+        api = login(server, tmp_path, pool_size=4)
+        timings = measure(api, workers=16, calls=10)
+
+        assert len(timings) == 160
+        # Workers past the pool size wait for a connection instead of opening one
+        assert server.connections <= 4
+
+
+def test_broken_wsdl_and_slow_servers_fail_to_connect(tmp_path):
+    with StubServer() as server:
+        server.wsdl = None
+        with pytest.raises(ConnectionFailed, match="WSDL"):
+            login(server, tmp_path, attempts=1)
+
+    with StubServer(latency=0.5) as server:
+        with pytest.raises(ConnectionFailed, match="Login"):
+            login(server, tmp_path, attempts=1, read_timeout=0.1)
+
+
+def test_waiting_calls_time_out_and_are_served_in_order():
+    slots = FairSlots(1)
+    assert slots.acquire(timeout=0)
+    assert not slots.acquire(timeout=0.05)
+
+    served = []
+
+    def wait(n: int):
+        assert slots.acquire(timeout=5)
+        served.append(n)
+        slots.release()
+
+    waiters = []
+    for n in range(5):
+        waiters.append(threading.Thread(target=wait, args=(n,)))
+        waiters[-1].start()
+        deadline = time.monotonic() + 5
+        while len(slots._waiting) <= n:  # Queued before the next one starts
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    slots.release()
+    for waiter in waiters:
+        waiter.join(5)
+    assert served == list(range(5))
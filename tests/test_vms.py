@@ -0,0 +1,40 @@
+import asyncio
+
+from textual.app import App
+from textual.css.query import NoMatches
+from textual.widgets import TabbedContent
+
+from vboxui.vms import VMList
+
+from .stubsoap import StubServer, StubVBox, login
+from .test_fleet import wait_until
+
+
+def test_tabs_keep_their_names_once_the_cache_expires(tmp_path):
+    with StubServer(StubVBox(machines=3)) as server:
+        api = login(server, tmp_path)
+        vms = VMList(api)
+
+        async def run():
+            app = App()
+            async with app.run_test() as pilot:
+                await app.push_screen(vms)
+
+                def labels():
+                    try:
+                        tabs = vms.query_exactly_one("#vms", TabbedContent)
+                        return [str(tabs.get_tab(p).label) for p in vms.pane_machines]
+                    except NoMatches:
+                        return []
+
+                names = ["vm0", "vm1", "vm2"]
+                assert await wait_until(pilot, lambda: labels() == names, 10)
+
+                # Every cached name has expired when a machine is added or removed
+                vms.cache.ttl = 0
+                vms.vms.pop()
+                await vms.recompose()
+                await pilot.pause()
+                assert labels() == names[:2]
+
+        asyncio.run(run())
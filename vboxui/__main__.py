@@ -1,9 +1,21 @@
 from textual.app import App, ComposeResult
 from vbox_api.helpers import start_vboxwebsrv
 
+import argparse
+import asyncio
+from getpass import getpass, getuser
 import logging
+import os
+import time
 
+from .api import ConnectionFailed, build_api
+from .exporter import Exporter
+from .fleet import FleetList, Host, parse_hosts
 from .login import Login
+from .metrics import METRIC_PERIOD
+from .profile import PROFILER, ProfilePanel
+from .store import MetricsStore
+from .transport import WSDL_CACHE
 from .vms import VMList
 
 logging.basicConfig(
@@ -16,22 +28,161 @@ logging.basicConfig(
 
 class VboxApp(App):
 
+    BINDINGS = [("f12", "toggle_profile", "Profile")]
+
+    # How often the event loop is checked for falling behind
+    LAG_INTERVAL = 0.05
+
+    def __init__(
+        self,
+        store: MetricsStore | None = None,
+        job_limit: int = 3,
+        hosts: list[tuple[str, int]] | None = None,
+        host_workers: int = 2,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.job_limit = job_limit
+        self.hosts = hosts
+        self.host_workers = host_workers
+        self._tick = time.perf_counter()
+
     def on_mount(self) -> None:
+        self.set_interval(self.LAG_INTERVAL, self.sample_loop_lag)
+        if self.hosts:
+            return self.start_fleet()
 
-        self.install_screen(Login(), name="login")
+        self.install_screen(Login(endpoint=("127.0.0.1", 18083)), name="login")
 
         def setup_screens(api):
-            self.install_screen(VMList(api), name="list")
+            self.install_screen(VMList(api, self.store, self.job_limit), name="list")
             self.push_screen("list")
 
         self.push_screen("login", setup_screens)
         #  Change the main screen to login. Login will then switch to the VM list page when done
 
+    def start_fleet(self):
+        # Every host is logged in to by the fleet view, with the same credentials
+        def setup_fleet(credentials: tuple[str, str] | None):
+            if credentials is None:
+                return  # Never dismissed without them, Textual only types it optional
+            hosts = [Host(h, port, self.host_workers) for h, port in self.hosts or []]
+            self.push_screen(FleetList(hosts, *credentials, self.store, self.job_limit))
+
+        credentials = Login(lambda username, password: (username, password))
+        self.push_screen(credentials, setup_fleet)
+
+    def sample_loop_lag(self):
+        # Time past the interval is time the loop spent busy with something else
+        now = time.perf_counter()
+        lag = max(0, now - self._tick - self.LAG_INTERVAL)
+        PROFILER.record("ui", "loop_lag", now - lag, lag, group="loop_lag")
+        self._tick = now
+
+    def _display(self, screen, renderable):
+        # Every frame Textual writes to the terminal goes through here
+        started = time.perf_counter()
+        super()._display(screen, renderable)
+        if renderable is not None:
+            duration = time.perf_counter() - started
+            PROFILER.record("ui", "frame", started, duration, group="frame")
+
+    def action_toggle_profile(self):
+        panels = self.screen.query(ProfilePanel)
+        if panels:
+            panels.remove()
+        else:
+            self.screen.mount(ProfilePanel(cursor_type="none"))
+
 
 def start_app():
-    start_vboxwebsrv()
-    app = VboxApp()
+    parser = argparse.ArgumentParser(prog="vboxui")
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="keep VM metric history in a SQLite database at PATH",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=3,
+        metavar="N",
+        help="long VirtualBox operations run at once, such as creating machines",
+    )
+    parser.add_argument(
+        "--hosts",
+        type=parse_hosts,
+        metavar="HOST[:PORT],...",
+        help="show the VMs of several vboxwebsrv hosts in one fleet view",
+    )
+    parser.add_argument(
+        "--host-workers",
+        type=int,
+        default=2,
+        metavar="N",
+        help="SOAP calls in flight at once per host in the fleet view",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="write a Chrome trace of SOAP calls and frames to PATH on exit",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    export = subparsers.add_parser(
+        "export", help="serve VM metrics for Prometheus without the TUI"
+    )
+    export.add_argument("--username", default=getuser())
+    export.add_argument("--host", default="127.0.0.1", help="vboxwebsrv host")
+    export.add_argument("--port", type=int, default=18083, help="vboxwebsrv port")
+    export.add_argument("--bind", default="127.0.0.1", help="address to serve on")
+    export.add_argument("--listen-port", type=int, default=9718)
+    export.add_argument(
+        "--interval",
+        type=float,
+        default=METRIC_PERIOD,
+        help="seconds between collections, independent of scrapes",
+    )
+    args = parser.parse_args()
+
+    if args.command == "export":
+        return start_export(args)
+
+    if not args.hosts or any(h in ("127.0.0.1", "localhost") for h, _ in args.hosts):
+        start_vboxwebsrv()
+    WSDL_CACHE.preload()  # Parse while vboxwebsrv starts and the user logs in
+    store = MetricsStore(args.record) if args.record else None
+    PROFILER.trace_path = args.profile
+    app = VboxApp(store, args.jobs, args.hosts, args.host_workers)
     app.run()
+    PROFILER.write_trace()
+    if store is not None:
+        store.close()
+
+
+def start_export(args: argparse.Namespace):
+    if args.host in ("127.0.0.1", "localhost"):
+        start_vboxwebsrv()
+    WSDL_CACHE.preload()
+    password = os.environ.get("VBOXUI_PASSWORD") or getpass()
+    try:
+        api = build_api(args.username, password, args.host, args.port)
+    except ConnectionFailed as e:
+        print(e)
+        exit(1)
+
+    exporter = Exporter(api, args.interval)
+    exporter.serve(args.bind, args.listen_port)
+    try:
+        asyncio.run(exporter.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        exporter.events.stop()
+        exporter.poller.close()
+
 
 if __name__ == "__main__":
     start_app()
@@ -1,10 +1,58 @@
-import time
-from getpass import getpass, getuser
+import asyncio
 import logging
+import time
 
 import requests.exceptions
+import zeep.exceptions
+
+from vbox_api import VBoxAPI
+
+from .refs import REFS
+from .transport import (
+    ReconnectingTransport,
+    TransportInterface,
+    backoff,
+    build_session,
+)
+
+
+class ConnectionFailed(Exception):
+    pass
 
-from vbox_api import SOAPInterface, VBoxAPI
+
+async def wait_for_endpoint(
+    host: str, port: int, attempts: int = 10, timeout: float = 2
+):
+    # Runs on the event loop while the WSDL is parsed on its own thread, and
+    # returns as soon as vboxwebsrv accepts connections
+    started = time.perf_counter()
+    for attempt, delay in enumerate(backoff(attempts)):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout
+            )
+            writer.close()
+            await writer.wait_closed()
+            logging.info(
+                f"{host}:{port} answered after {time.perf_counter() - started:.2f}s, "
+                f"{attempt} retries"
+            )
+            return
+        except (OSError, TimeoutError):
+            await asyncio.sleep(delay)
+    raise ConnectionFailed(
+        f"vboxwebsrv at {host}:{port} did not answer after {attempts} attempts."
+    )
+
+
+def log_in(api, username: str, password: str, failed: str):
+    # Refused logins, faults and timeouts all surface as ConnectionFailed
+    try:
+        logged_in = api.login(username, password)
+    except (requests.exceptions.RequestException, zeep.exceptions.Error) as e:
+        raise ConnectionFailed(f"{failed}: {e}") from e
+    if not logged_in:
+        raise ConnectionFailed(f"{failed}.")
 
 
 def build_api(
@@ -12,25 +60,53 @@ def build_api(
     password: str,
     host: str = "127.0.0.1",
     port: int = 18083,
-    attempts: int = 5,
+    attempts: int = 8,
+    pool_size: int = 8,
+    connect_timeout: float = 5,
+    read_timeout: float = 30,
 ) -> VBoxAPI:
-    interface = SOAPInterface(host, port)  # SOAP interface is used to interact with the VirtualBox API
-    for _ in range(attempts):
+    transport = ReconnectingTransport(
+        session=build_session(pool_size),
+        timeout=read_timeout,
+        operation_timeout=(connect_timeout, read_timeout),
+        connections=pool_size,
+        pool_timeout=read_timeout,
+    )
+    interface = TransportInterface(host, port, transport)  # SOAP interface is used to interact with the VirtualBox API
+    started = time.perf_counter()
+    for attempt, delay in enumerate(backoff(attempts)):
         try:
             interface.connect()
             break
         except requests.exceptions.ConnectionError:
-            time.sleep(2)
+            time.sleep(delay)
+        except (requests.exceptions.RequestException, zeep.exceptions.Error) as e:
+            # Answered, but not with a WSDL in time, so retrying won't help
+            raise ConnectionFailed(
+                f"vboxwebsrv at {host}:{port} did not serve its WSDL: {e}"
+            ) from e
     else:
-        print(f"Connection to {host}:{port} failed " f"after {attempts} attempts.")
-        print("Check if vboxwebsrv is running on the host.")
-        exit(1)
+        raise ConnectionFailed(
+            f"Connection to {host}:{port} failed after {attempts} attempts. "
+            "Check if vboxwebsrv is running on the host."
+        )
 
-    logging.info("Connected")
+    logging.info(
+        f"Connected in {time.perf_counter() - started:.2f}s, "
+        f"{attempt} retries waiting for vboxwebsrv"
+    )
     api = VBoxAPI(interface)  # pyright: ignore [reportArgumentType]
-    if not api.login(username, password):
-        print("Login failed.")
-        exit(1)  # TODO: Add better login failure handling
+    log_in(api, username, password, f"Login to {host}:{port} failed")
+
+    def replay_login():
+        # A restarted vboxwebsrv has forgotten the session, log in to a new one
+        api.handle = None
+        log_in(api, username, password, f"Login to {host}:{port} failed on reconnect")
+
+    release = api.interface.ManagedObjectRef.release
+    transport.on_reconnect = replay_login
+    transport.release = release
+    REFS.pin(str(api.handle), release)
 
     logging.info("returning API")
     return api  # pyright: ignore [reportReturnType]
@@ -0,0 +1,262 @@
+import asyncio
+from datetime import datetime
+import logging
+import time
+
+from textual import on, work
+from textual.app import ComposeResult
+from textual.containers import Horizontal, Vertical
+from textual.screen import ModalScreen
+from textual.widgets import (
+    Button,
+    DataTable,
+    Input,
+    Markdown,
+    ProgressBar,
+    Select,
+    SelectionList,
+    Static,
+)
+from vbox_api.models import Machine
+
+from .cache import MachineCache
+from .jobs import Job, JobQueue, progress_for
+from .snapshots import snapshot_machine
+
+
+def start_machine(job: Job, machine: Machine):
+    job.follow(progress_for(machine, machine.start()))
+
+
+def stop_machine(job: Job, machine: Machine):
+    job.follow(progress_for(machine, machine.stop()))
+
+
+def restart_machine(job: Job, machine: Machine):
+    stop_machine(job, machine)
+    start_machine(job, machine)
+
+
+# Action name, label and job function
+ACTIONS = {
+    "start": ("Start", start_machine),
+    "stop": ("Stop", stop_machine),
+    "restart": ("Restart", restart_machine),
+    "snapshot": ("Snapshot", snapshot_machine),
+}
+
+
+# Runs one action across many machines at once. Each machine gets its own job, so
+# operations on different machines overlap and the whole run takes about as long as
+# the slowest machine, while the job queue still keeps each machine's jobs in order.
+class BulkModal(ModalScreen):
+    PARALLEL = 16  # Default operations at once, up to the job queue's bulk_limit
+
+    DEFAULT_CSS = """
+    BulkModal {
+        align: center middle;
+    }
+
+    BulkModal > Vertical {
+        width: 80%;
+        height: 90%;
+        border: thick $background 80%;
+        background: $surface;
+        padding: 1 3;
+    }
+
+    SelectionList {
+        height: 2fr;
+    }
+
+    Horizontal {
+        height: auto;
+    }
+
+    Horizontal > Static {
+        width: 1fr;
+        padding: 1 0;
+    }
+
+    Horizontal > Input, Horizontal > Select {
+        width: 3fr;
+    }
+
+    #bulk-progress {
+        display: none;
+    }
+
+    #bulk-results {
+        height: 1fr;
+    }
+
+    #btns > Button {
+        margin: 0 2 0 0;
+    }
+    """
+
+    def __init__(
+        self,
+        machines: list[tuple[Machine, str]],
+        cache: MachineCache,
+        jobs: JobQueue,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self._machines = machines
+        self._cache = cache
+        self._jobs = jobs
+        self._bulk_jobs: dict[int, Job] = {}
+        self._running = False
+        self._cancelled = False
+
+    def compose(self) -> ComposeResult:
+        with Vertical():
+            yield Markdown("**Bulk Actions**")
+            yield SelectionList[int](
+                *[(name, i) for i, (_, name) in enumerate(self._machines)],
+                id="bulk-machines",
+            )
+            with Horizontal():
+                yield Static("Action")
+                yield Select(
+                    [(label, action) for action, (label, _) in ACTIONS.items()],
+                    value="start",
+                    allow_blank=False,
+                    id="bulk-action",
+                )
+            with Horizontal():
+                yield Static("Snapshot Name")
+                yield Input(
+                    f"Bulk {datetime.now():%Y-%m-%d %H:%M}", id="bulk-snap-name"
+                )
+            with Horizontal():
+                yield Static("Parallel Operations")
+                yield Input(
+                    str(min(self.PARALLEL, self._jobs.bulk_limit)),
+                    type="integer",
+                    id="bulk-parallel",
+                )
+            yield ProgressBar(show_eta=False, id="bulk-progress")
+            yield DataTable(cursor_type="row", id="bulk-results")
+            with Horizontal(id="btns"):
+                yield Button("Run", variant="success", id="run-btn")
+                yield Button("Close", variant="error", id="close-btn")
+
+    def on_mount(self):
+        results = self.query_exactly_one("#bulk-results", DataTable)
+        for column in ("Machine", "Status", "Error"):
+            results.add_column(column, key=column)
+
+    @on(Button.Pressed, "#run-btn")
+    def run_bulk(self, event: Button.Pressed):
+        selected = self.query_exactly_one("#bulk-machines", SelectionList).selected
+        if not selected:
+            self.notify("Select at least one machine", severity="warning")
+            return
+        action = str(self.query_exactly_one("#bulk-action", Select).value)
+        parallel = int(self.query_exactly_one("#bulk-parallel", Input).value or 1)
+
+        args = ()
+        if action == "snapshot":
+            name = self.query_exactly_one("#bulk-snap-name", Input).value
+            # Pauses like the Take Snapshot default does
+            args = (name, "Taken by vboxui bulk actions", True)
+
+        for widget in self.query("SelectionList, Select, Input, #run-btn"):
+            widget.disabled = True
+        self.query_exactly_one("#close-btn", Button).label = "Cancel"
+        machines = [self._machines[i] for i in selected]
+        self.run_jobs(
+            machines, action, args, min(max(1, parallel), self._jobs.bulk_limit)
+        )
+
+    @work(exclusive=True)
+    async def run_jobs(
+        self,
+        machines: list[tuple[Machine, str]],
+        action: str,
+        args: tuple,
+        parallel: int,
+    ):
+        label, func = ACTIONS[action]
+        limit = asyncio.Semaphore(parallel)
+        results = self.query_exactly_one("#bulk-results", DataTable)
+        results.clear()
+        progress = self.query_exactly_one("#bulk-progress", ProgressBar)
+        progress.update(total=len(machines) * 100, progress=0)
+        progress.display = True
+        self._bulk_jobs = {}
+        self._running = True
+        self._cancelled = False
+
+        async def run_one(row: int, machine: Machine, name: str):
+            async with limit:
+                if self._cancelled:
+                    results.update_cell(str(row), "Status", "cancelled")
+                    return False
+                job = self._jobs.submit(
+                    f"{label} {name}",
+                    str(machine.handle),
+                    func,
+                    machine,
+                    *args,
+                    bulk=True,
+                )
+                self._bulk_jobs[row] = job
+                try:
+                    await self._jobs.wait(job)
+                    return True
+                except Exception as e:
+                    results.update_cell(str(row), "Error", str(e))
+                    return False
+                finally:
+                    self._cache.invalidate(machine)
+                    results.update_cell(str(row), "Status", job.status)
+
+        for row, (_, name) in enumerate(machines):
+            results.add_row(name, "queued", "", key=str(row))
+
+        started = time.monotonic()
+        timer = self.set_interval(0.25, self.show_progress)
+        try:
+            outcomes = await asyncio.gather(
+                *(run_one(row, m, name) for row, (m, name) in enumerate(machines))
+            )
+        finally:
+            timer.stop()
+            self._running = False
+        self.show_progress()
+
+        elapsed = time.monotonic() - started
+        succeeded = f"{sum(outcomes)} of {len(machines)} succeeded in {elapsed:.1f}s"
+        logging.info(f"Bulk {action}: {succeeded}")
+        self.notify(
+            f"{label}: {succeeded}",
+            severity="information" if all(outcomes) else "error",
+        )
+        for widget in self.query("SelectionList, Select, Input, #run-btn"):
+            widget.disabled = False
+        self.query_exactly_one("#close-btn", Button).label = "Close"
+
+    def show_progress(self):
+        # Every machine counts for 100, so the bar is the sum of all job percentages
+        results = self.query_exactly_one("#bulk-results", DataTable)
+        for row, job in self._bulk_jobs.items():
+            if not job.done:
+                results.update_cell(str(row), "Status", f"{job.status} {job.percent}%")
+        self.query_exactly_one("#bulk-progress", ProgressBar).update(
+            progress=sum(job.percent for job in self._bulk_jobs.values())
+        )
+
+    @on(Button.Pressed, "#close-btn")
+    def close_bulk(self, event: Button.Pressed):
+        if self._running:
+            # Machines not started yet are skipped, running jobs cancel their progress
+            self._cancelled = True
+            for job in self._bulk_jobs.values():
+                if not job.done:
+                    job.cancel()
+            return
+        self.dismiss()
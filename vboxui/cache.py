@@ -0,0 +1,209 @@
+from datetime import datetime
+import threading
+import time
+from typing import Callable
+
+from vbox_api.models import Machine
+
+from .models import MachineDetails, SnapshotInfo
+
+
+# Every Machine attribute read is its own SOAP round trip, so the attributes vboxui
+# displays are fetched together on a worker thread and served from memory. Entries
+# are dropped once they're older than the TTL, when the machine's state change
+# timestamp moves, or when an action that changes the machine invalidates them.
+class MachineCache:
+
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, tuple[float, MachineDetails]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fetch(machine: Machine) -> MachineDetails:
+        return MachineDetails(
+            machine.id,
+            machine.name,
+            machine.os_type_id,
+            machine.cpu_count,
+            machine.memory_size,
+            machine.health,
+            machine.network_adapters,
+            [m for m in machine.mediums if m.type == "HardDisk"],
+            machine.get_last_state_change_dt(),
+        )
+
+    def peek(self, machine: Machine) -> MachineDetails | None:
+        # Never makes a SOAP call, so it's safe to use from the event loop
+        with self._lock:
+            entry = self._entries.get(str(machine.handle))
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def get(self, machine: Machine) -> MachineDetails:
+        details = self.peek(machine)
+        if details is None:
+            details = self.fetch(machine)
+            self._store(machine, details)
+        return details
+
+    def validate(self, machine: Machine) -> MachineDetails:
+        # One round trip to check the state change timestamp, everything else is
+        # only fetched again when it moved
+        details = self.peek(machine)
+        if details is None or details.last_state_change != (
+            machine.get_last_state_change_dt()
+        ):
+            details = self.fetch(machine)
+            self._store(machine, details)
+        return details
+
+    def prefetch(self, machines: list[Machine]):
+        for machine in machines:
+            self.get(machine)
+
+    def invalidate(self, machine: Machine | None = None):
+        with self._lock:
+            if machine is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(machine.handle), None)
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def _store(self, machine: Machine, details: MachineDetails):
+        with self._lock:
+            self._entries[str(machine.handle)] = time.monotonic(), details
+
+
+# Snapshot metadata per machine UUID, indexed one tree level at a time as the snapshot
+# list opens them, so only the levels someone looked at cost round trips. The index
+# is dropped when the machine's snapshot count or current snapshot moved, or after a
+# snapshot event invalidated it, so reopening the snapshot list is instant.
+class SnapshotIndex:
+
+    def __init__(self, batch_size: int = 25):
+        self.batch_size = batch_size
+        # Signature, snapshots by id, and the child ids of every fetched level keyed
+        # by parent id, None for the root
+        self._entries: dict[
+            str, tuple[tuple, dict[str, SnapshotInfo], dict[str | None, list[str]]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def signature(machine: Machine) -> tuple[int, str | None]:
+        count = machine.snapshot_count
+        if not count:
+            return 0, None
+        return count, machine.current_snapshot.id
+
+    def peek(self, machine_id: str) -> dict[str, SnapshotInfo] | None:
+        # Every snapshot indexed so far, parents before their children
+        with self._lock:
+            entry = self._entries.get(machine_id)
+        return dict(entry[1]) if entry is not None else None
+
+    def level(
+        self, machine_id: str, parent_id: str | None
+    ) -> list[SnapshotInfo] | None:
+        with self._lock:
+            entry = self._entries.get(machine_id)
+            if entry is None or parent_id not in entry[2]:
+                return None
+            return [entry[1][child] for child in entry[2][parent_id]]
+
+    def unfetched(self, machine_id: str) -> list[str | None]:
+        # Levels not fetched yet that are known to hold snapshots, None for the root
+        with self._lock:
+            entry = self._entries.get(machine_id)
+            if entry is None or not entry[0][0]:
+                return []
+            levels = [
+                info.id
+                for info in entry[1].values()
+                if info.children_count and info.id not in entry[2]
+            ]
+            return levels if None in entry[2] else [None, *levels]
+
+    def validate(self, machine: Machine, machine_id: str) -> bool:
+        # Returns False, starting an empty index, if the cached one is out of date
+        signature = self.signature(machine)
+        with self._lock:
+            entry = self._entries.get(machine_id)
+            if entry is not None and entry[0] == signature:
+                return True
+            self._entries[machine_id] = signature, {}, {}
+        return False
+
+    def fetch_level(
+        self,
+        machine: Machine,
+        machine_id: str,
+        parent_id: str | None,
+        on_batch: Callable[[list[SnapshotInfo]], None] | None = None,
+    ) -> list[SnapshotInfo]:
+        # The root snapshot for None, otherwise the children of parent_id
+        cached = self.level(machine_id, parent_id)
+        if cached is not None:
+            return cached
+        with self._lock:
+            entry = self._entries.get(machine_id)
+        if entry is None or not entry[0][0]:
+            return []
+        if parent_id is None:
+            snapshots = [machine.find_snapshot("")]
+        else:
+            snapshots = machine.find_snapshot(parent_id).children
+
+        level: list[SnapshotInfo] = []
+        for start in range(0, len(snapshots), self.batch_size):
+            batch = [
+                SnapshotInfo(
+                    snapshot.id,
+                    snapshot.name,
+                    snapshot.description,
+                    snapshot.online,
+                    parent_id,
+                    snapshot.time_stamp,
+                    snapshot.children_count,
+                )
+                for snapshot in snapshots[start : start + self.batch_size]
+            ]
+            with self._lock:
+                entry[1].update((info.id, info) for info in batch)
+            level.extend(batch)
+            if on_batch is not None:
+                on_batch(batch)
+        with self._lock:
+            entry[2][parent_id] = [info.id for info in level]
+        return level
+
+    def search(self, machine_id: str, query: str) -> list[SnapshotInfo]:
+        # Matches names, or dates written as 2024-05-31 or 5/31/2024, among the
+        # snapshots indexed so far
+        query = query.strip().lower()
+        matches = []
+        for info in (self.peek(machine_id) or {}).values():
+            taken = datetime.fromtimestamp(info.time_stamp / 1000)
+            if (
+                query in info.name.lower()
+                or taken.strftime("%Y-%m-%d %H:%M").startswith(query)
+                or f"{taken.month}/{taken.day}/{taken.year}".startswith(query)
+            ):
+                matches.append(info)
+        return matches
+
+    def invalidate(self, machine_id: str | None = None):
+        with self._lock:
+            if machine_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(machine_id, None)
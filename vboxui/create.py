@@ -2,7 +2,7 @@ from getpass import getuser
 import logging
 import os
 from pathlib import Path
-import time
+from typing import Callable
 
 import psutil
 from textual import on, work
@@ -26,19 +26,29 @@ from textual_slider import Slider
 from textual_fspicker import SelectDirectory, FileOpen
 from vbox_api import VBoxAPI
 from vbox_api.constants import AccessMode, MediumDeviceType, MediumState, MediumVariant
-from vbox_api.models import Machine
+from vbox_api.models import Machine, Medium, Progress
+
+from .jobs import Job, JobQueue
+from .refs import REFS, subsystem
+from .registry import Registry
+from .validation import ValidationEngine
 
 
 # Machines must have unique names
 class UniqueName(Validator):
 
-    def __init__(self, api: VBoxAPI, *args, **kwargs):
+    def __init__(self, registry: Registry, *args, timeout: float = 30, **kwargs):
         super().__init__(*args, **kwargs)
-        self.api = api
+        self.registry = registry
+        self.timeout = timeout
 
     def validate(self, value: str) -> ValidationResult:
-        found = next((m for m in self.api.machines if m.name == value), None)
-        if not found:
+        # Checked against the registry on every keystroke, without a round trip. Runs
+        # on a validation thread, so it can wait for the registry to finish loading,
+        # until then every name would look free.
+        if not self.registry.loaded.wait(self.timeout):
+            return self.failure("Still loading the names of existing machines", value)
+        if not self.registry.has_machine(value):
             return self.success()
         else:
             return self.failure("Already existing machine shares that name", value)
@@ -66,6 +76,21 @@ class PathExists(Validator):
             return self.failure("Path does not exist")
 
 
+# Disks must fit in the free space where they'll be stored
+class FitsOnDisk(Validator):
+
+    def __init__(self, location: Callable[[], str], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.location = location
+
+    def validate(self, value: str) -> ValidationResult:
+        try:
+            free = psutil.disk_usage(self.location()).free // 1_000_000
+        except OSError:
+            return self.failure("Storage location is not available")
+        return Integer(4, free).validate(value)
+
+
 class CreateModal(ModalScreen[Machine]):
     DEFAULT_CSS = """
     CreateModal {
@@ -141,13 +166,30 @@ class CreateModal(ModalScreen[Machine]):
         ("tab-storage", ["slocation-input", "ssize-input"]),
     ]
 
-    def __init__(self, api: VBoxAPI, *args, **kwargs):
+    def __init__(
+        self, api: VBoxAPI, jobs: JobQueue, registry: Registry, *args, **kwargs
+    ):
         super().__init__(*args, **kwargs)
 
         mem = psutil.virtual_memory()
         self._max_cpu_cores = psutil.cpu_count() or 2
         self._max_memory = mem.total // 1_000_000
         self._api = api
+        self._jobs = jobs
+        self._registry = registry
+        self.validation = ValidationEngine(self, self.show_validation)
+        # A result from before the registry loaded isn't reused once it has
+        self.validation.add(
+            "name-input", UniqueName(registry), depends=registry.loaded.is_set
+        )
+        self.validation.add("parent-input", PathExists(target_directory=True))
+        self.validation.add("iso-input", PathExists(target_directory=False))
+        self.validation.add("slocation-input", PathExists(target_directory=True))
+        self.validation.add(
+            "ssize-input",
+            FitsOnDisk(lambda: self.form_data["slocation-input"]),
+            depends=lambda: self.form_data["slocation-input"],
+        )
         self.form_data = {
             "name-input": "",
             "parent-input": f"/home/{getuser()}/VirtualBox VMs",
@@ -169,8 +211,6 @@ class CreateModal(ModalScreen[Machine]):
                             yield Input(
                                 self.form_data["name-input"],
                                 id="name-input",
-                                validators=[UniqueName(self._api)],
-                                validate_on=["changed"],
                                 placeholder="Unique Machine Name",
                             )
                         yield Static(f"", classes="error-message", id="error-name")
@@ -181,8 +221,6 @@ class CreateModal(ModalScreen[Machine]):
                                 yield Input(
                                     self.form_data["parent-input"],
                                     id="parent-input",
-                                    validators=[PathExists(target_directory=True)],
-                                    validate_on=["changed"],
                                 )
                                 yield Button(
                                     "Select Directory",
@@ -197,8 +235,6 @@ class CreateModal(ModalScreen[Machine]):
                                 yield Input(
                                     self.form_data["iso-input"],
                                     id="iso-input",
-                                    validators=[PathExists(target_directory=False)],
-                                    validate_on=["changed"],
                                 )
                                 yield Button(
                                     "Select File", id="iso-btn", classes="filepicker"
@@ -247,8 +283,6 @@ class CreateModal(ModalScreen[Machine]):
                                 yield Input(
                                     self.form_data["slocation-input"],
                                     id="slocation-input",
-                                    validators=[PathExists(target_directory=True)],
-                                    validate_on=["changed"],
                                 )
                                 yield Button(
                                     "Select Directory",
@@ -263,10 +297,6 @@ class CreateModal(ModalScreen[Machine]):
                                 self.form_data["ssize-input"],
                                 id="ssize-input",
                                 type="integer",
-                                validators=[
-                                    Integer(4, psutil.disk_usage("/").free // 1_000_000)
-                                ],
-                                validate_on=["changed"],
                             )
                         yield Static(f"", classes="error-message", id="error-ssize")
             with Horizontal(id="options"):
@@ -346,26 +376,31 @@ class CreateModal(ModalScreen[Machine]):
         self.app.pop_screen()
 
     @on(Input.Changed)
-    @work
-    async def display_errors(self, event: Input.Changed):
+    def validate_input(self, event: Input.Changed):
         if event.input.id is None:
             logging.warning("Input element lacks ID")
             return
 
+        # Checked off the event loop once typing pauses, then shown by show_validation
+        self.validation.check(event.input.id, event.value)
+
+    def show_validation(self, input_id: str, value: str, result: ValidationResult):
         # Show any errors users make
+        err_element = self.query_exactly_one("#error-" + input_id.split("-")[0], Static)
+        self.query_exactly_one("#" + input_id, Input).set_class(
+            not result.is_valid, "-invalid"
+        )
+        if not result.is_valid:
+            err_element.update("*" + ", ".join(result.failure_descriptions) + "*")
+            err_element.styles.display = "block"
+        else:
+            self.form_data[input_id] = value
+            err_element.styles.display = "none"
 
-        if event.validation_result is not None:
-            err_element = self.query_exactly_one(
-                "#error-" + event.input.id.split("-")[0], Static
-            )
-            if not event.validation_result.is_valid:
-                err_element.update(
-                    "*" + ", ".join(event.validation_result.failure_descriptions) + "*"
-                )
-                err_element.styles.display = "block"
-            else:
-                self.form_data[event.input.id] = event.value
-                err_element.styles.display = "none"
+        if input_id == "slocation-input":
+            # The size check depends on the free space at the storage location
+            size = self.query_exactly_one("#ssize-input", Input).value
+            self.validation.check("ssize-input", size)
 
         active_tab = self.query_exactly_one(TabbedContent).active_pane
 
@@ -373,11 +408,9 @@ class CreateModal(ModalScreen[Machine]):
             logging.warning("Active tab not found or has no ID")
             return
 
-        self.check_active_tab(active_tab, event)
+        self.check_active_tab(active_tab, input_id)
 
-    def check_active_tab(
-        self, active_tab: TabPane | Tab, event: Input.Changed | None = None
-    ):
+    def check_active_tab(self, active_tab: TabPane | Tab, input_id: str | None = None):
         # This function is responsible for checking how far the user is allowed to progress into the VM creation form
         if active_tab.id is None:
             return
@@ -397,7 +430,7 @@ class CreateModal(ModalScreen[Machine]):
                     "#" + self.tab_form[next_tab][0], TabPane
                 ).disabled = False
 
-            if event and event.input.id in tab_inputs:
+            if input_id in tab_inputs:
                 logging.info(self.form_data, tab_inputs)
                 self.query_exactly_one("#continue-btn", Button).disabled = False
         else:
@@ -406,60 +439,159 @@ class CreateModal(ModalScreen[Machine]):
                     "#" + self.tab_form[next_tab][0], TabPane
                 ).disabled = True
 
-            if event and event.input.id in tab_inputs:
+            if input_id in tab_inputs:
                 self.query_exactly_one("#continue-btn", Button).disabled = True
 
-    def create_machine(self):
+    @work(exclusive=True)
+    async def create_machine(self):
+        self.query_exactly_one("#continue-btn", Button).disabled = True
+        job = self._jobs.submit(
+            f"Create {self.form_data['name-input']}",
+            "create:" + self.form_data["name-input"],
+            self.build_machine,
+            dict(self.form_data),
+        )
+        header = self.query_exactly_one("#header", Label)
+
+        def show_stage():
+            header.update(f"Creating machine: {job.stage} ({job.percent}%)")
+
+        timer = self.set_interval(0.25, show_stage)
+        try:
+            machine = await self._jobs.wait(job)
+        except Exception as e:
+            self.notify(str(e), title="Unable to create machine", severity="error")
+            self.query_exactly_one("#continue-btn", Button).disabled = False
+            header.update("Create a new Machine")
+            return
+        finally:
+            timer.stop()
+        self.dismiss(machine)
+
+    def build_machine(self, job: Job, form_data: dict) -> Machine:
+        # Runs on a job thread, with a copy of the form taken when it was submitted
+        job.set_stage("Creating machine")
         unattended = self._api.ctx.api.create_unattended_installer()
-        unattended.iso_path = self.form_data["iso-input"]
+        unattended.iso_path = form_data["iso-input"]
         logging.info(unattended.iso_path)
         # unattended.detect_iso_os()
-        settings_path = self._api.compose_machine_filename(
-            self.form_data["name-input"], "/", "", self.form_data["parent-input"]
-        )
-        architecture = self._api.host.architecture
-        machine: Machine = self._api.create_machine(
-            settings_path,
-            self.form_data["name-input"],
-            architecture,
-            ["/"],
-            "Linux26_64",  # OS detection not working at all sadly
-            "",
-            "",
-            "",
-            "",
-        )
-        machine.apply_defaults("")
-        self._api.register_machine(machine)
-
-        with machine.with_lock(save_settings=True, force_unlock=True) as mut_machine:
-            mut_machine.cpu_count = self.form_data["cpu-input"]
-            mut_machine.memory_size = self.form_data["memory-input"]
-            medium = self._api.create_medium(
-                "",
-                os.path.join(
-                    self.form_data["slocation-input"],
-                    self.form_data["name-input"] + ".vdi",
-                ),
-                AccessMode.READ_WRITE,
-                MediumDeviceType.HARD_DISK,
-            )
-            logging.info(self.form_data["ssize-input"])
-            progress = medium.create_base_storage(
-                ((int(self.form_data["ssize-input"]) * 1_000_000) // 512) * 512,
-                ["Standard"],
+        logging.info(form_data["ssize-input"])
+        size = ((int(form_data["ssize-input"]) * 1_000_000) // 512) * 512
+        name = form_data["name-input"]
+        iso = None
+        if form_data["iso-input"]:
+            iso = self._registry.open_medium(
+                self._api, form_data["iso-input"], "DVD", AccessMode.READ_ONLY, True
             )
+        return provision_machine(
+            job,
+            self._api,
+            name,
+            form_data["parent-input"],
+            form_data["cpu-input"],
+            form_data["memory-input"],
+            os.path.join(form_data["slocation-input"], name + ".vdi"),
+            lambda medium: medium.create_base_storage(size, ["Standard"]),
+            iso,
+        )
 
-            progress.wait_for_completion(10)
-            medium.refresh_state()
-            logging.info(medium.state)
 
-            iso_medium = self._api.open_medium(
-                self.form_data["iso-input"], "DVD", AccessMode.READ_ONLY, True
+def provision_machine(
+    job: Job,
+    api: VBoxAPI,
+    name: str,
+    parent_dir: str,
+    cpu_count: int,
+    memory_size: int,
+    disk_location: str,
+    allocate: Callable[[Medium], Progress],
+    iso: Medium | None = None,
+) -> Machine:
+    # Runs on a job thread. allocate starts filling the new disk, from scratch or as
+    # a differencing image of a shared base. Anything created is recorded as it's
+    # made, so a failure at any stage can remove the partial machine and disk again.
+    # Timed and tracked as "create" rather than with the other jobs, whatever it
+    # made is released again if it's rolled back.
+    scope = f"create:{job.id}"
+    created: dict[str, Machine | Medium] = {}
+    try:
+        with subsystem(scope):
+            job.set_stage("Creating machine")
+            settings_path = api.compose_machine_filename(name, "/", "", parent_dir)
+            architecture = api.host.architecture
+            machine: Machine = api.create_machine(
+                settings_path,
+                name,
+                architecture,
+                ["/"],
+                "Linux26_64",  # OS detection not working at all sadly
+                "",
+                "",
+                "",
+                "",
             )
+            machine.apply_defaults("")
 
-            mut_machine.attach_medium(iso_medium, "IDE")  # Manually mount ISO because unattended installer wasn't working
+            job.set_stage("Registering machine")
+            api.register_machine(machine)
+            created["machine"] = machine
 
-            mut_machine.attach_medium(medium, "SATA")
+            with machine.with_lock(
+                save_settings=True, force_unlock=True
+            ) as mut_machine:
+                mut_machine.cpu_count = cpu_count
+                mut_machine.memory_size = memory_size
 
-        self.dismiss(machine)
+                job.set_stage("Allocating disk")
+                medium = api.create_medium(
+                    "", disk_location, AccessMode.READ_WRITE, MediumDeviceType.HARD_DISK
+                )
+                created["medium"] = medium
+                # Waits for as long as allocation takes, the disk is never attached
+                # half created
+                job.follow(allocate(medium))
+                medium.refresh_state()
+                if medium.state != MediumState.CREATED:
+                    raise RuntimeError(f"Disk was left {medium.state} after allocation")
+
+                job.set_stage("Attaching media")
+                if iso is not None:
+                    mut_machine.attach_medium(iso, "IDE")  # Manually mount ISO because unattended installer wasn't working
+
+                mut_machine.attach_medium(medium, "SATA")
+                created["attached"] = medium
+    except Exception:
+        job.set_stage("Rolling back")
+        with subsystem(scope):
+            roll_back(created)
+        REFS.release(scope)
+        raise
+
+    return machine
+
+
+def roll_back(created: dict):
+    # Waits without the job's cancel flag, a cancelled creation still has to be
+    # cleaned up completely
+    if "machine" in created:
+        try:
+            # Unregisters the machine, deleting its settings and attached disks
+            progress = created["machine"].delete()
+            if progress is not None:
+                progress.wait_for_completion(-1)
+            if "attached" in created:
+                created.pop("medium", None)
+        except Exception:
+            logging.exception("Unable to remove partially created machine")
+    if "medium" in created:
+        medium = created["medium"]
+        try:
+            # Only a disk whose storage was created can delete it, one that was
+            # cancelled or never allocated is just closed, which unregisters it
+            medium.refresh_state()
+            if medium.state == MediumState.CREATED:
+                medium.delete_storage().wait_for_completion(-1)
+            else:
+                medium.close()
+        except Exception:
+            logging.exception("Unable to remove partially created disk")
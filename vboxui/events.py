@@ -0,0 +1,76 @@
+import itertools
+import logging
+import threading
+from typing import Callable
+
+from vbox_api import VBoxAPI
+from vbox_api.constants import VBoxEventType
+from vbox_api.models import PassiveEventListener
+
+from .models import MachineEvent
+from .refs import REFS, subsystem
+
+WATCHED_EVENTS = [
+    VBoxEventType.ON_MACHINE_STATE_CHANGED,
+    VBoxEventType.ON_MACHINE_DATA_CHANGED,
+    VBoxEventType.ON_MACHINE_REGISTERED,
+    VBoxEventType.ON_MEDIUM_REGISTERED,
+    VBoxEventType.ON_SNAPSHOT_TAKEN,
+    VBoxEventType.ON_SNAPSHOT_DELETED,
+    VBoxEventType.ON_SNAPSHOT_CHANGED,
+    VBoxEventType.ON_SNAPSHOT_RESTORED,
+]
+
+
+# Long-polls a passive listener on the VirtualBox event source and hands machine
+# events to the callback. If the listener can't be set up, or the connection fails,
+# the thread exits and callers go back to polling.
+class EventWatcher(threading.Thread):
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        api: VBoxAPI,
+        callback: Callable[[MachineEvent], None],
+        timeout_ms: int = 1000,
+    ):
+        super().__init__(name="vboxui-events", daemon=True)
+        self.api = api
+        self.callback = callback
+        self.timeout_ms = timeout_ms
+        self._scope = f"events:{next(self._ids)}"
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        try:
+            listener = PassiveEventListener.from_ctx(self.api.ctx, WATCHED_EVENTS)
+        except Exception:
+            logging.exception("Unable to listen for events, falling back to polling")
+            return
+
+        logging.info("Listening for VirtualBox events")
+        try:
+            while not self._stop_event.is_set():
+                with subsystem(self._scope):
+                    # get_event blocks on the server for up to timeout_ms (a long poll)
+                    event = listener.get_event(self.timeout_ms)
+                    if not event:
+                        continue
+                    if event.type == VBoxEventType.ON_MEDIUM_REGISTERED:
+                        # Carries the medium's id in place of a machine's
+                        machine_event = MachineEvent(event.type, event.medium_id)
+                    else:
+                        machine_event = MachineEvent(event.type, event.machine_id)
+                # Every event is a new reference on the server, done with once read
+                REFS.release(self._scope)
+                self.callback(machine_event)
+        except Exception:
+            logging.exception("Event listener failed, falling back to polling")
+        finally:
+            try:
+                listener.source.unregister_listener(listener)
+            except Exception:
+                pass
@@ -0,0 +1,193 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import re
+import threading
+import time
+
+import zeep.exceptions
+from vbox_api import VBoxAPI, models
+from vbox_api.constants import VBoxEventType
+
+from .events import EventWatcher
+from .metrics import METRIC_PERIOD, setup_metrics, split_metrics
+from .models import MachineEvent
+from .polling import Poller
+from .registry import Registry
+from .session import SessionManager, stale
+from .transport import SessionReplaced
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metric_name(name: str) -> str:
+    # "CPU/Load/User" -> "vbox_cpu_load_user"
+    return "vbox_" + re.sub(r"[^a-zA-Z0-9_]", "_", name).lower()
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Headless counterpart to VMList: collects metrics and machine health on its own
+# schedule with the same poller, and keeps the rendered Prometheus exposition cached.
+# Scrapes only ever read the cache, so they never cause SOAP traffic. Health is read
+# once per machine and then only again after a state change event for it, and the
+# session is kept alive, and rebuilt after vboxwebsrv restarts, like the VM list's.
+class Exporter:
+
+    def __init__(
+        self,
+        api: VBoxAPI,
+        interval: float = METRIC_PERIOD,
+        refresh_machines_every: int = 30,
+    ):
+        self.api = api
+        self.interval = interval
+        self.refresh_machines_every = refresh_machines_every
+        self.collector = api.performance_collector
+        self.poller = Poller()
+        self.session = SessionManager(api, Registry())
+        self.events = EventWatcher(api, self.on_event)
+        self.snapshot = b""
+        # Machine, UUID, name and health by handle
+        self._machines: dict[str, tuple[models.Machine, str, str, int]] = {}
+        self._changed: set[str] = set()
+        self._lock = threading.Lock()
+
+    def on_event(self, event: MachineEvent):
+        # Called on the event watcher thread
+        if event.kind == VBoxEventType.ON_MACHINE_STATE_CHANGED:
+            with self._lock:
+                self._changed.add(event.machine_id)
+
+    def fetch_machines(self):
+        machines = {}
+        new = []
+        for vm in self.api.machines:
+            entry = self._machines.get(str(vm.handle))
+            if entry is None:
+                new.append(vm)
+                entry = vm, vm.id, vm.name, int(vm.health)
+            machines[str(vm.handle)] = entry
+        if new:
+            setup_metrics(self.api, self.collector, new)
+        self._machines = machines
+
+    def refresh_health(self):
+        # Every machine when there are no events to say which ones changed
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        watching = self.events.is_alive()
+        for handle, (vm, machine_id, name, health) in list(self._machines.items()):
+            if not watching or machine_id in changed:
+                self._machines[handle] = vm, machine_id, name, int(vm.health)
+
+    def reset(self):
+        # The collector and every machine reference went with the old session
+        self.collector = self.api.performance_collector
+        self._machines = {}
+        self.fetch_machines()
+        if not self.events.is_alive():
+            self.events = EventWatcher(self.api, self.on_event)
+            self.events.start()
+
+    def collect(self) -> bytes:
+        try:
+            return self.render()
+        except SessionReplaced:
+            pass
+        except zeep.exceptions.Fault as e:
+            if not stale(e):
+                raise
+            self.session.keepalive()
+        logging.warning("vboxwebsrv session was replaced, collecting again")
+        self.reset()
+        return self.render()
+
+    def render(self) -> bytes:
+        lines = []
+        started = time.monotonic()
+        self.refresh_health()
+        machines = self._machines
+
+        metrics = split_metrics(
+            self.collector.query_metrics_data(None, list(machines))
+        )
+        families: dict[str, list[str]] = {}
+        for handle, vm_metrics in metrics.items():
+            if handle not in machines:
+                continue
+            _, machine_id, name, _ = machines[handle]
+            labels = f'id="{machine_id}",machine="{escape_label(name)}"'
+            for metric, samples in vm_metrics.items():
+                if not samples.values or ":" in metric:
+                    continue
+                value = samples.values[-1] / (samples.scale or 1)
+                families.setdefault(metric, []).append(
+                    f"{metric_name(metric)}{{{labels}}} {value}"
+                )
+
+        for metric, samples in sorted(families.items()):
+            lines.append(f"# HELP {metric_name(metric)} VirtualBox metric {metric}")
+            lines.append(f"# TYPE {metric_name(metric)} gauge")
+            lines += samples
+
+        lines.append("# HELP vbox_machine_health vboxui health code of the machine")
+        lines.append("# TYPE vbox_machine_health gauge")
+        for _, machine_id, name, health in machines.values():
+            labels = f'id="{machine_id}",machine="{escape_label(name)}"'
+            lines.append(f"vbox_machine_health{{{labels}}} {health}")
+
+        lines.append("# HELP vboxui_collect_seconds Time taken by the last collection")
+        lines.append("# TYPE vboxui_collect_seconds gauge")
+        lines.append(f"vboxui_collect_seconds {time.monotonic() - started}")
+        lines.append("# HELP vboxui_collect_timestamp_seconds Last collection time")
+        lines.append("# TYPE vboxui_collect_timestamp_seconds gauge")
+        lines.append(f"vboxui_collect_timestamp_seconds {time.time()}")
+        return ("\n".join(lines) + "\n").encode()
+
+    async def keep_session(self):
+        recovered = await self.poller.run("session", self.session.keepalive)
+        if recovered:
+            await self.poller.run("machines", self.reset, timeout=120)
+
+    async def run(self):
+        cycle = 0
+        kept_alive = time.monotonic()
+        self.events.start()
+        while True:
+            started = time.monotonic()
+            if started - kept_alive >= self.session.interval:
+                kept_alive = started
+                await self.keep_session()
+            if cycle % self.refresh_machines_every == 0:
+                await self.poller.run("machines", self.fetch_machines)
+            snapshot = await self.poller.run("collect", self.collect)
+            if snapshot is not None:
+                self.snapshot = snapshot
+            cycle += 1
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.snapshot
+                self.send_response(200 if body else 503)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
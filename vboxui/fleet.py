@@ -0,0 +1,241 @@
+import logging
+import time
+
+from textual import on
+from textual.css.query import NoMatches
+from textual.screen import Screen
+from textual.widgets import DataTable, Footer, Header, Static
+from vbox_api import VBoxAPI
+from vbox_api.models.machine import MachineHealth
+
+from .api import ConnectionFailed, build_api, wait_for_endpoint
+from .cache import MachineCache
+from .models import FleetRow
+from .polling import Poller
+from .store import MetricsStore
+from .vms import VMList
+
+
+def parse_hosts(value: str, default_port: int = 18083) -> list[tuple[str, int]]:
+    # "lab1,lab2:18084" -> [("lab1", 18083), ("lab2", 18084)]
+    hosts = []
+    for entry in value.split(","):
+        host, _, port = entry.strip().partition(":")
+        if host:
+            hosts.append((host, int(port) if port else default_port))
+    return hosts
+
+
+# One vboxwebsrv endpoint of the fleet. Every host has its own poller, so a slow or
+# dead host only ever ties up its own workers and the others keep refreshing.
+class Host:
+
+    def __init__(self, host: str, port: int, workers: int = 2):
+        self.host = host
+        self.port = port
+        self.address = f"{host}:{port}"
+        self.api: VBoxAPI | None = None
+        self.status = "connecting"
+        self.poller = Poller(workers, timeout=30)
+        self.cache = MachineCache()
+
+    def connect(self, username: str, password: str) -> bool:
+        # Runs on a worker thread, hosts log in at the same time as each other
+        started = time.perf_counter()
+        try:
+            self.api = build_api(username, password, self.host, self.port, attempts=3)
+        except Exception as e:
+            logging.warning(f"Unable to connect to {self.address}: {e}")
+            self.status = "failed"
+            return False
+        elapsed = time.perf_counter() - started
+        logging.info(f"Logged in to {self.address} in {elapsed:.2f}s")
+        self.status = "online"
+        return True
+
+    def fetch_rows(self) -> list[FleetRow]:
+        # One call for the machine list and one state check per machine, everything
+        # else comes from the cache until the machine's state changes
+        if self.api is None:
+            return []
+        rows = []
+        for machine in self.api.machines:
+            details = self.cache.validate(machine)
+            rows.append(
+                FleetRow(
+                    self.address,
+                    details.id,
+                    details.name,
+                    details.health,
+                    details.os_type_id,
+                    details.cpu_count,
+                    details.memory_size,
+                )
+            )
+        return rows
+
+    def close(self):
+        self.poller.close()
+
+
+# Machines from every host in one sortable table. Hosts connect and refresh
+# independently, and their rows are filled in as each one answers, so the list is
+# usable while slower hosts are still logging in. Selecting a row opens the usual
+# VM list for that machine's host.
+class FleetList(Screen):
+    DEFAULT_CSS = """
+	#fleet-hosts {
+	  height: auto;
+	  margin: 1 1 0 1;
+	}
+
+	#fleet {
+	  height: 1fr;
+	  margin: 1 1 0 1;
+	}
+	"""
+
+    BINDINGS = [("r", "refresh_hosts", "Refresh now")]
+
+    COLUMNS = ["Host", "Name", "State", "OS", "CPUs", "Memory (MB)"]
+
+    def __init__(
+        self,
+        hosts: list[Host],
+        username: str,
+        password: str,
+        store: MetricsStore | None = None,
+        job_limit: int = 3,
+        interval: float = 5,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.hosts = {host.address: host for host in hosts}
+        self.username = username
+        self.password = password
+        self.store = store
+        self.job_limit = job_limit
+        self.interval = interval
+        self.sort_column: str | None = None
+        self.sort_reverse = False
+        self._rows: dict[str, set[str]] = {host.address: set() for host in hosts}
+
+    def compose(self):
+        yield Header()
+        yield Static("", id="fleet-hosts")
+        yield DataTable(cursor_type="row", id="fleet")
+        yield Footer()
+
+    def on_mount(self):
+        self.title = "Fleet"
+        table = self.query_exactly_one("#fleet", DataTable)
+        for column in self.COLUMNS:
+            table.add_column(column, key=column)
+        self.show_hosts()
+        for host in self.hosts.values():
+            self.run_worker(self.connect_host(host), group="connect")
+        self.set_interval(self.interval, self.action_refresh_hosts)
+
+    async def connect_host(self, host: Host):
+        # Hosts are probed and logged in to concurrently, none waits on another
+        try:
+            await wait_for_endpoint(host.host, host.port, attempts=6)
+        except ConnectionFailed as e:
+            logging.warning(str(e))
+            host.status = "unreachable"
+            self.show_hosts()
+            return
+        connected = await host.poller.run(
+            "connect", host.connect, self.username, self.password, timeout=120
+        )
+        self.show_hosts()
+        if connected:
+            await self.refresh_host(host)
+
+    def action_refresh_hosts(self):
+        for host in self.hosts.values():
+            if host.api is not None:
+                self.run_worker(self.refresh_host(host), group="refresh")
+
+    async def refresh_host(self, host: Host):
+        started = time.perf_counter()
+        rows = await host.poller.run("rows", host.fetch_rows)
+        if rows is None:
+            # Skipped while the last refresh is still running, or it failed
+            host.status = "slow" if host.poller.busy("rows") else "not responding"
+            self.show_hosts()
+            return
+        host.status = "online"
+        logging.info(
+            f"{host.address}: {len(rows)} machines in "
+            f"{time.perf_counter() - started:.2f}s"
+        )
+        self.show_rows(host, rows)
+        self.show_hosts()
+
+    def show_rows(self, host: Host, rows: list[FleetRow]):
+        try:
+            table = self.query_exactly_one("#fleet", DataTable)
+        except NoMatches:
+            return
+        shown = self._rows[host.address]
+        current = set()
+        for row in rows:
+            key = f"{row.host}/{row.machine_id}"
+            cells = {
+                "Host": row.host,
+                "Name": row.name,
+                "State": MachineHealth(row.health).name,
+                "OS": row.os_type_id,
+                "CPUs": row.cpu_count,
+                "Memory (MB)": row.memory_size,
+            }
+            if key in shown:
+                for column, value in cells.items():
+                    if table.get_cell(key, column) != value:
+                        table.update_cell(key, column, value)
+            else:
+                table.add_row(*cells.values(), key=key)
+            current.add(key)
+        for key in shown - current:
+            table.remove_row(key)
+        self._rows[host.address] = current
+        if self.sort_column is not None:
+            table.sort(self.sort_column, reverse=self.sort_reverse)
+
+    def show_hosts(self):
+        parts = []
+        for address, host in self.hosts.items():
+            if host.status == "online":
+                parts.append(f"{address} online ({len(self._rows[address])})")
+            else:
+                parts.append(f"{address} {host.status}")
+        try:
+            self.query_exactly_one("#fleet-hosts", Static).update(" | ".join(parts))
+        except NoMatches:
+            return
+        machines = sum(len(keys) for keys in self._rows.values())
+        online = sum(host.status == "online" for host in self.hosts.values())
+        self.sub_title = f"{machines} machines on {online}/{len(self.hosts)} hosts"
+
+    @on(DataTable.HeaderSelected, "#fleet")
+    def sort_rows(self, event: DataTable.HeaderSelected):
+        column = str(event.column_key.value)
+        if column == self.sort_column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_column, self.sort_reverse = column, False
+        event.data_table.sort(column, reverse=self.sort_reverse)
+
+    @on(DataTable.RowSelected, "#fleet")
+    def open_host(self, event: DataTable.RowSelected):
+        address, _, _ = str(event.row_key.value).partition("/")
+        host = self.hosts[address]
+        if host.api is None:
+            return
+        self.app.push_screen(VMList(host.api, self.store, self.job_limit))
+
+    def on_unmount(self):
+        for host in self.hosts.values():
+            host.close()
@@ -1,16 +1,31 @@
-import asyncio
 import logging
-import time
 from textual import on, work
 from textual.css.query import NoMatches, TooManyMatches, WrongType
 
 from vboxui.snapshots import ListSnapshots, TakeSnapshot
-from .models import Metric
+from .cache import MachineCache, SnapshotIndex
+from .jobs import Job, JobCancelled, JobQueue, progress_for
+from .metrics import (
+    METRIC_ATTRIBUTES,
+    MetricHistory,
+    metric_histories,
+    setup_metrics,
+)
+from .models import (
+    MachineDetails,
+    MachineStatus,
+    Metric,
+    MetricSamples,
+    SnapshotInfo,
+)
+from .polling import Poller
+from .profile import PROFILER
 
 from textual.app import ComposeResult
 from textual.containers import Container, Horizontal, Vertical
+from textual.message import Message
 from textual.reactive import reactive
-from textual.widgets import Button, Markdown, ProgressBar, Rule
+from textual.widgets import Button, Markdown, ProgressBar, Rule, Sparkline
 from vbox_api.api import VBoxAPI
 from vbox_api.models.machine import Machine, MachineHealth
 
@@ -31,11 +46,14 @@ class MetricDisplay(Container):
 	}
 	"""
 
-    metric = reactive(Metric(0, 1, "Unknown"))
+    metric = reactive(Metric(0, 1, "Unknown"), always_update=True)
 
-    def __init__(self, name: str, metric: Metric, *args, **kwargs):
+    def __init__(
+        self, name: str, metric: Metric, history: MetricHistory, *args, **kwargs
+    ):
         super().__init__(*args, **kwargs)
 
+        self.history = history
         self.metric = metric
         self.metric_name = name
 
@@ -50,18 +68,22 @@ class MetricDisplay(Container):
         elif isinstance(value, ProgressBar):
             value.update(progress=metric.value, total=metric.scale)
 
+        self.query_exactly_one(Sparkline).data = self.history.values()
+
     def compose(self) -> ComposeResult:
         with Vertical():
             yield Markdown(self.metric_name)
-            if self.metric.scale == 1:
-                yield Markdown(
-                    f"**{self.metric.value} {self.metric.unit}**",
-                    classes="metric-value",
-                )
-            else:
-                yield ProgressBar(
-                    self.metric.scale, show_eta=False, classes="metric-value"
-                )
+            with Horizontal():
+                if self.metric.scale == 1:
+                    yield Markdown(
+                        f"**{self.metric.value} {self.metric.unit}**",
+                        classes="metric-value",
+                    )
+                else:
+                    yield ProgressBar(
+                        self.metric.scale, show_eta=False, classes="metric-value"
+                    )
+                yield Sparkline(self.history.values())
 
 
 class VM(Container):
@@ -102,45 +124,76 @@ class VM(Container):
 		width: 1fr;
 	}
 
+	MetricDisplay Sparkline {
+		width: 1fr;
+		margin: 0 1;
+	}
+
 	Rule {
 		padding: 0;
 	}
 
 	"""
 
-    metric_cpu_user_load = reactive(Metric(0.0, 100, "%"))
-    metric_cpu_kernel_load = reactive(Metric(0.0, 100, "%"))
-    metric_mem_usage = reactive(Metric(0, 100, "kB"))
-    metric_disk_used = reactive(Metric(0, 1, "MB"))
-    metric_network_rx = reactive(Metric(0.0, 1, "B/s"))
-    metric_network_tx = reactive(Metric(0.0, 1, "B/s"))
+    metric_cpu_user_load = reactive(Metric(0.0, 100, "%"), always_update=True)
+    metric_cpu_kernel_load = reactive(Metric(0.0, 100, "%"), always_update=True)
+    metric_mem_usage = reactive(Metric(0, 100, "kB"), always_update=True)
+    metric_disk_used = reactive(Metric(0, 1, "MB"), always_update=True)
+    metric_network_rx = reactive(Metric(0.0, 1, "B/s"), always_update=True)
+    metric_network_tx = reactive(Metric(0.0, 1, "B/s"), always_update=True)
 
     vbox_name = reactive("")
     vbox_cpu_count = reactive(0)
     vbox_memory = reactive(0)
     vbox_health = reactive(MachineHealth.ERROR)
 
-    def __init__(self, machine: Machine, api: VBoxAPI, *args, **kwargs):
+    class MetricsUpdated(Message, bubble=False):
+        def __init__(self, metrics: dict[str, MetricSamples]):
+            super().__init__()
+            self.metrics = metrics
+
+    class StatusUpdated(Message, bubble=False):
+        def __init__(self, status: MachineStatus):
+            super().__init__()
+            self.status = status
+
+    def __init__(
+        self,
+        machine: Machine,
+        details: MachineDetails,
+        api: VBoxAPI,
+        poller: Poller,
+        cache: MachineCache,
+        jobs: JobQueue,
+        snapshots: SnapshotIndex,
+        history: dict[str, MetricHistory] | None = None,
+        *args,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
 
         self._vbox = machine
         self._api = api
-        self.set_reactive(self.__class__.vbox_name, machine.name)
-        self.vbox_os: str = machine.os_type_id
-        self.set_reactive(self.__class__.vbox_cpu_count, machine.cpu_count)
-        self.set_reactive(self.__class__.vbox_memory, machine.memory_size)
-        self.set_reactive(
-            self.__class__.vbox_health, machine.health  # pyright: ignore [reportArgumentType]
-        )  
-        self.vbox_networks = machine.network_adapters
-        self.vbox_drives = []
-
-        self._latest_state = machine.get_last_state_change_dt()
-        self.set_interval(2, self.poll_status)
-
-        for attachment in machine.mediums:
-            if attachment.type == "HardDisk":
-                self.vbox_drives.append(attachment)
+        self._poller = poller
+        self._cache = cache
+        self._jobs = jobs
+        self._snapshots = snapshots
+        self.machine_id: str = details.id
+        # Kept by the VM list, which collects every machine's metrics in the background
+        self.history = metric_histories() if history is None else history
+        self.set_reactive(self.__class__.vbox_name, details.name)
+        self.vbox_os: str = details.os_type_id
+        self.set_reactive(self.__class__.vbox_cpu_count, details.cpu_count)
+        self.set_reactive(self.__class__.vbox_memory, details.memory_size)
+        self.set_reactive(self.__class__.vbox_health, details.health)
+        self.vbox_networks = details.networks
+        self.vbox_drives = details.drives
+
+        self.latest_state = details.last_state_change
+
+    @property
+    def machine(self) -> Machine:
+        return self._vbox
 
     def compose(self) -> ComposeResult:
         with Horizontal(classes="instance"):
@@ -188,30 +241,38 @@ class VM(Container):
                         yield MetricDisplay(
                             "User CPU Usage",
                             self.metric_cpu_user_load,
+                            self.history["CPU/Load/User"],
                             id="cpu-user-metric",
                         )
                         yield MetricDisplay(
                             "Kernel CPU Usage",
                             self.metric_cpu_kernel_load,
+                            self.history["CPU/Load/Kernel"],
                             id="cpu-kernel-metric",
                         )
                         yield MetricDisplay(
                             "RAM Usage (Guest Additions Required)",
                             self.metric_mem_usage,
+                            self.history["CPU/Usage/Used"],
                             id="mem-metric",
                         )
                     with Vertical():
                         yield MetricDisplay(
-                            "Disk Usage", self.metric_disk_used, id="disk-metric"
+                            "Disk Usage",
+                            self.metric_disk_used,
+                            self.history["Disk/Usage/Used"],
+                            id="disk-metric",
                         )
                         yield MetricDisplay(
                             "Network Rx Usage",
                             self.metric_network_rx,
+                            self.history["Net/Rate/Rx"],
                             id="net-rx-metric",
                         )
                         yield MetricDisplay(
                             "Network Tx Usage",
                             self.metric_network_tx,
+                            self.history["Net/Rate/Tx"],
                             id="net-tx-metric",
                         )
 
@@ -219,21 +280,37 @@ class VM(Container):
     @work()
     async def revert_snapshot(self):
         logging.info("Opening list")
-        selected = await self.app.push_screen_wait(ListSnapshots(self._vbox))
+        selected: SnapshotInfo | None = await self.app.push_screen_wait(
+            ListSnapshots(self._vbox, self.machine_id, self._snapshots)
+        )
         if selected:
-            with self._vbox.with_lock() as mut_machine:
-                mut_machine.restore_snapshot(selected)
-                for i in range(20):
-                    if mut_machine.health != MachineHealth.WARNING:
-                        break
-                    await asyncio.sleep(0.5)
-                else:
-                    raise TimeoutError("Unable to take snapshot")
+            self._cache.invalidate(self._vbox)
+            job = self._jobs.submit(
+                f"Restore {selected.name} on {self.vbox_name}",
+                str(self._vbox.handle),
+                self.restore_snapshot,
+                selected.id,
+            )
+            try:
+                await self._jobs.wait(job)
+            except JobCancelled:
+                pass
+            except Exception as e:
+                self.notify(str(e), title="Restore failed", severity="error")
+            self._cache.invalidate(self._vbox)
+
+    def restore_snapshot(self, job: Job, snapshot_id: str):
+        # Runs on a job thread, holding the lock until VirtualBox has finished
+        snapshot = self._vbox.find_snapshot(snapshot_id)
+        with self._vbox.with_lock() as mut_machine:
+            progress = mut_machine.restore_snapshot(snapshot)
+            job.follow(progress_for(mut_machine, progress))
 
     @on(Button.Pressed, "#start-btn")
     def start_vm(self):
         logging.info("Starting VM")
         self._vbox.start()
+        self._cache.invalidate(self._vbox)
         self.query("#start-btn").only_one(Button).disabled = True
         self.query("#stop-btn").only_one(Button).disabled = False
         self.query("#delete-btn").only_one(Button).disabled = True
@@ -242,6 +319,7 @@ class VM(Container):
     def stop_vm(self):
         logging.info("Stopping VM")
         self._vbox.stop()
+        self._cache.invalidate(self._vbox)
         self.query("#start-btn").only_one(Button).disabled = False
         self.query("#stop-btn").only_one(Button).disabled = True
         self.query("#delete-btn").only_one(Button).disabled = False
@@ -249,6 +327,7 @@ class VM(Container):
     @on(Button.Pressed, "#delete-btn")
     def delete_vm(self):
         self._vbox.delete()
+        self._cache.invalidate(self._vbox)
         self.parent.parent.parent.parent.vms.remove(  # pyright: ignore [reportOptionalMemberAccess, reportAttributeAccessIssue]
             self._vbox
         )  
@@ -259,32 +338,47 @@ class VM(Container):
     @on(Button.Pressed, "#take-snap-btn")
     @work()
     async def open_snap(self):
-        await self.app.push_screen_wait(TakeSnapshot(self._vbox))
-
-    def poll_status(self):
-        # Repeatedly poll VM status and update state when changes are found
-        latest_state = self._vbox.get_last_state_change_dt()
-
-        if latest_state > self._latest_state:
-            self._latest_state = latest_state
-            self.vbox_name = self._vbox.name
-            self.vbox_cpu_count = self._vbox.cpu_count
-
-            if (
-                self.vbox_health != MachineHealth.RUNNING
-                and self._vbox.health == MachineHealth.RUNNING
-            ):
-                logging.info("Identified new status")
-                logging.info(
-                    f"{self._api.performance_collector.setup_metrics(None, self._vbox, 2, 1)}"
-                )
-                logging.info(
-                    f"{self._api.performance_collector.enable_metrics(None, self._vbox)}"
+        await self.app.push_screen_wait(TakeSnapshot(self._vbox, self._jobs))
+        self._cache.invalidate(self._vbox)
+
+    def fetch_status(self, since, health) -> MachineStatus | None:
+        # Called from the VMList status poller on a worker thread, so no widget access
+        details = self._cache.validate(self._vbox)
+        if details.last_state_change <= since:
+            return None
+
+        status = MachineStatus(
+            details.last_state_change,
+            details.name,
+            details.cpu_count,
+            details.health,
+            details.memory_size,
+        )
+        if health != MachineHealth.RUNNING and status.health == MachineHealth.RUNNING:
+            logging.info("Identified new status")
+            setup_metrics(self._api, self._api.performance_collector, [self._vbox])
+        return status
+
+    def on_vm_status_updated(self, message: StatusUpdated):
+        status = message.status
+        self.latest_state = status.changed
+        self.vbox_name = status.name
+        self.vbox_cpu_count = status.cpu_count
+        self.vbox_health = status.health
+        self.vbox_memory = status.memory_size
+
+    def on_vm_metrics_updated(self, message: MetricsUpdated):
+        with PROFILER.span("metrics_updated"):
+            for name, samples in message.metrics.items():
+                if name not in METRIC_ATTRIBUTES or not samples.values:
+                    continue
+                # Setting these values will also automatically update the display
+                setattr(
+                    self,
+                    METRIC_ATTRIBUTES[name],
+                    Metric(samples.values[-1], samples.scale, samples.unit),
                 )
 
-            self.vbox_health = self._vbox.health
-            self.vbox_memory = self._vbox.memory_size
-
     def watch_vbox_name(self, name: str):
         self.query_exactly_one("#vbox-name", Markdown).update(f"**Name:** {name}")
 
@@ -368,7 +462,7 @@ class VM(Container):
 
     def watch_metric_network_tx(self, metric: Metric):
         try:
-            m_display: MetricDisplay = self.query("#net-rx-metric").only_one(
+            m_display: MetricDisplay = self.query("#net-tx-metric").only_one(
                 MetricDisplay
             )
             m_display.metric = metric
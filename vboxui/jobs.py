@@ -0,0 +1,231 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+from vbox_api.models import Machine, Progress
+
+from .refs import REFS, subsystem
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def progress_for(machine: Machine, result) -> Progress:
+    # Methods with several out parameters return the raw response, which holds the
+    # progress as a handle instead of a model
+    if isinstance(result, Progress):
+        return result
+    return machine.ctx.get_progress(result["returnval"])
+
+
+def follow_progress(
+    progress: Progress,
+    on_percent: Callable[[int], None],
+    cancelled: threading.Event,
+    interval_ms: int = 500,
+) -> bool:
+    # wait_for_completion blocks on the server, so this long-polls rather than
+    # sleeping, and there is no limit on how long the operation may take.
+    # Returns False if the operation was cancelled.
+    percent = -1
+    while not progress.completed:
+        if cancelled.is_set() and progress.cancelable:
+            progress.cancel()
+        progress.wait_for_completion(interval_ms)
+        if progress.percent != percent:
+            percent = progress.percent
+            on_percent(percent)
+
+    if progress.canceled:
+        return False
+    if progress.result_code != 0:
+        raise RuntimeError(progress.error_info.text)
+    return True
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(
+        self, queue: "JobQueue", title: str, key: str, func, args, bulk: bool = False
+    ):
+        self.id = next(self._ids)
+        self.title = title
+        self.key = key
+        self.bulk = bulk
+        self.status = "queued"
+        self.stage = ""
+        self.percent = 0
+        self.error: str | None = None
+        self.submitted = time.monotonic()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.future: Future = Future()
+        self.cancelled = threading.Event()
+        self._queue = queue
+        self._func = func
+        self._args = args
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    def follow(self, progress: Progress):
+        # Called by the job function for each IProgress it starts
+        completed = follow_progress(progress, self._set_percent, self.cancelled)
+        if not completed:
+            raise JobCancelled(self.title)
+
+    def set_stage(self, stage: str):
+        # For jobs made of several steps, shown next to the status while running
+        self.stage = stage
+        self.percent = 0
+        self._queue.changed(self)
+
+    def cancel(self):
+        self.cancelled.set()
+        self._queue.cancel(self)
+
+    def _set_percent(self, percent: int):
+        self.percent = percent
+        self._queue.changed(self)
+
+
+# Runs long VirtualBox operations on a small pool of threads, one queue per host.
+# Jobs for the same machine run one after another in submission order, jobs for
+# different machines run in parallel up to the host limit. Bulk runs limit their
+# own parallelism, so their jobs go to a separate, larger pool and neither holds
+# up the other.
+class JobQueue:
+
+    def __init__(
+        self,
+        host_limit: int = 3,
+        on_change: Callable[[Job], None] | None = None,
+        keep_finished: int = 20,
+        bulk_limit: int = 64,
+    ):
+        self.host_limit = host_limit
+        self.bulk_limit = bulk_limit
+        self.on_change = on_change
+        self.keep_finished = keep_finished
+        self.jobs: dict[int, Job] = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=host_limit, thread_name_prefix="vboxui-job"
+        )
+        self._bulk_executor = ThreadPoolExecutor(
+            max_workers=bulk_limit, thread_name_prefix="vboxui-bulk"
+        )
+        self._pending: dict[str, deque[Job]] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, title: str, key: str, func: Callable[..., Any], *args, bulk: bool = False
+    ) -> Job:
+        # func is called on a job thread as func(job, *args)
+        job = Job(self, title, key, func, args, bulk)
+        with self._lock:
+            self.jobs[job.id] = job
+            waiting = self._pending.setdefault(key, deque())
+            waiting.append(job)
+            if len(waiting) == 1:
+                self._start(job)
+        self.changed(job)
+        return job
+
+    async def wait(self, job: Job):
+        return await asyncio.wrap_future(job.future)
+
+    def cancel(self, job: Job):
+        with self._lock:
+            waiting = self._pending.get(job.key)
+            # Jobs still waiting behind another are dropped, running ones see the flag
+            if job.status != "queued" or not waiting or waiting[0] is job:
+                return
+            waiting.remove(job)
+        self._finish(job, "cancelled", exception=JobCancelled(job.title))
+
+    def changed(self, job: Job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def busy(self, key: str) -> bool:
+        return bool(self._pending.get(key))
+
+    def close(self):
+        for job in list(self.jobs.values()):
+            job.cancelled.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._bulk_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start(self, job: Job):
+        executor = self._bulk_executor if job.bulk else self._executor
+        executor.submit(self._run, job)
+
+    def _run(self, job: Job):
+        result = exception = None
+        if job.cancelled.is_set():
+            status, exception = "cancelled", JobCancelled(job.title)
+        else:
+            job.status = "running"
+            job.started = time.monotonic()
+            self.changed(job)
+            logging.info(f"Job {job.id} started: {job.title}")
+            scope = f"job:{job.id}"
+            try:
+                with subsystem(scope):
+                    result = job._func(job, *job._args)
+                status = "done"
+                job.percent = 100
+            except JobCancelled as e:
+                status, exception = "cancelled", e
+            except Exception as e:
+                logging.exception(f"Job {job.id} failed: {job.title}")
+                status, exception = "failed", e
+                job.error = str(e)
+            # Sessions and progress objects are done with, but anything the job
+            # hands back, such as a created machine, is still in use
+            if result is None:
+                REFS.release(scope)
+
+        # Hand the machine to its next job before anyone waiting on this one wakes up
+        self._next(job)
+        self._finish(job, status, result, exception)
+
+    def _next(self, job: Job):
+        with self._lock:
+            waiting = self._pending[job.key]
+            waiting.popleft()
+            if waiting:
+                self._start(waiting[0])
+            else:
+                del self._pending[job.key]
+
+    def _finish(self, job: Job, status: str, result=None, exception=None):
+        job.status = status
+        job.finished = time.monotonic()
+        if job.started is not None:
+            logging.info(f"Job {job.id} {status} after {job.elapsed():.1f}s")
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+        self._trim()
+        self.changed(job)
+
+    def _trim(self):
+        with self._lock:
+            finished = [j for j in self.jobs.values() if j.done]
+            for job in finished[: max(0, len(finished) - self.keep_finished)]:
+                del self.jobs[job.id]
@@ -4,10 +4,12 @@ from textual.containers import Horizontal, Vertical, Container
 from textual.logging import TextualHandler
 from textual.widgets import Header, Input, Label, Static, Button
 
-from .api import build_api
+from .api import ConnectionFailed, build_api, wait_for_endpoint
 
+import asyncio
 from getpass import getuser
 import logging
+from typing import Any, Callable
 
 
 class Login(Screen):
@@ -57,6 +59,20 @@ class Login(Screen):
     }
     """
 
+    def __init__(
+        self,
+        connect: Callable[[str, str], Any] = build_api,
+        endpoint: tuple[str, int] | None = None,
+        *args,
+        **kwargs,
+    ):
+        # connect is given the username and password on a worker thread, the screen
+        # dismisses with whatever it returns. With an endpoint, logging in waits
+        # until vboxwebsrv answers there.
+        super().__init__(*args, **kwargs)
+        self.connect = connect
+        self.endpoint = endpoint
+
     def compose(self) -> ComposeResult:
         yield Header()
         with Container(id="Main"):
@@ -81,8 +97,26 @@ class Login(Screen):
         self.title = "VirtualBox Login"
         self.sub_title = f"Default User - {getuser()}"
         self.query_exactly_one("#password").focus()
+        if self.endpoint is not None:
+            self.query_exactly_one("#login", Button).disabled = True
+            self.sub_title = f"Waiting for vboxwebsrv at {self.endpoint[0]}"
+            self.run_worker(self.wait_for_server(*self.endpoint))
+
+    async def wait_for_server(self, host: str, port: int):
+        # Probed while the WSDL is parsed on its own thread
+        try:
+            await wait_for_endpoint(host, port)
+        except ConnectionFailed as e:
+            self.show_error(str(e))  # Logging in still retries, in case it comes up
+        self.sub_title = f"Default User - {getuser()}"
+        self.query_exactly_one("#login", Button).disabled = False
 
-    def on_button_pressed(self, event: Button.Pressed) -> None:
+    def show_error(self, message: str):
+        err = self.query_one(".err", Static)
+        err.styles.visibility = "visible"
+        err.update(f"Error: {message}")
+
+    async def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "login":
             username = self.query_one("#username", Input).value or getuser()
             password = self.query_one("#password", Input)
@@ -94,13 +128,21 @@ class Login(Screen):
                 logging.info(username)
                 logging.info(repr(self.query_one("#username-text").styles))
 
-                err = self.query_one(".err", Static)
-                err.styles.visibility = "visible"
-                err.update("Error: Please enter a password")
+                self.show_error("Please enter a password")
 
             else:
+                event.button.disabled = True
+                try:
+                    connected = await asyncio.to_thread(
+                        self.connect, username, password.value
+                    )
+                except ConnectionFailed as e:
+                    self.show_error(str(e))
+                    return
+                finally:
+                    event.button.disabled = False
                 logging.info("Dismissing")
-                self.dismiss(build_api(username, password.value))  # We don't check if password is wrong yet
+                self.dismiss(connected)
 
         elif event.button.id == "quit":
             logging.warning("Quitting...")
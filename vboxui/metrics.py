@@ -0,0 +1,105 @@
+from array import array
+from collections import defaultdict
+import threading
+
+from vbox_api import VBoxAPI
+from vbox_api.models import Machine
+
+from .models import MetricSamples
+from .refs import REFS, subsystem
+
+METRIC_PERIOD = 2  # Seconds between samples taken by the VirtualBox collector
+HISTORY_SIZE = 60  # Samples kept by the collector, and by each MetricHistory
+
+# VirtualBox metric names, mapped to the VM pane reactive that displays them
+METRIC_ATTRIBUTES = {
+    "CPU/Load/User": "metric_cpu_user_load",
+    "CPU/Load/Kernel": "metric_cpu_kernel_load",
+    "CPU/Usage/Used": "metric_mem_usage",
+    "Disk/Usage/Used": "metric_disk_used",
+    "Net/Rate/Rx": "metric_network_rx",
+    "Net/Rate/Tx": "metric_network_tx",
+}
+
+
+# Fixed-size ring buffer of samples, so memory stays flat however long vboxui runs
+class MetricHistory:
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        self.size = size
+        self.next_sequence: int | None = None
+        self._values = array("d", bytes(8 * size))
+        self._start = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float):
+        self._values[(self._start + self._count) % self.size] = value
+        if self._count < self.size:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self.size
+
+    def extend(self, samples: MetricSamples):
+        # The collector returns its whole window on every query, so only keep the
+        # samples past the last sequence number we stored
+        skip = 0
+        end = samples.sequence + len(samples.values)
+        if self.next_sequence is not None and end >= self.next_sequence:
+            skip = max(0, self.next_sequence - samples.sequence)
+        self.next_sequence = end
+
+        for value in samples.values[skip:]:
+            self.append(value)
+
+    def values(self) -> list[float]:
+        # Oldest sample first
+        return [
+            self._values[(self._start + i) % self.size] for i in range(self._count)
+        ]
+
+
+def metric_histories() -> dict[str, MetricHistory]:
+    # One ring buffer per displayed metric of a machine
+    return {name: MetricHistory() for name in METRIC_ATTRIBUTES}
+
+
+def split_metrics(raw_metrics) -> dict[str, dict[str, MetricSamples]]:
+    # A single query_metrics_data call returns rows for every requested object,
+    # so group them by the handle of the machine they belong to. Each row points
+    # at a slice of the flat data array holding that metric's sample window.
+    by_machine: dict[str, dict[str, MetricSamples]] = defaultdict(dict)
+    data = raw_metrics["returnval"]
+    for name, obj, unit, scale, sequence, index, length in zip(
+        raw_metrics["returnMetricNames"],
+        raw_metrics["returnObjects"],
+        raw_metrics["returnUnits"],
+        raw_metrics["returnScales"],
+        raw_metrics["returnSequenceNumbers"],
+        raw_metrics["returnDataIndices"],
+        raw_metrics["returnDataLengths"],
+    ):
+        by_machine[str(obj)][name] = MetricSamples(
+            data[index : index + length], scale, unit, sequence
+        )
+    return by_machine
+
+
+def setup_metrics(api: VBoxAPI, collector, machines: list[Machine]):
+    # Both calls hand back an IPerformanceMetric reference per metric and machine,
+    # which nothing reads. The raw interface skips a getInterfaceName round trip
+    # for each of them, and they are released straight away instead of staying
+    # on the server for as long as the session lasts.
+    handles = [vm.handle for vm in machines]
+    interface = api.interface.get_interface("PerformanceCollector")
+    scope = f"metrics:{threading.get_ident()}"
+    with subsystem(scope):
+        interface.setup_metrics(  # pyright: ignore [reportAttributeAccessIssue]
+            collector.handle, None, handles, METRIC_PERIOD, HISTORY_SIZE
+        )
+        interface.enable_metrics(  # pyright: ignore [reportAttributeAccessIssue]
+            collector.handle, None, handles
+        )
+    REFS.release(scope)
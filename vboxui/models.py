@@ -1,3 +1,22 @@
 from collections import namedtuple
 
 Metric = namedtuple("Metric", "value scale unit")
+MetricSamples = namedtuple("MetricSamples", "values scale unit sequence")
+MachineStatus = namedtuple(
+    "MachineStatus", "changed name cpu_count health memory_size"
+)
+MachineDetails = namedtuple(
+    "MachineDetails",
+    "id name os_type_id cpu_count memory_size health networks drives last_state_change",
+)
+MachineEvent = namedtuple("MachineEvent", "kind machine_id")
+SnapshotInfo = namedtuple(
+    "SnapshotInfo", "id name description online parent_id time_stamp children_count"
+)
+Template = namedtuple(
+    "Template",
+    "name_pattern count cpu_count memory_size disk_size iso parent_dir base_disk",
+)
+FleetRow = namedtuple(
+    "FleetRow", "host machine_id name health os_type_id cpu_count memory_size"
+)
@@ -0,0 +1,49 @@
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from .refs import SUBSYSTEM
+
+
+# Runs blocking SOAP calls on a bounded thread pool, away from the Textual event loop
+class Poller:
+
+    def __init__(self, workers: int = 4, timeout: float = 10):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vboxui-poll"
+        )
+        self._in_flight: set[str] = set()
+
+    def busy(self, key: str) -> bool:
+        return key in self._in_flight
+
+    async def run(
+        self, key: str, func: Callable, *args, timeout: float | None = None
+    ) -> Any:
+        # Only one call per key may be outstanding, so a slow server costs skipped
+        # ticks rather than an ever growing queue of threads
+        if key in self._in_flight:
+            logging.info(f"Skipping {key}, previous call still running")
+            return None
+
+        self._in_flight.add(key)
+        # References the call receives are counted against the key's prefix
+        context = contextvars.copy_context()
+        context.run(SUBSYSTEM.set, key.split(":")[0])
+        future = self._executor.submit(context.run, func, *args)
+        future.add_done_callback(lambda _: self._in_flight.discard(key))
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except TimeoutError:
+            logging.warning(f"{key} timed out after {timeout}s")
+        except Exception:
+            logging.exception(f"{key} failed")
+        return None
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
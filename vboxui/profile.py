@@ -0,0 +1,148 @@
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from textual.widgets import DataTable
+
+from .refs import SUBSYSTEM
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[round(q * (len(ordered) - 1))]
+
+
+# Rolling timings per kind of work and subsystem: SOAP calls grouped by the subsystem
+# that made them, and UI work such as frames, event loop lag and metric handling.
+# With a trace path every sample is also kept as a Chrome trace event, which loads
+# in chrome://tracing, Perfetto or speedscope.
+class Profiler:
+
+    def __init__(self, samples: int = 1000, trace_limit: int = 500_000):
+        self.samples = samples
+        self.trace_path: str | None = None
+        self._stats: dict[tuple[str, str], deque[tuple[float, int]]] = {}
+        self._counts: dict[tuple[str, str], int] = {}
+        self._events: deque[dict] = deque(maxlen=trace_limit)
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        kind: str,
+        name: str,
+        started: float,
+        duration: float,
+        size: int = 0,
+        group: str | None = None,
+    ):
+        # "snapshots:<id>" and "create:12" are grouped as "snapshots" and "create", other
+        # jobs all count as "job"
+        group = group or SUBSYSTEM.get().split(":")[0]
+        key = kind, group
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = deque(maxlen=self.samples)
+                self._counts[key] = 0
+            self._stats[key].append((duration, size))
+            self._counts[key] += 1
+            if self.trace_path is not None:
+                self._events.append(
+                    {
+                        "name": name,
+                        "cat": f"{kind},{group}",
+                        "ph": "X",
+                        "ts": (started - self._started) * 1_000_000,
+                        "dur": duration * 1_000_000,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {"subsystem": SUBSYSTEM.get(), "bytes": size},
+                    }
+                )
+
+    @contextmanager
+    def span(self, name: str, kind: str = "ui"):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, started, time.perf_counter() - started, group=name)
+
+    def summary(self) -> list[tuple[str, str, int, float, float, float]]:
+        # Kind, group, total count, p50 and p99 seconds and mean size of each group
+        rows = []
+        with self._lock:
+            stats = {key: list(samples) for key, samples in self._stats.items()}
+            counts = dict(self._counts)
+        for (kind, group), samples in sorted(stats.items()):
+            durations = [duration for duration, _ in samples]
+            rows.append(
+                (
+                    kind,
+                    group,
+                    counts[(kind, group)],
+                    percentile(durations, 0.5),
+                    percentile(durations, 0.99),
+                    sum(size for _, size in samples) / len(samples),
+                )
+            )
+        return rows
+
+    def write_trace(self, path: str | None = None):
+        path = path or self.trace_path
+        if path is None:
+            return
+        with self._lock:
+            events = list(self._events)
+        names = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": {"name": thread.name},
+            }
+            for thread in threading.enumerate()
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, f)
+
+
+PROFILER = Profiler()
+
+
+class ProfilePanel(DataTable):
+    DEFAULT_CSS = """
+	ProfilePanel {
+	  dock: right;
+	  layer: overlay;
+	  width: 72;
+	  height: 100%;
+	  border: round $accent;
+	  background: $surface;
+	}
+	"""
+
+    def on_mount(self):
+        self.border_title = "Profile"
+        for column in ("Kind", "Subsystem", "Count", "p50 ms", "p99 ms", "Avg KB"):
+            self.add_column(column, key=column)
+        self.show_summary()
+        self.set_interval(1, self.show_summary)
+
+    def show_summary(self):
+        self.clear()
+        for kind, group, count, p50, p99, size in PROFILER.summary():
+            self.add_row(
+                kind,
+                group,
+                count,
+                f"{p50 * 1000:.1f}",
+                f"{p99 * 1000:.1f}",
+                f"{size / 1024:.1f}" if size else "",
+            )
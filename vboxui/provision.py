@@ -0,0 +1,360 @@
+import asyncio
+from getpass import getuser
+import json
+import logging
+import os
+import time
+import tomllib
+from typing import Literal
+
+from textual import on, work
+from textual.app import ComposeResult
+from textual.containers import Horizontal, Vertical
+from textual.screen import ModalScreen
+from textual.widgets import Button, DataTable, Input, Markdown, ProgressBar, Static
+from textual_fspicker import FileOpen
+from vbox_api import VBoxAPI
+from vbox_api.constants import AccessMode, MediumDeviceType
+from vbox_api.models import Machine, Medium
+
+from .create import provision_machine, roll_back
+from .jobs import Job, JobQueue
+from .models import Template
+from .registry import Registry
+
+DEFAULT_TEMPLATE = Template(
+    "worker-{n:02}", 1, 1, 1024, 4096, "", f"/home/{getuser()}/VirtualBox VMs", ""
+)
+
+
+def load_template(path: str) -> Template:
+    # TOML or JSON, with the same keys either way:
+    #   name = "worker-{n:02}"  count = 20  cpus = 2  memory = 2048  disk = 8192
+    #   iso = "/isos/debian.iso"  directory = "/vms"  base_disk = "/vms/golden.vdi"
+    with open(path, "rb") as f:
+        data = json.load(f) if path.endswith(".json") else tomllib.load(f)
+    return Template(
+        data.get("name", DEFAULT_TEMPLATE.name_pattern),
+        int(data.get("count", DEFAULT_TEMPLATE.count)),
+        int(data.get("cpus", DEFAULT_TEMPLATE.cpu_count)),
+        int(data.get("memory", DEFAULT_TEMPLATE.memory_size)),
+        int(data.get("disk", DEFAULT_TEMPLATE.disk_size)),
+        data.get("iso", DEFAULT_TEMPLATE.iso),
+        data.get("directory", DEFAULT_TEMPLATE.parent_dir),
+        data.get("base_disk", DEFAULT_TEMPLATE.base_disk),
+    )
+
+
+def machine_names(template: Template) -> list[str]:
+    # Empty if the pattern has other placeholders or a format {n} can't take
+    try:
+        return [
+            template.name_pattern.format(n=n) for n in range(1, template.count + 1)
+        ]
+    except (ValueError, KeyError, IndexError, AttributeError, TypeError):
+        return []
+
+
+def prepare_batch(job: Job, api: VBoxAPI, registry: Registry, template: Template):
+    # Runs on a job thread before any machine is made. Only the base disk is ever
+    # allocated in full, every machine gets a differencing image on top of it. One
+    # made here is removed again if preparing fails.
+    created: dict[str, Medium] = {}
+    try:
+        if template.base_disk:
+            job.set_stage("Opening base disk")
+            base = registry.open_medium(
+                api, template.base_disk, "HardDisk", AccessMode.READ_WRITE
+            )
+        else:
+            job.set_stage("Allocating base disk")
+            base = api.create_medium(
+                "",
+                os.path.join(
+                    template.parent_dir, template.name_pattern.format(n=0) + "-base.vdi"
+                ),
+                AccessMode.READ_WRITE,
+                MediumDeviceType.HARD_DISK,
+            )
+            created["medium"] = base
+            size = ((template.disk_size * 1_000_000) // 512) * 512
+            job.follow(base.create_base_storage(size, ["Standard"]))
+
+        iso = None
+        if template.iso:
+            job.set_stage("Opening ISO")
+            iso = registry.open_medium(
+                api, template.iso, "DVD", AccessMode.READ_ONLY, True
+            )
+    except Exception:
+        job.set_stage("Rolling back")
+        roll_back(created)
+        raise
+    return base, iso
+
+
+def discard_base(job: Job, base: Medium):
+    # A base disk made for a batch that created no machine at all
+    job.set_stage("Removing base disk")
+    roll_back({"medium": base})
+
+
+def provision_clone(
+    job: Job, api: VBoxAPI, template: Template, name: str, base: Medium, iso
+) -> Machine:
+    return provision_machine(
+        job,
+        api,
+        name,
+        template.parent_dir,
+        template.cpu_count,
+        template.memory_size,
+        os.path.join(template.parent_dir, name + ".vdi"),
+        lambda medium: base.create_diff_storage(medium, ["Standard"]),
+        iso,
+    )
+
+
+# Creates many identical machines from a template. Machines are created concurrently
+# as separate jobs, and share one base disk through differencing images, so adding a
+# machine costs a small diff file rather than a full disk allocation.
+class ProvisionModal(ModalScreen[list[Machine]]):
+    DEFAULT_CSS = """
+    ProvisionModal {
+        align: center middle;
+    }
+
+    ProvisionModal > Vertical {
+        width: 80%;
+        height: 95%;
+        border: thick $background 80%;
+        background: $surface;
+        padding: 1 3;
+    }
+
+    Horizontal {
+        height: auto;
+    }
+
+    Horizontal > Static {
+        width: 1fr;
+        padding: 1 0;
+    }
+
+    Horizontal > Input {
+        width: 3fr;
+    }
+
+    #provision-progress {
+        display: none;
+    }
+
+    #provision-results {
+        height: 1fr;
+    }
+
+    #btns > Button {
+        margin: 0 2 0 0;
+    }
+    """
+
+    # Attribute, label and the kind of Input it's edited in
+    FIELDS: list[tuple[str, str, Literal["integer", "text"]]] = [
+        ("name_pattern", "Name Pattern", "text"),
+        ("count", "Machines", "integer"),
+        ("cpu_count", "CPU Cores", "integer"),
+        ("memory_size", "Memory (MB)", "integer"),
+        ("disk_size", "Disk Size (MB)", "integer"),
+        ("iso", "ISO Image", "text"),
+        ("parent_dir", "VM Directory", "text"),
+        ("base_disk", "Base Disk (optional)", "text"),
+    ]
+
+    def __init__(
+        self, api: VBoxAPI, jobs: JobQueue, registry: Registry, *args, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self._api = api
+        self._jobs = jobs
+        self._registry = registry
+        self._machine_jobs: dict[int, Job] = {}
+        self._created: list[Machine] = []
+        self._running = False
+        self._cancelled = False
+
+    def compose(self) -> ComposeResult:
+        with Vertical():
+            yield Markdown("**Provision Machines from a Template**")
+            for field, label, kind in self.FIELDS:
+                with Horizontal():
+                    yield Static(label)
+                    yield Input(
+                        str(getattr(DEFAULT_TEMPLATE, field)),
+                        type=kind,
+                        id="template-" + field,
+                    )
+            yield ProgressBar(show_eta=False, id="provision-progress")
+            yield Static("", id="provision-rate")
+            yield DataTable(cursor_type="row", id="provision-results")
+            with Horizontal(id="btns"):
+                yield Button("Load Template", variant="primary", id="load-btn")
+                yield Button("Provision", variant="success", id="provision-btn")
+                yield Button("Close", variant="error", id="close-btn")
+
+    def on_mount(self):
+        results = self.query_exactly_one("#provision-results", DataTable)
+        for column in ("Machine", "Status", "Error"):
+            results.add_column(column, key=column)
+
+    def show_template(self, template: Template):
+        for field, _, _ in self.FIELDS:
+            self.query_exactly_one("#template-" + field, Input).value = str(
+                getattr(template, field)
+            )
+
+    def read_template(self) -> Template:
+        values = {}
+        for field, _, kind in self.FIELDS:
+            value = self.query_exactly_one("#template-" + field, Input).value
+            values[field] = int(value or 0) if kind == "integer" else value
+        return Template(**values)
+
+    @on(Button.Pressed, "#load-btn")
+    @work()
+    async def load(self, event: Button.Pressed):
+        path = await self.app.push_screen_wait(FileOpen("."))
+        if not path:
+            return
+        try:
+            self.show_template(load_template(str(path)))
+        except (OSError, ValueError, KeyError) as e:
+            self.notify(str(e), title="Unable to load template", severity="error")
+
+    @on(Button.Pressed, "#provision-btn")
+    def provision(self, event: Button.Pressed):
+        template = self.read_template()
+        names = machine_names(template)
+        if template.count < 1 or len(set(names)) < template.count:
+            self.notify(
+                "Name pattern needs a {n} placeholder for the machine number, "
+                "such as worker-{n} or worker-{n:02}",
+                severity="warning",
+            )
+            return
+        if not self._registry.loaded.is_set():
+            # Every name would look free until then
+            self.notify(
+                "Still loading the names of existing machines, try again shortly",
+                severity="warning",
+            )
+            return
+        taken = [name for name in names if self._registry.has_machine(name)]
+        if taken:
+            self.notify(
+                ", ".join(taken[:5]) + (" ..." if len(taken) > 5 else ""),
+                title="Machine names already in use",
+                severity="warning",
+            )
+            return
+        for widget in self.query("Input, #load-btn, #provision-btn"):
+            widget.disabled = True
+        self.run_batch(template)
+
+    @work(exclusive=True)
+    async def run_batch(self, template: Template):
+        names = machine_names(template)
+        results = self.query_exactly_one("#provision-results", DataTable)
+        results.clear()
+        for row, name in enumerate(names):
+            results.add_row(name, "queued", "", key=str(row))
+        progress = self.query_exactly_one("#provision-progress", ProgressBar)
+        progress.update(total=len(names) * 100, progress=0)
+        progress.display = True
+        self._running = True
+        started = time.monotonic()
+        timer = self.set_interval(0.5, lambda: self.show_progress(started))
+
+        try:
+            prepare = self._jobs.submit(
+                f"Prepare {template.name_pattern}",
+                "provision:" + template.name_pattern,
+                prepare_batch,
+                self._api,
+                self._registry,
+                template,
+            )
+            try:
+                base, iso = await self._jobs.wait(prepare)
+            except Exception as e:
+                self.notify(str(e), title="Unable to prepare disks", severity="error")
+                return
+
+            async def create(row: int, name: str):
+                if self._cancelled:
+                    results.update_cell(str(row), "Status", "cancelled")
+                    return
+                job = self._jobs.submit(
+                    f"Create {name}",
+                    "create:" + name,
+                    provision_clone,
+                    self._api,
+                    template,
+                    name,
+                    base,
+                    iso,
+                )
+                self._machine_jobs[row] = job
+                try:
+                    self._created.append(await self._jobs.wait(job))
+                except Exception as e:
+                    results.update_cell(str(row), "Error", str(e))
+                finally:
+                    results.update_cell(str(row), "Status", job.status)
+
+            # The job queue runs these up to the host limit at a time
+            await asyncio.gather(*(create(row, name) for row, name in enumerate(names)))
+            if not self._created and not template.base_disk:
+                self._jobs.submit(
+                    f"Remove {template.name_pattern} base disk",
+                    "provision:" + template.name_pattern,
+                    discard_base,
+                    base,
+                )
+        finally:
+            timer.stop()
+            self._running = False
+            self.show_progress(started)
+            self.query_exactly_one("#close-btn", Button).label = "Done"
+
+        logging.info(
+            f"Provisioned {len(self._created)}/{len(names)} machines in "
+            f"{time.monotonic() - started:.1f}s"
+        )
+
+    def show_progress(self, started: float):
+        results = self.query_exactly_one("#provision-results", DataTable)
+        for row, job in self._machine_jobs.items():
+            if not job.done:
+                status = f"{job.stage} {job.percent}%" if job.stage else job.status
+                results.update_cell(str(row), "Status", status)
+        self.query_exactly_one("#provision-progress", ProgressBar).update(
+            progress=sum(
+                100 if job.done else job.percent for job in self._machine_jobs.values()
+            )
+        )
+        minutes = (time.monotonic() - started) / 60
+        self.query_exactly_one("#provision-rate", Static).update(
+            f"{len(self._created)} created, "
+            f"{len(self._created) / minutes if minutes else 0:.1f} VMs/min"
+        )
+
+    @on(Button.Pressed, "#close-btn")
+    def close_provision(self, event: Button.Pressed):
+        if self._running:
+            # Machines not started yet are skipped, ones being created are rolled back
+            self._cancelled = True
+            for job in self._machine_jobs.values():
+                if not job.done:
+                    job.cancel()
+            return
+        self.dismiss(self._created)
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import re
+import threading
+from typing import Callable
+
+import zeep.exceptions
+
+# Which part of vboxui a SOAP call is made for, set around blocks of work
+SUBSYSTEM: ContextVar[str] = ContextVar("subsystem", default="other")
+
+HANDLE = re.compile(rb"[0-9a-fA-F]{16}-[0-9a-fA-F]{16}")
+
+# The logon's IVirtualBox and the ISession objects live as long as the API or the
+# Machine holding them, not the subsystem that happened to ask for them
+PINNED = {"IWebsessionManager_logon", "IWebsessionManager_getSessionObject"}
+
+
+@contextmanager
+def subsystem(name: str):
+    token = SUBSYSTEM.set(name)
+    try:
+        yield
+    finally:
+        SUBSYSTEM.reset(token)
+
+
+# vboxwebsrv keeps every managed object reference it hands out until it's released
+# or the session ends. The transport records the references in each response
+# against the subsystem that asked for them, so work with a clear end, such as a
+# snapshot walk or a job, can release what only it used once it's done.
+class RefTracker:
+
+    def __init__(self):
+        self.released = 0
+        self._refs: dict[str, tuple[Callable[[str], None], set[str]]] = {}
+        self._pinned: dict[str, Callable[[str], None]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self, content: bytes, release: Callable[[str], None], operation: str = ""
+    ):
+        handles = HANDLE.findall(content)
+        if not handles:
+            return
+        scope = SUBSYSTEM.get()
+        with self._lock:
+            for handle in map(bytes.decode, handles):
+                if operation in PINNED:
+                    self._pinned[handle] = release
+                    self._refs.pop(handle, None)
+                elif handle not in self._pinned:
+                    self._refs.setdefault(handle, (release, set()))[1].add(scope)
+
+    def pin(self, handle: str, release: Callable[[str], None]):
+        # Never released by a scope, such as the IVirtualBox of a login made before
+        # tracking started
+        with self._lock:
+            self._pinned[handle] = release
+            self._refs.pop(handle, None)
+
+    def release(self, scope: str) -> int:
+        # References another subsystem also received are only handed over to it
+        with self._lock:
+            owned = []
+            for handle, (release, scopes) in list(self._refs.items()):
+                if scope not in scopes:
+                    continue
+                scopes.discard(scope)
+                if not scopes:
+                    owned.append((handle, release))
+                    del self._refs[handle]
+
+        for handle, release in owned:
+            try:
+                release(handle)
+            except zeep.exceptions.Fault:
+                pass  # Already gone with its session
+            except Exception:
+                logging.exception(f"Unable to release {handle}")
+        self.released += len(owned)
+        if owned:
+            logging.info(f"Released {len(owned)} references held by {scope}")
+        return len(owned)
+
+    def forget(self, release: Callable[[str], None]):
+        # Everything from a session that's gone, it can't be released any more
+        with self._lock:
+            for handle, (owner, _) in list(self._refs.items()):
+                if owner is release:
+                    del self._refs[handle]
+            for handle, owner in list(self._pinned.items()):
+                if owner is release:
+                    del self._pinned[handle]
+
+    def outstanding(self) -> int:
+        return len(self._refs)
+
+    def report(self) -> dict[str, int]:
+        # Jobs and panes are grouped, "job:12" and "job:13" both count as "job"
+        counts: dict[str, int] = {}
+        with self._lock:
+            for _, scopes in self._refs.values():
+                for group in {scope.split(":")[0] for scope in scopes}:
+                    counts[group] = counts.get(group, 0) + 1
+        return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+REFS = RefTracker()
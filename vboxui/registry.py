@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+
+from vbox_api import VBoxAPI
+from vbox_api.constants import AccessMode
+from vbox_api.models import Machine, Medium
+
+
+def medium_key(path: str) -> str:
+    return os.path.abspath(os.path.expanduser(path))
+
+
+# Names of registered machines and locations of registered mediums, fetched once on a
+# worker thread and then kept current from registration events. Checking whether a
+# name is taken, or whether an ISO is already open, is a dict lookup rather than a
+# SOAP call for every machine or medium on the host.
+class Registry:
+
+    def __init__(self):
+        self.loaded = threading.Event()
+        self._machines: dict[str, tuple[str, str]] = {}  # handle -> (id, name)
+        self._names: dict[str, str] = {}  # name -> id
+        self._mediums: dict[str, Medium] = {}  # location -> medium
+        self._medium_ids: dict[str, str] = {}  # id -> location
+        self._lock = threading.Lock()
+
+    def load(self, api: VBoxAPI, machines: list[Machine]):
+        self.sync(machines)
+        mediums = {}
+        for medium in [*api.dvd_images, *api.hard_disks]:
+            mediums[medium.id] = medium_key(medium.location), medium
+        with self._lock:
+            for medium_id, (location, medium) in mediums.items():
+                self._mediums[location] = medium
+                self._medium_ids[medium_id] = location
+        self.loaded.set()
+        logging.info(
+            f"Registry loaded {len(self._names)} machines, {len(mediums)} mediums"
+        )
+
+    def sync(self, machines: list[Machine]):
+        # Only machines not seen before cost a round trip for their id and name
+        with self._lock:
+            known = dict(self._machines)
+        current = {}
+        for machine in machines:
+            handle = str(machine.handle)
+            current[handle] = known.get(handle) or (machine.id, machine.name)
+        with self._lock:
+            self._machines = current
+            self._names = {name: machine_id for machine_id, name in current.values()}
+
+    def has_machine(self, name: str) -> bool:
+        return name in self._names
+
+    def machine_names(self) -> dict[str, str]:
+        with self._lock:
+            return {handle: entry[1] for handle, entry in self._machines.items()}
+
+    def machine_ids(self) -> dict[str, str]:
+        with self._lock:
+            return {handle: entry[0] for handle, entry in self._machines.items()}
+
+    def rekey(self, handles: dict[str, str]):
+        # Machines moved to new references after logging in again
+        with self._lock:
+            for old, new in handles.items():
+                if old in self._machines:
+                    self._machines[new] = self._machines.pop(old)
+
+    def forget_mediums(self):
+        with self._lock:
+            self._mediums.clear()
+            self._medium_ids.clear()
+
+    def forget_machine(self, machine_id: str):
+        # After a rename, the next sync fetches the new name
+        with self._lock:
+            for handle, (known_id, name) in list(self._machines.items()):
+                if known_id == machine_id:
+                    del self._machines[handle]
+                    self._names.pop(name, None)
+
+    def find_medium(self, path: str) -> Medium | None:
+        return self._mediums.get(medium_key(path))
+
+    def open_medium(
+        self,
+        api: VBoxAPI,
+        path: str,
+        device_type: str,
+        access_mode: AccessMode,
+        force_new_uuid: bool = False,
+    ) -> Medium:
+        # Runs on a worker thread, reusing the medium if it's already registered
+        medium = self.find_medium(path)
+        if medium is not None:
+            logging.info(f"Reusing registered medium {path}")
+            return medium
+        medium = api.open_medium(path, device_type, access_mode, force_new_uuid)
+        with self._lock:
+            self._mediums[medium_key(path)] = medium
+            self._medium_ids[medium.id] = medium_key(path)
+        return medium
+
+    def forget_medium(self, medium_id: str):
+        # An unregistered medium must not be handed out again, a newly registered
+        # one is picked up the first time it's opened
+        with self._lock:
+            location = self._medium_ids.pop(medium_id, None)
+            if location is not None:
+                self._mediums.pop(location, None)
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+import zeep.exceptions
+from vbox_api import VBoxAPI
+from vbox_api.models import Machine
+from vbox_api.models.base import BaseModelRegister
+
+from .registry import Registry
+from .transport import SessionReplaced
+
+
+def stale(error: Exception) -> bool:
+    return isinstance(error, zeep.exceptions.Fault) and (
+        "managed object reference" in str(error).lower()
+    )
+
+
+# vboxwebsrv logs out sessions that stay idle past its timeout (300s by default), and
+# every object reference handed out in a session goes with it. A cheap call each
+# interval keeps the session alive. If it expired anyway, or vboxwebsrv restarted and
+# the transport logged in again, every Machine still held is pointed at a reference
+# and an ISession from the new login, looked up by its UUID, so widgets keep the
+# same objects.
+class SessionManager:
+
+    def __init__(self, api: VBoxAPI, registry: Registry, interval: float = 60):
+        self.api = api
+        self.registry = registry
+        self.interval = interval
+        self.recoveries = 0
+        self.transport = api.interface.interface.transport  # pyright: ignore [reportAttributeAccessIssue]
+        self._reconnects = self.transport.reconnects
+        self._lock = threading.Lock()
+
+    def keepalive(self) -> bool:
+        # Runs on a worker thread, returns True if the references were rebound
+        try:
+            self.api.version
+        except SessionReplaced:
+            pass  # The transport noticed the restart and logged in again
+        except zeep.exceptions.Fault as e:
+            if not stale(e):
+                raise
+            logging.warning("vboxwebsrv session expired, logging in again")
+            self.transport.replay(self.transport.reconnects)
+        if self.transport.reconnects == self._reconnects:
+            return False
+        self.rebind()
+        return True
+
+    def rebind(self):
+        with self._lock:
+            started = time.perf_counter()
+            self._reconnects = self.transport.reconnects
+            machines = BaseModelRegister._handles[Machine]
+            machine_ids = self.registry.machine_ids()
+            handles = {}
+            for handle, machine in list(machines.items()):
+                machine_id = machine_ids.get(str(handle))
+                if machine_id is None:
+                    continue  # Not a registered machine, such as a session's copy
+                try:
+                    fresh = self.api.find_machine(machine_id).handle
+                except zeep.exceptions.Fault:
+                    logging.warning(f"Machine {machine_id} is gone after logging in")
+                    continue
+                machine.handle = fresh
+                # Its ISession went with the old login, locking opens a new one
+                machine.session = self.api.ctx.get_session()
+                del machines[handle]
+                machines[fresh] = machine
+                handles[str(handle)] = str(fresh)
+            self.registry.rekey(handles)
+            self.recoveries += 1
+            logging.info(
+                f"Rebound {len(handles)} machines to the new session in "
+                f"{time.perf_counter() - started:.2f}s"
+            )
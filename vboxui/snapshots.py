@@ -1,15 +1,46 @@
 from datetime import datetime
-import time
+from functools import partial
 
-from textual import on
+import requests.exceptions
+from rich.markup import escape
+
+from textual import on, work
 from textual.app import ComposeResult
 from textual.containers import Horizontal, Vertical
 from textual.screen import ModalScreen
-from textual.widgets import Button, DataTable, Input, Markdown, Static, Switch, TextArea
+from textual.widgets import (
+    Button,
+    Input,
+    Markdown,
+    ProgressBar,
+    Static,
+    Switch,
+    TextArea,
+    Tree,
+)
+from textual.widgets.tree import TreeNode
+from textual.worker import get_current_worker
 from vbox_api.models import Machine
 from vbox_api.models.machine import MachineHealth
 from zeep.exceptions import Fault
 
+from .api import ConnectionFailed
+from .jobs import Job, JobCancelled, JobQueue, progress_for
+from .cache import SnapshotIndex
+from .models import SnapshotInfo
+from .refs import REFS, subsystem
+from .transport import SessionReplaced
+
+
+def snapshot_machine(
+    job: Job, machine: Machine, name: str, description: str, pause: bool
+):
+    # Runs on a job thread. The lock is held until the progress completes,
+    # unlocking while the machine is still snapshotting leaves it stuck.
+    with machine.with_lock() as mut_machine:
+        progress = mut_machine.take_snapshot(name, description, pause)
+        job.follow(progress_for(mut_machine, progress))
+
 
 class TakeSnapshot(ModalScreen):
     DEFAULT_CSS = """
@@ -49,10 +80,17 @@ class TakeSnapshot(ModalScreen):
     #btns > Button {
         margin: 0 2 0 0;
     }
+
+    #snap-progress {
+        display: none;
+    }
     """
 
-    def __init__(self, machine: Machine, *args, **kwargs):
+    def __init__(self, machine: Machine, jobs: JobQueue, *args, **kwargs):
         self._vbox = machine
+        self._jobs = jobs
+        self._job: Job | None = None
+        self._frozen = []
         super().__init__(*args, **kwargs)
 
     def compose(self) -> ComposeResult:
@@ -71,6 +109,7 @@ class TakeSnapshot(ModalScreen):
                     disabled=self._vbox.health != MachineHealth.RUNNING,
                     value=False,
                 )
+            yield ProgressBar(100, show_eta=False, id="snap-progress")
             with Horizontal(id="btns"):
                 yield Button(
                     "Take Snapshot", id="take-btn", disabled=True, variant="success"
@@ -87,22 +126,58 @@ class TakeSnapshot(ModalScreen):
 
     @on(Button.Pressed, "#take-btn")
     def create_snap(self, event: Button.Pressed):
-        with self._vbox.with_lock() as mut_machine:
-            mut_machine.take_snapshot(
-                self.query_exactly_one("#snap-name", Input).value,
-                self.query_exactly_one("#snap-desc", TextArea).text,
-                not self.query_exactly_one("#snap-pause", Switch).value,
-            )
-            for _ in range(20):
-                if mut_machine.health != MachineHealth.WARNING:
-                    break  # Must wait until MachineHealth is not WARNING before unlocking the VM. Learned this the hard way.
-                time.sleep(0.5)
-            else:
-                raise TimeoutError("Unable to take snapshot")
+        inputs = self.query("Input, TextArea, Switch, #take-btn")
+        self._frozen = [w for w in inputs if not w.disabled]
+        for widget in self._frozen:
+            widget.disabled = True
+        self.query_exactly_one("#snap-progress", ProgressBar).display = True
+        name = self.query_exactly_one("#snap-name", Input).value
+        self._job = self._jobs.submit(
+            f"Snapshot {name}",
+            str(self._vbox.handle),
+            snapshot_machine,
+            self._vbox,
+            name,
+            self.query_exactly_one("#snap-desc", TextArea).text,
+            not self.query_exactly_one("#snap-pause", Switch).value,
+        )
+        self.wait_for_snapshot(self._job)
+
+    @work(exclusive=True)
+    async def wait_for_snapshot(self, job: Job):
+        timer = self.set_interval(0.25, self.show_progress)
+        try:
+            await self._jobs.wait(job)
+        except JobCancelled:
+            self.notify(f"{job.title} cancelled")
+        except Exception as e:
+            self.snapshot_failed(str(e))
+            return
+        finally:
+            timer.stop()
         self.dismiss()
 
+    def show_progress(self):
+        if self._job is not None:
+            self.query_exactly_one("#snap-progress", ProgressBar).update(
+                progress=self._job.percent
+            )
+
+    def snapshot_failed(self, error: str):
+        self._job = None
+        self.notify(error, title="Snapshot failed", severity="error")
+        for widget in self._frozen:
+            widget.disabled = False
+        self.query_exactly_one("#cancel-btn", Button).disabled = False
+        self.query_exactly_one("#snap-progress", ProgressBar).display = False
+
     @on(Button.Pressed, "#cancel-btn")
     def cancel_btn(self, event: Button.Pressed):
+        if self._job is not None:
+            # The job cancels the progress, and this closes once VirtualBox stops
+            self._job.cancel()
+            event.button.disabled = True
+            return
         self.dismiss()
 
 
@@ -120,12 +195,16 @@ class ListSnapshots(ModalScreen):
         padding: 3;
     }
 
-    DataTable {
-        height: 40%;
+    Tree {
+        height: 1fr;
     }
 
     Vertical > * {
-        margin: 2 1
+        margin: 1 1
+    }
+
+    Horizontal {
+        height: auto;
     }
 
     Horizontal > Input {
@@ -137,18 +216,26 @@ class ListSnapshots(ModalScreen):
     }
     """
 
-    def __init__(self, machine: Machine, *args, **kwargs):
+    def __init__(
+        self, machine: Machine, machine_id: str, index: SnapshotIndex, *args, **kwargs
+    ):
         self._vbox = machine
-        self._selected_snapshot = None
-        self.snapshots = {}
+        self._machine_id = machine_id
+        self._index = index
+        self._selected_snapshot: SnapshotInfo | None = None
+        self._snapshot_nodes: dict[str, TreeNode] = {}
+        self._indexing = False
+        # The snapshot objects fetched are released when the list closes, the index
+        # only keeps plain SnapshotInfo copies
+        self._scope = f"snapshots:{machine_id}"
         super().__init__(*args, **kwargs)
 
     def compose(self) -> ComposeResult:
         with Vertical():
             yield Static("Select a snapshot to revert to")
-            yield DataTable(
-                fixed_columns=6, cursor_type="row", zebra_stripes=True, id="snapshots"
-            )  # TODO: Will add better selection system later, but this is solid right now
+            yield Input(placeholder="Search by name or date", id="snapshot-search")
+            yield Tree("Snapshots", id="snapshots")
+            yield Static("", id="snapshot-description")
             with Horizontal():
                 yield Input(disabled=True, id="selected-snapshot")
                 yield Button(
@@ -162,43 +249,145 @@ class ListSnapshots(ModalScreen):
 
     @on(Button.Pressed, "#revert-btn")
     def return_snapshot(self, event: Button.Pressed):
-        self.dismiss(self.snapshots[self._selected_snapshot])
+        self.dismiss(self._selected_snapshot)
 
-    @on(DataTable.RowSelected, "#snapshots")
-    def select_snapshot(self, event: DataTable.RowSelected):
-        snap_display = self.query_exactly_one("#selected-snapshot", Input)
-        snap_display.value = event.data_table.get_row_at(event.cursor_row)[0]
+    @on(Tree.NodeHighlighted, "#snapshots")
+    def describe_snapshot(self, event: Tree.NodeHighlighted[SnapshotInfo]):
+        info = event.node.data
+        self.query_exactly_one("#snapshot-description", Static).update(
+            info.description if info is not None else ""
+        )
+
+    @on(Tree.NodeSelected, "#snapshots")
+    def select_snapshot(self, event: Tree.NodeSelected[SnapshotInfo]):
+        info = event.node.data
+        if info is None:
+            return
+        self.query_exactly_one("#selected-snapshot", Input).value = info.id
         self.query_exactly_one("#revert-btn", Button).disabled = False
-        self._selected_snapshot = snap_display.value
+        self._selected_snapshot = info
 
-    @classmethod
-    def flatten_snapshots(cls, snapshot) -> list:
-        current_list = []
-        current_list.append(snapshot)
-        for child in snapshot.children:
-            current_list += cls.flatten_snapshots(child)
-        return current_list
+    @on(Input.Changed, "#snapshot-search")
+    def search_snapshots(self, event: Input.Changed):
+        if not event.value.strip():
+            self.show_tree(self._index.peek(self._machine_id) or {})
+            return
+        self.show_matches(event.value)
+        if not self._indexing:
+            self._indexing = True
+            event.input.border_subtitle = "Searching unopened snapshots..."
+            self.index_remaining()
 
-    def on_mount(self):
-        snapshot_table = self.query_exactly_one("#snapshots", DataTable)
-        snapshot_table.add_columns(
-            "id", "name", "description", "online", "parent", "timestamp"
-        )
+    def show_matches(self, query: str):
+        tree = self.query_exactly_one("#snapshots", Tree)
+        tree.clear()
+        self._snapshot_nodes = {}
+        for info in self._index.search(self._machine_id, query):
+            tree.root.add_leaf(self.label(info), data=info)
+
+    def update_matches(self, done: bool = False):
+        search = self.query_exactly_one("#snapshot-search", Input)
+        if done:
+            self._indexing = False
+            search.border_subtitle = None
+        if search.value.strip():
+            self.show_matches(search.value)
+
+    @work(thread=True, group="snapshot-index")
+    def index_remaining(self):
+        # Only opened levels are indexed, so a search fetches every other one in the
+        # background and its results grow as they arrive
+        worker = get_current_worker()
         try:
-            snapshots = self.flatten_snapshots(self._vbox.find_snapshot(""))
+            with subsystem(self._scope):
+                while remaining := self._index.unfetched(self._machine_id):
+                    for parent_id in remaining:
+                        if worker.is_cancelled:
+                            return
+                        self._index.fetch_level(
+                            self._vbox, self._machine_id, parent_id
+                        )
+                        self.app.call_from_thread(self.update_matches)
         except Fault:
-            return
+            pass
+        except (requests.exceptions.ConnectionError, ConnectionFailed, SessionReplaced):
+            self.app.call_from_thread(
+                self.notify,
+                "Lost the connection to vboxwebsrv, search results are incomplete",
+                severity="error",
+            )
+        if not worker.is_cancelled:
+            self.app.call_from_thread(self.update_matches, True)
+
+    @staticmethod
+    def label(info: SnapshotInfo) -> str:
+        taken = datetime.fromtimestamp(info.time_stamp / 1000)
+        timestamp = f"{taken.month:02}/{taken.day}/{taken.year} {taken:%H:%M}"
+        online = "Online" if info.online else "Offline"
+        return f"{escape(info.name)}  [dim]{timestamp} {online}[/dim]"
 
-        for snapshot in snapshots:
-            self.snapshots[snapshot.id] = snapshot
-            timestamp = datetime.fromtimestamp(snapshot.time_stamp / 1000).strftime(
-                "%m/%-d/%Y %H:%M"
+    def add_snapshots(self, snapshots: list[SnapshotInfo]):
+        # Parents always arrive before their children, nodes stay collapsed and
+        # their children are only fetched once they're opened
+        if self.query_exactly_one("#snapshot-search", Input).value.strip():
+            return
+        tree = self.query_exactly_one("#snapshots", Tree)
+        for info in snapshots:
+            parent = self._snapshot_nodes.get(info.parent_id, tree.root)
+            self._snapshot_nodes[info.id] = parent.add(
+                self.label(info), data=info, allow_expand=info.children_count > 0
             )
-            snapshot_table.add_row(
-                snapshot.id,
-                snapshot.name,
-                snapshot.description,
-                "Online" if snapshot.online else "Offline",
-                "-" if not snapshot.parent else snapshot.parent.name,
-                timestamp,
+
+    def show_tree(self, snapshots: dict[str, SnapshotInfo]):
+        self.query_exactly_one("#snapshots", Tree).clear()
+        self._snapshot_nodes = {}
+        self.add_snapshots(list(snapshots.values()))
+
+    @on(Tree.NodeExpanded, "#snapshots")
+    def expand_snapshot(self, event: Tree.NodeExpanded[SnapshotInfo]):
+        info = event.node.data
+        if info is not None and info.children_count and not event.node.children:
+            self.load_level(info.id)
+
+    @work(thread=True, group="snapshots")
+    def load_level(self, parent_id: str | None):
+        # The root level also checks the cached index, which is shown straight away
+        # and only rebuilt if the machine's snapshots changed since
+
+        shown = False
+
+        def on_batch(batch: list[SnapshotInfo]):
+            nonlocal shown
+            shown = True
+            self.app.call_from_thread(self.add_snapshots, batch)
+
+        try:
+            with subsystem(self._scope):
+                if parent_id is None:
+                    if self._index.validate(self._vbox, self._machine_id):
+                        return
+                    self.app.call_from_thread(self.show_tree, {})
+                level = self._index.fetch_level(
+                    self._vbox, self._machine_id, parent_id, on_batch
+                )
+                if not shown and level:
+                    # Already fetched by a search, after this level was shown
+                    self.app.call_from_thread(self.add_snapshots, level)
+        except Fault:
+            return
+        except (requests.exceptions.ConnectionError, ConnectionFailed, SessionReplaced):
+            self.app.call_from_thread(
+                self.notify,
+                "Lost the connection to vboxwebsrv while loading snapshots",
+                severity="error",
             )
+
+    def on_mount(self):
+        tree = self.query_exactly_one("#snapshots", Tree)
+        tree.show_root = False
+        tree.root.expand()
+        self.show_tree(self._index.peek(self._machine_id) or {})
+        self.load_level(None)
+
+    def on_unmount(self):
+        self.app.run_worker(partial(REFS.release, self._scope), thread=True)
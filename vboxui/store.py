@@ -0,0 +1,181 @@
+import sqlite3
+import threading
+import time
+
+from .metrics import METRIC_PERIOD
+from .models import MetricSamples
+
+# Table, bucket width in seconds and how long rows are kept, from finest to coarsest
+RESOLUTIONS = [
+    ("samples", 0, 6 * 60 * 60),
+    ("rollup_minute", 60, 7 * 24 * 60 * 60),
+    ("rollup_hour", 60 * 60, 365 * 24 * 60 * 60),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    machine TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (machine, metric, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_minute (
+    machine TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    total REAL NOT NULL,
+    count INTEGER NOT NULL,
+    low REAL NOT NULL,
+    high REAL NOT NULL,
+    PRIMARY KEY (machine, metric, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_hour (
+    machine TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    total REAL NOT NULL,
+    count INTEGER NOT NULL,
+    low REAL NOT NULL,
+    high REAL NOT NULL,
+    PRIMARY KEY (machine, metric, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cursors (
+    machine TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    PRIMARY KEY (machine, metric)
+) WITHOUT ROWID;
+"""
+
+ROLLUP = """
+INSERT INTO {table} (machine, metric, bucket, total, count, low, high)
+VALUES (?, ?, ?, ?, 1, ?, ?)
+ON CONFLICT (machine, metric, bucket) DO UPDATE SET
+    total = total + excluded.total,
+    count = count + 1,
+    low = min(low, excluded.low),
+    high = max(high, excluded.high)
+"""
+
+
+# Optional on-disk metric history. Raw samples are kept for a few hours, and are rolled
+# up into per-minute and per-hour buckets as they arrive, so long ranges are read from
+# small pre-aggregated tables instead of replaying every sample.
+class MetricsStore:
+
+    def __init__(
+        self, path: str, prune_every: float = 60 * 60, period: float = METRIC_PERIOD
+    ):
+        self.path = path
+        self.prune_every = prune_every
+        self.period = period
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # The sequence past the last stored sample and the second it was stored at,
+        # so a restart doesn't store the collector's window a second time
+        self._cursors: dict[tuple[str, str], tuple[int, int]] = {
+            (machine, metric): (sequence, bucket)
+            for machine, metric, sequence, bucket in self._db.execute(
+                "SELECT machine, metric, sequence, bucket FROM cursors"
+            )
+        }
+
+    def sequence(self, machine: str, metric: str) -> int | None:
+        # Where a history loaded from the store carries on from
+        with self._lock:
+            cursor = self._cursors.get((machine, metric))
+        return cursor[0] if cursor is not None else None
+
+    def record(
+        self,
+        metrics: dict[str, dict[str, MetricSamples]],
+        now: float | None = None,
+    ):
+        # Keyed by machine UUID then metric name. The collector returns its whole
+        # window every time, so only samples past the last stored sequence number are
+        # written, each against the time it was taken, the newest one being now. A
+        # restarted collector counts from 0 again, then its samples newer than the
+        # last stored one are written.
+        now = time.time() if now is None else now
+        with self._lock, self._db:
+            for machine, machine_metrics in metrics.items():
+                for name, samples in machine_metrics.items():
+                    # Skip the collector's own :avg/:min/:max aggregates
+                    if not samples.values or ":" in name:
+                        continue
+                    count = len(samples.values)
+                    end = samples.sequence + count
+                    stored, last = self._cursors.get((machine, name), (None, 0))
+                    skip = 0
+                    if stored is not None and end >= stored:
+                        skip = max(0, stored - samples.sequence)
+
+                    for i in range(skip, count):
+                        second = int(now - (count - 1 - i) * self.period)
+                        if second > last:
+                            self._insert(machine, name, second, samples.values[i])
+                            last = second
+                    self._cursors[machine, name] = end, last
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+                        (machine, name, end, last),
+                    )
+            if now - self._last_prune > self.prune_every:
+                self._prune(now)
+                self._last_prune = now
+
+    def _insert(self, machine: str, name: str, second: int, value: float):
+        # Only a sample that was actually added is counted in the rollups
+        inserted = self._db.execute(
+            "INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?)",
+            (machine, name, second, value),
+        )
+        if not inserted.rowcount:
+            return
+        for table, width, _ in RESOLUTIONS[1:]:
+            bucket = second - second % width
+            self._db.execute(
+                ROLLUP.format(table=table), (machine, name, bucket, value, value, value)
+            )
+
+    def _prune(self, now: float):
+        for table, _, retention in RESOLUTIONS:
+            self._db.execute(
+                f"DELETE FROM {table} WHERE bucket < ?", (int(now - retention),)
+            )
+        # Machines that haven't been recorded for as long as anything is kept
+        oldest = int(now - RESOLUTIONS[-1][2])
+        self._db.execute("DELETE FROM cursors WHERE bucket < ?", (oldest,))
+        self._cursors = {
+            key: cursor for key, cursor in self._cursors.items() if cursor[1] >= oldest
+        }
+
+    def history(
+        self, machine: str, metric: str, start: float, end: float
+    ) -> list[tuple[int, float]]:
+        # Use the finest resolution that still covers the start of the range
+        age = time.time() - start
+        table, width = next(
+            ((t, w) for t, w, retention in RESOLUTIONS if age <= retention),
+            RESOLUTIONS[-1][:2],
+        )
+        if width:
+            query = f"SELECT bucket, total / count FROM {table}"
+        else:
+            query = f"SELECT bucket, value FROM {table}"
+        with self._lock:
+            return self._db.execute(
+                query + " WHERE machine = ? AND metric = ? AND bucket BETWEEN ? AND ?"
+                " ORDER BY bucket",
+                (machine, metric, int(start), int(end)),
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,352 @@
+from collections import deque
+from concurrent.futures import Future
+from functools import cached_property
+import hashlib
+import logging
+from pathlib import Path
+import random
+import subprocess
+import threading
+import time
+from typing import Callable, Iterator
+
+import platformdirs
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from lxml import etree  # pyright: ignore [reportAttributeAccessIssue]
+import zeep
+from zeep.wsdl.utils import etree_to_string
+from vbox_api import SOAPInterface
+
+from .profile import PROFILER
+from .refs import REFS
+
+
+# Rolling count of SOAP requests, so polling changes can be checked against real traffic
+class CallCounter:
+
+    def __init__(self, window: float = 60):
+        self.window = window
+        self.total = 0
+        self._calls: deque[tuple[float, float]] = deque()
+        self._lock = threading.Lock()
+
+    def record(self, duration: float = 0):
+        now = time.monotonic()
+        with self._lock:
+            self.total += 1
+            self._calls.append((now, duration))
+            self._trim(now)
+
+    def per_minute(self) -> float:
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self._calls) * 60 / self.window
+
+    def mean_latency(self) -> float:
+        with self._lock:
+            self._trim(time.monotonic())
+            if not self._calls:
+                return 0
+            return sum(duration for _, duration in self._calls) / len(self._calls)
+
+    def _trim(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+
+SOAP_CALLS = CallCounter()
+
+
+def build_session(pool_size: int = 8) -> requests.Session:
+    # One pool of persistent connections shared by every worker, urllib3 already
+    # sets TCP_NODELAY on them
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# A semaphore that hands a freed slot to the longest waiting thread, where a plain
+# one lets the releasing thread take it straight back and starve the others
+class FairSlots:
+
+    def __init__(self, count: int):
+        self._free = count
+        self._waiting: deque[threading.Lock] = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._lock:
+            if self._free and not self._waiting:
+                self._free -= 1
+                return True
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiting.append(waiter)
+        if waiter.acquire(timeout=timeout):
+            return True
+        with self._lock:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+                return False
+        return True  # Handed over just as it timed out
+
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                self._waiting.popleft().release()
+            else:
+                self._free += 1
+
+
+class CountingTransport(zeep.Transport):
+
+    def __init__(
+        self,
+        counter: CallCounter = SOAP_CALLS,
+        *args,
+        connections: int = 8,
+        pool_timeout: float = 30,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.counter = counter
+        # Set once logged in, references in responses are tracked from then on
+        self.release: Callable[[str], None] | None = None
+        # One call in flight per pooled connection. The others wait for a free one
+        # rather than opening a connection that's thrown away afterwards, but not
+        # for longer than pool_timeout.
+        self.pool_timeout = pool_timeout
+        self._connections = FairSlots(connections)
+
+    def post_xml(self, address, envelope, headers):
+        # Same as zeep's, with the serialised message kept so its size is profiled
+        message = etree_to_string(envelope)
+        if not self._connections.acquire(timeout=self.pool_timeout):
+            raise requests.exceptions.Timeout(
+                f"No connection to vboxwebsrv free after {self.pool_timeout}s"
+            )
+        started = time.perf_counter()
+        try:
+            response = self.post(address, message, headers)
+        finally:
+            self._connections.release()
+            duration = time.perf_counter() - started
+            self.counter.record(duration)
+        name = operation(envelope)
+        PROFILER.record(
+            "soap", name, started, duration, len(message) + len(response.content)
+        )
+        if self.release is not None:
+            REFS.record(response.content, self.release, name)
+        return response
+
+
+def operation(envelope) -> str:
+    # "IMachine_getState" from the first element of the SOAP body
+    for part in envelope:
+        if etree.QName(part).localname == "Body" and len(part):
+            return etree.QName(part[0]).localname
+    return "unknown"
+
+
+def backoff(attempts: int, base: float = 0.25, cap: float = 8) -> Iterator[float]:
+    # Full jitter: a random wait below an exponentially growing ceiling, so clients
+    # retrying against the same restarted server spread out instead of arriving
+    # in lockstep
+    for attempt in range(attempts):
+        yield random.uniform(0, min(cap, base * 2**attempt))
+
+
+def unsent(error: requests.exceptions.ConnectionError) -> bool:
+    # Refused or timed out while connecting, so the request never reached vboxwebsrv
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# Methods that only read, "IMachine_getState" can be sent twice but a repeated
+# "IMachine_launchVMProcess" could start the machine twice
+IDEMPOTENT = ("get", "is", "find", "query")
+
+
+def idempotent(name: str) -> bool:
+    return name.partition("_")[2].startswith(IDEMPOTENT)
+
+
+def stale(response: requests.Response) -> bool:
+    return response.status_code == 500 and (
+        b"managed object reference" in response.content.lower()
+    )
+
+
+class SessionReplaced(Exception):
+    pass
+
+
+# Retries requests whose connection dropped, backing off while vboxwebsrv is away.
+# Only requests that never reached the server, or that only read, are sent again.
+# If the retried request is refused for holding references vboxwebsrv no longer
+# knows, the server restarted in between: on_reconnect replays the login and the
+# call fails with SessionReplaced, as its envelope still carries the old references.
+# Only one thread replays it, the others wait on the lock and reuse the new session.
+class ReconnectingTransport(CountingTransport):
+
+    def __init__(self, *args, retries: int = 6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retries = retries
+        self.on_reconnect: Callable[[], None] | None = None
+        self.reconnects = 0
+        self._lock = threading.Lock()
+        self._replaying = threading.local()
+
+    def post_xml(self, address, envelope, headers):
+        if getattr(self._replaying, "active", False) or self.on_reconnect is None:
+            return super().post_xml(address, envelope, headers)
+
+        generation = self.reconnects
+        retry = idempotent(operation(envelope))
+        delays = backoff(self.retries)
+        dropped = False
+        while True:
+            try:
+                response = super().post_xml(address, envelope, headers)
+                break
+            except requests.exceptions.ConnectionError as e:
+                delay = next(delays, None)
+                if delay is None or not (retry or unsent(e)):
+                    raise  # Out of retries, or it may already have run
+                dropped = True
+                logging.warning(f"vboxwebsrv connection lost, retrying in {delay:.2f}s")
+                time.sleep(delay)
+        if dropped and stale(response):
+            self.replay(generation)
+            raise SessionReplaced("vboxwebsrv restarted, the call was not repeated")
+        return response
+
+    def replay(self, generation: int):
+        with self._lock:
+            if self.reconnects != generation or self.on_reconnect is None:
+                return  # Already logged in again by another thread
+            if self.release is not None:
+                REFS.forget(self.release)
+            self._replaying.active = True
+            try:
+                self.on_reconnect()
+            finally:
+                self._replaying.active = False
+            self.reconnects += 1
+            logging.info("Logged in to vboxwebsrv again after it restarted")
+
+
+# zeep's parsed WSDL is full of dynamically created types and can't be pickled, so the
+# cache keeps the raw document per VirtualBox version and WSDL hash instead. That lets
+# the parse start from disk at launch, while vboxwebsrv starts and the user logs in,
+# rather than after the login button is pressed.
+class WSDLCache:
+
+    def __init__(self, directory: str | Path | None = None):
+        self.directory = Path(directory or platformdirs.user_cache_dir("vboxui"))
+        self._preloaded: Future | None = None
+        self._lock = threading.Lock()
+
+    @cached_property
+    def version(self) -> str:
+        try:
+            result = subprocess.run(
+                ["VBoxManage", "--version"], capture_output=True, text=True, timeout=5
+            )
+            return result.stdout.strip() or "unknown"
+        except (OSError, subprocess.SubprocessError):
+            return "unknown"
+
+    def latest(self) -> Path | None:
+        cached = sorted(
+            self.directory.glob(f"{self.version}-*.wsdl"),
+            key=lambda p: p.stat().st_mtime,
+        )
+        return cached[-1] if cached else None
+
+    def store(self, content: bytes) -> Path:
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        path = self.directory / f"{self.version}-{digest}.wsdl"
+        if not path.exists():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        return path
+
+    def preload(self):
+        future: Future = Future()
+        self._preloaded = future
+
+        def parse():
+            try:
+                path = self.latest()
+                if path is None:
+                    future.set_result(None)
+                    return
+                started = time.perf_counter()
+                client = zeep.Client(str(path))
+                logging.info(
+                    f"Parsed cached WSDL in {time.perf_counter() - started:.2f}s"
+                )
+                future.set_result((path.stem.split("-")[-1], client))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=parse, name="vboxui-wsdl", daemon=True).start()
+
+    def client_for(self, content: bytes, transport: zeep.Transport) -> zeep.Client:
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        # zeep sends through the client's transport, so the preloaded client goes to
+        # the first connection only and every other one, such as further fleet
+        # hosts, parses a client of its own
+        with self._lock:
+            preloaded_future, self._preloaded = self._preloaded, None
+        if preloaded_future is not None:
+            try:
+                # Waiting on a parse that is already under way beats starting another
+                preloaded = preloaded_future.result()
+                if preloaded is not None and preloaded[0] == digest:
+                    preloaded[1].transport = transport
+                    return preloaded[1]
+            except Exception:
+                logging.exception("Cached WSDL unusable, parsing the served one")
+
+        started = time.perf_counter()
+        client = zeep.Client(str(self.store(content)), transport=transport)
+        logging.info(f"Parsed WSDL in {time.perf_counter() - started:.2f}s")
+        return client
+
+
+WSDL_CACHE = WSDLCache()
+
+
+# SOAPInterface builds its zeep client without a transport, so this lets us supply one
+class TransportInterface(SOAPInterface):
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        transport: zeep.Transport,
+        wsdl_cache: WSDLCache = WSDL_CACHE,
+    ):
+        super().__init__(host, port)
+        self.transport = transport
+        self.wsdl_cache = wsdl_cache
+
+    def connect(self):
+        # Fetching the document is cheap and doubles as the readiness check for the
+        # retry loop in build_api, the parse is served from the cache when it matches
+        response = self.transport.session.get(
+            self.wsdl, timeout=self.transport.load_timeout
+        )
+        response.raise_for_status()
+        self.client = self.wsdl_cache.client_for(response.content, self.transport)
+        self.service = self.client.create_service(self.BINDING_QNAME, self.url)
+        self._register_methods()
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Hashable
+
+from textual.dom import DOMNode
+from textual.validation import ValidationResult, Validator
+
+
+# Runs form validators on a worker thread instead of the event loop. Each keystroke
+# restarts a short debounce for its input and cancels the check still waiting or
+# running for the previous value, so only the value typing settles on is checked.
+# Results are kept per value for a few seconds, so going back to a value is instant.
+class ValidationEngine:
+
+    def __init__(
+        self,
+        node: DOMNode,
+        on_result: Callable[[str, str, ValidationResult], None],
+        delay: float = 0.3,
+        ttl: float = 5,
+    ):
+        self.node = node
+        self.on_result = on_result
+        self.delay = delay
+        self.ttl = ttl
+        self._validators: dict[str, tuple[list[Validator], Callable[[], Hashable]]] = {}
+        self._results: dict[tuple, tuple[float, ValidationResult]] = {}
+
+    def add(
+        self,
+        input_id: str,
+        *validators: Validator,
+        depends: Callable[[], Hashable] = lambda: None,
+    ):
+        # depends returns whatever else the result relies on, such as another input
+        self._validators[input_id] = list(validators), depends
+
+    def check(self, input_id: str, value: str):
+        if input_id not in self._validators:
+            return
+        self.node.run_worker(
+            self._check(input_id, value), group="validate:" + input_id, exclusive=True
+        )
+
+    async def _check(self, input_id: str, value: str):
+        validators, depends = self._validators[input_id]
+        key = input_id, value, depends()
+        cached = self._results.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            result = cached[1]
+        else:
+            await asyncio.sleep(self.delay)
+            started = time.perf_counter()
+            result = await asyncio.to_thread(self.validate, validators, value)
+            elapsed = time.perf_counter() - started
+            logging.info(f"Validated {input_id} in {elapsed * 1000:.0f}ms")
+            self._results[key] = time.monotonic(), result
+        self.on_result(input_id, value, result)
+
+    @staticmethod
+    def validate(validators: list[Validator], value: str) -> ValidationResult:
+        return ValidationResult.merge([v.validate(value) for v in validators])
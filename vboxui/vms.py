@@ -1,19 +1,115 @@
+from collections import OrderedDict
+from datetime import datetime
 import logging
+import time
+
+import psutil
 
 from textual import on, work
 from textual.containers import Horizontal
 from textual.css.query import NoMatches
 
 from vboxui.create import CreateModal
-from .models import Metric
+from .bulk import BulkModal
+from .provision import ProvisionModal
+from .cache import MachineCache, SnapshotIndex
+from .events import EventWatcher
+from .jobs import Job, JobQueue
+from .metrics import (
+    HISTORY_SIZE,
+    METRIC_PERIOD,
+    MetricHistory,
+    metric_histories,
+    setup_metrics,
+    split_metrics,
+)
+from .models import MachineEvent
+from .polling import Poller
+from .profile import PROFILER
+from .registry import Registry
+from .refs import REFS
+from .session import SessionManager
+from .store import MetricsStore
+from .transport import SOAP_CALLS
 
+from textual.message import Message
 from textual.screen import Screen
-from textual.widgets import Button, Header, TabbedContent, TabPane
+from textual.widgets import (
+    Button,
+    DataTable,
+    Header,
+    LoadingIndicator,
+    TabbedContent,
+    TabPane,
+)
 from vbox_api import VBoxAPI, models
+from vbox_api.constants import VBoxEventType
 
 from vboxui.instance import VM
 
 
+SNAPSHOT_EVENTS = (
+    VBoxEventType.ON_SNAPSHOT_TAKEN,
+    VBoxEventType.ON_SNAPSHOT_DELETED,
+    VBoxEventType.ON_SNAPSHOT_CHANGED,
+    VBoxEventType.ON_SNAPSHOT_RESTORED,
+)
+
+
+class JobsPanel(DataTable):
+    DEFAULT_CSS = """
+	JobsPanel {
+	  height: auto;
+	  max-height: 8;
+	  display: none;
+	}
+	"""
+
+    BINDINGS = [("c", "cancel_job", "Cancel job")]
+
+    def __init__(self, jobs: JobQueue, *args, **kwargs):
+        super().__init__(*args, cursor_type="row", **kwargs)
+        self.jobs = jobs
+
+    def on_mount(self):
+        for column in ("Job", "Status", "Progress", "Elapsed"):
+            self.add_column(column, key=column)
+        for job in self.jobs.jobs.values():
+            self.update_job(job)
+        self.set_interval(1, self.refresh_running)
+
+    def update_job(self, job: Job):
+        key = str(job.id)
+        row = {
+            "Job": job.title,
+            "Status": f"{job.status}: {job.stage}" if job.stage else job.status,
+            "Progress": f"{job.percent}%",
+            "Elapsed": f"{job.elapsed():.0f}s",
+        }
+        if key in self.rows:
+            for column, value in row.items():
+                self.update_cell(key, column, value)
+        else:
+            self.add_row(*row.values(), key=key)
+        # Drop finished jobs the queue has stopped tracking
+        for stale in [k for k in self.rows if int(k.value or 0) not in self.jobs.jobs]:
+            self.remove_row(stale)
+        self.display = True
+
+    def refresh_running(self):
+        for job in self.jobs.jobs.values():
+            if job.status == "running":
+                self.update_job(job)
+
+    def action_cancel_job(self):
+        if not self.row_count:
+            return
+        key = self.coordinate_to_cell_key(self.cursor_coordinate).row_key
+        job = self.jobs.jobs.get(int(key.value or 0))
+        if job is not None and not job.done:
+            job.cancel()
+
+
 class VMList(Screen):
     DEFAULT_CSS = """
 	Screen {
@@ -28,59 +124,282 @@ class VMList(Screen):
 	  margin: 1 1 0 1
 	}
 
-	#vms {
+	#vms, #vms-loading {
 	  height: 4fr;
 	}
+
+	#jobs {
+	  margin: 0 1;
+	}
 	"""
 
-    def __init__(self, api: VBoxAPI, *args, **kwargs):
+    MAX_PANES = 5  # Built VM panes kept around at once
+    COUNTER_INTERVAL = 2
+
+    BINDINGS = [
+        ("escape", "back", "Back to fleet"),
+        ("r", "show_refs", "References"),
+    ]
+
+    class VBoxEvent(Message):
+        def __init__(self, event: MachineEvent):
+            super().__init__()
+            self.event = event
+
+    class JobUpdated(Message):
+        def __init__(self, job: Job):
+            super().__init__()
+            self.job = job
+
+    def __init__(
+        self,
+        api: VBoxAPI,
+        store: MetricsStore | None = None,
+        job_limit: int = 3,
+        *args,
+        **kwargs,
+    ):
         self.api = api
+        self.store = store
+
+        # Listed off the event loop once mounted, so the first paint doesn't wait on
+        # the host
+        self.vms: list[models.Machine] = []
+        self.collector = None
+        self.histories: dict[models.Machine, dict[str, MetricHistory]] = {}
+        self.labels: dict[str, str] = {}  # Tab names by pane id, kept across recomposes
+        self.poller = Poller()
+        self.cache = MachineCache()
+        self.snapshots = SnapshotIndex()
+        self.registry = Registry()
+        self.session = SessionManager(api, self.registry)
+        self.jobs = JobQueue(job_limit, on_change=self.push_job)
+        self.tick_calls = 0
+        self._calls_seen = SOAP_CALLS.total
+        self.events = EventWatcher(api, self.push_event)
+
+        super().__init__(*args, **kwargs)
+
+    def push_job(self, job: Job):
+        # Called on job threads as well as the event loop
+        self.post_message(self.JobUpdated(job))
+
+    def push_event(self, event: MachineEvent):
+        # Called on the event watcher's thread
+        self.post_message(self.VBoxEvent(event))
+
+    async def query_metrics(self):
+        if self.collector is None or not self.vms:
+            return
+
+        # One round trip for every machine on the host, made off the event loop, so
+        # the history and the recorder also cover machines whose pane isn't open
+        fetched = await self.poller.run(
+            "query_metrics", self.fetch_metrics, list(self.vms)
+        )
+        if fetched is None:
+            return
+        metrics, loaded = fetched
+        for machine, history in loaded.items():
+            self.histories.setdefault(machine, history)
+
+        panes = {pane.machine: pane for pane in self.query(VM)}
+        for machine, vm_metrics in metrics.items():
+            history = self.histories.get(machine)
+            for name, samples in vm_metrics.items():
+                if history is not None and name in history and samples.values:
+                    history[name].extend(samples)
+            if machine in panes:
+                panes[machine].post_message(VM.MetricsUpdated(vm_metrics))
 
-        self.vms: list[models.Machine] = api.machines
+    def fetch_metrics(self, machines: list[models.Machine]):
+        collector = self.collector
+        if collector is None:
+            return {}, {}  # Machines not listed yet
+        handles = {str(vm.handle): vm for vm in machines}
+        raw_metrics = collector.query_metrics_data(None, list(handles))
+        with PROFILER.span("split_metrics"):
+            metrics = split_metrics(raw_metrics)
 
-        for vm in self.vms:
-            logging.info(
-                f"{self.api.performance_collector.setup_metrics(None, vm, 2, 1)}"
+        # Histories start once a machine's UUID is known, with what was recorded
+        # before, then take the collector's whole window on top
+        machine_ids = self.machine_ids(handles)
+        loaded = {
+            vm: self.load_history(machine_ids[handle])
+            for handle, vm in handles.items()
+            if vm not in self.histories and handle in machine_ids
+        }
+        if self.store is not None:
+            self.store.record(
+                {machine_ids[h]: m for h, m in metrics.items() if h in machine_ids}
             )
-            logging.info(f"{self.api.performance_collector.enable_metrics(None, vm)}")  # Enable metrics for all VMs
+        return {handles[h]: m for h, m in metrics.items() if h in handles}, loaded
 
-        super().__init__(*args, **kwargs)
+    def machine_ids(self, handles: dict[str, models.Machine]) -> dict[str, str]:
+        # From the registry once it's loaded, otherwise from details already cached
+        machine_ids = self.registry.machine_ids()
+        for handle, vm in handles.items():
+            if handle not in machine_ids:
+                details = self.cache.peek(vm)
+                if details is not None:
+                    machine_ids[handle] = details.id
+        return machine_ids
 
-    def query_metrics(self):
-        vm_summary = {}
-        for vm in self.vms:
-            try:
-                vm_pane: VM = self.query("#ID" + vm.id).first(VM)
-            except NoMatches:
-                continue
-            raw_metrics = self.api.performance_collector.query_metrics_data(None, vm)
-            summary = {}
-            for name, _, unit, scale, _, _, _, value in zip(
-                *(raw_metrics[key] for key in raw_metrics)
-            ):
-                # Setting these values will also automatically update the display
-
-                if name == "CPU/Load/User":
-                    vm_pane.metric_cpu_user_load = Metric(value, scale, unit)
-                elif name == "CPU/Load/Kernel":
-                    vm_pane.metric_cpu_kernel_load = Metric(value, scale, unit)
-                elif name == "CPU/Usage/Used":
-                    vm_pane.metric_mem_usage = Metric(value, scale, unit)
-                elif name == "Disk/Usage/Used":
-                    vm_pane.metric_disk_used = Metric(value, scale, unit)
-                elif name == "Net/Rate/Rx":
-                    vm_pane.metric_network_rx = Metric(value, scale, unit)
-                elif name == "Net/Rate/Tx":
-                    vm_pane.metric_network_tx = Metric(value, scale, unit)
-
-                summary[name] = value, scale, unit
-            vm_summary[vm] = summary
-        return vm_summary
+    def load_history(self, machine_id: str) -> dict[str, MetricHistory]:
+        history = metric_histories()
+        if self.store is None:
+            return history
+        until = time.time()
+        since = until - HISTORY_SIZE * METRIC_PERIOD
+        for name, samples in history.items():
+            for _, value in self.store.history(machine_id, name, since, until):
+                samples.append(value)
+            # The collector's window was stored up to here, so isn't added twice
+            samples.next_sequence = self.store.sequence(machine_id, name)
+        return history
+
+    async def poll_status(self):
+        if self.events.is_alive():
+            return  # State changes are pushed by the event watcher instead
+
+        # A single pass over the visible panes replaces a timer per VM
+        try:
+            active_pane = self.query_exactly_one("#vms", TabbedContent).active_pane
+        except NoMatches:
+            return  # Screen is being recomposed
+        if active_pane is None:
+            return
+        panes = [
+            (pane, pane.latest_state, pane.vbox_health)
+            for pane in active_pane.query(VM)
+        ]
+        if not panes:
+            return
+
+        statuses = await self.poller.run("poll_status", self.fetch_statuses, panes)
+        if statuses is None:
+            return
+
+        # Only panes whose state actually changed get an update
+        for pane, status in statuses:
+            pane.post_message(VM.StatusUpdated(status))
+
+    def update_counters(self):
+        # Calls made since the last tick of this timer, so cache savings show up
+        self.tick_calls = SOAP_CALLS.total - self._calls_seen
+        self._calls_seen = SOAP_CALLS.total
+        self.sub_title = (
+            f"{self.tick_calls} SOAP calls/{self.COUNTER_INTERVAL}s, "
+            f"{SOAP_CALLS.per_minute():.0f}/min, "
+            f"{SOAP_CALLS.mean_latency() * 1000:.1f} ms avg, "
+            f"{self.cache.hit_rate():.0%} cached, "
+            f"{REFS.outstanding()} refs held"
+        )
+
+    @staticmethod
+    def fetch_statuses(panes: list[tuple[VM, datetime, int]]):
+        statuses = []
+        for pane, since, health in panes:
+            status = pane.fetch_status(since, health)
+            if status is not None:
+                statuses.append((pane, status))
+        return statuses
+
+    def on_vmlist_vbox_event(self, message: VBoxEvent):
+        event = message.event
+        logging.info(f"Received {event.kind} for {event.machine_id}")
+
+        if event.kind == VBoxEventType.ON_MEDIUM_REGISTERED:
+            self.registry.forget_medium(event.machine_id)
+            return
+        if event.kind == VBoxEventType.ON_MACHINE_REGISTERED:
+            # Apart from load_machines, which lists them anyway if it's still running
+            self.run_worker(self.refresh_machines(), group="refresh", exclusive=True)
+            return
+        if event.kind == VBoxEventType.ON_MACHINE_DATA_CHANGED:
+            # Possibly renamed, the registry picks up the name again on the next sync
+            self.registry.forget_machine(event.machine_id)
+            self.run_worker(self.sync_registry(), group="registry")
+        if event.kind in SNAPSHOT_EVENTS:
+            self.snapshots.invalidate(event.machine_id)
+
+        try:
+            pane = self.query_exactly_one("#ID" + event.machine_id, VM)
+        except NoMatches:
+            return
+        self.cache.invalidate(pane.machine)
+        self.run_worker(self.refresh_pane(pane), group="status")
+
+    def on_vmlist_job_updated(self, message: JobUpdated):
+        try:
+            self.query_exactly_one("#jobs", JobsPanel).update_job(message.job)
+        except NoMatches:
+            pass  # Screen is being recomposed, the new panel loads every tracked job
+
+    async def refresh_pane(self, pane: VM):
+        status = await self.poller.run(
+            "event_status:" + str(pane.id),
+            pane.fetch_status,
+            datetime.min,
+            pane.vbox_health,
+        )
+        if status is not None:
+            pane.post_message(VM.StatusUpdated(status))
+
+    async def refresh_machines(self):
+        machines = await self.poller.run("machines", self.fetch_machines)
+        if machines is None:
+            return
+        for vm in set(self.histories) - set(machines):
+            del self.histories[vm]
+        self.vms = machines
+        await self.recompose()
+        self.run_worker(self.prefetch_machines(), group="prefetch")
+
+    def fetch_machines(self) -> list[models.Machine] | None:
+        if self.collector is None:
+            return None  # Still loading, load_machines lists them
+        machines = self.api.machines
+        if set(machines) == set(self.vms):
+            return None
+        self.registry.sync(machines)
+        self.setup_metrics([vm for vm in machines if vm not in self.vms])
+        self.cache.prefetch(machines)
+        return machines
+
+    async def sync_registry(self):
+        await self.poller.run("registry", self.registry.sync, self.vms)
+
+    def setup_metrics(self, machines: list[models.Machine]):
+        if not machines or self.collector is None:
+            return
+        # One call each for the whole list rather than a pair per machine
+        setup_metrics(self.api, self.collector, machines)
+        logging.info(f"Metrics set up for {len(machines)} machines")
+
+    def list_machines(self) -> list[models.Machine]:
+        collector = self.api.performance_collector
+        machines = self.api.machines
+        self.collector = collector
+        self.setup_metrics(machines)
+        return machines
+
+    async def load_machines(self):
+        machines = await self.poller.run("machines", self.list_machines, timeout=120)
+        if machines is None:
+            self.notify("Unable to list machines", severity="error")
+            return
+        self.vms = machines
+        await self.recompose()
+        self.run_worker(self.prefetch_machines(), group="prefetch")
+        self.run_worker(self.load_registry(), group="registry")
 
     def compose(self):
         yield Header()
         with Horizontal(id="options"):
             yield Button("Create VM", variant="success", id="create-btn")
+            yield Button("Provision VMs", variant="success", id="provision-btn")
+            yield Button("Bulk Actions", variant="primary", id="bulk-btn")
             yield Button(
                 "Manage Mediums", variant="warning", id="manage-medium", disabled=True
             )
@@ -92,22 +411,195 @@ class VMList(Screen):
             )
             yield Button("Exit VboxUI", variant="error", id="leave-btn")
 
-        with TabbedContent(id="vms"):
-            for vm in self.vms:
-                with TabPane(vm.name):
-                    yield VM(vm, self.api, id="ID" + vm.id)
+        # Panes start as placeholders and are only built once their tab is opened.
+        # Tabs are keyed by handle so composing doesn't need a round trip per machine,
+        # names the cache has let go of stay as last labelled until prefetched again.
+        self.pane_machines: dict[str, models.Machine] = {}
+        self.visited: OrderedDict[str, None] = OrderedDict()
+        if self.collector is None:
+            yield LoadingIndicator(id="vms-loading")  # Until load_machines is done
+        else:
+            labels = {}
+            with TabbedContent(id="vms"):
+                for vm in self.vms:
+                    pane_id = "TAB" + str(vm.handle)
+                    self.pane_machines[pane_id] = vm
+                    details = self.cache.peek(vm)
+                    labels[pane_id] = (
+                        details.name if details else self.labels.get(pane_id, "...")
+                    )
+                    with TabPane(labels[pane_id], id=pane_id):
+                        yield LoadingIndicator()
+            self.labels = labels
+        yield JobsPanel(self.jobs, id="jobs")
 
     @on(Button.Pressed, "#leave-btn")
     def exit_app(self):
         self.app.exit()
 
+    def check_action(self, action: str, parameters: tuple) -> bool | None:
+        # Only opened over another screen from the fleet view
+        if action == "back":
+            return len(self.app.screen_stack) > 2
+        return True
+
+    def action_back(self):
+        self.app.pop_screen()
+
+    def action_show_refs(self):
+        report = REFS.report()
+        self.notify(
+            "\n".join(f"{group}: {count}" for group, count in report.items())
+            or "None outstanding",
+            title=f"References held, {REFS.released} released",
+        )
+
     @on(Button.Pressed, "#create-btn")
     @work()
     async def create_vm(self, event: Button.Pressed):
-        m = await self.app.push_screen_wait(CreateModal(self.api))
-        self.vms.append(m)
-        await self.recompose()
+        m = await self.app.push_screen_wait(CreateModal(self.api, self.jobs, self.registry))
+        if m not in self.vms:  # The registration event may have added it already
+            self.vms.append(m)
+            await self.recompose()
+            self.run_worker(self.prefetch_machines(), group="prefetch")
+
+    @on(Button.Pressed, "#provision-btn")
+    @work()
+    async def provision_vms(self, event: Button.Pressed):
+        created = await self.app.push_screen_wait(
+            ProvisionModal(self.api, self.jobs, self.registry)
+        )
+        if created:  # Usually already picked up from the registration events
+            await self.refresh_machines()
+
+    @on(Button.Pressed, "#bulk-btn")
+    @work()
+    async def bulk_actions(self, event: Button.Pressed):
+        machines = await self.poller.run("names", self.machine_names, list(self.vms))
+        if machines is None:
+            self.notify("Unable to list machine names", severity="error")
+            return
+        await self.app.push_screen_wait(BulkModal(machines, self.cache, self.jobs))
+
+    def machine_names(
+        self, machines: list[models.Machine]
+    ) -> list[tuple[models.Machine, str]]:
+        # Runs on a worker thread, only names neither cached nor in the registry cost
+        # a round trip
+        names = self.registry.machine_names()
+        named = []
+        for vm in machines:
+            details = self.cache.peek(vm)
+            name = details.name if details else names.get(str(vm.handle))
+            named.append((vm, name or vm.name))
+        return named
+
+    @on(TabbedContent.TabActivated, "#vms")
+    def activate_pane(self, event: TabbedContent.TabActivated):
+        self.run_worker(self.build_pane(event.pane), group="panes")
+        # Hidden panes are skipped by the poller, so catch up as soon as one is shown
+        self.run_worker(self.poll_status(), group="status")
+
+    async def build_pane(self, pane: TabPane):
+        if pane.id is None:
+            return
+        self.visited[pane.id] = None
+        self.visited.move_to_end(pane.id)
+
+        # Free panes that haven't been visited recently, they're rebuilt when reopened
+        while len(self.visited) > self.MAX_PANES:
+            stale, _ = self.visited.popitem(last=False)
+            try:
+                stale_pane = self.query_exactly_one("#" + stale, TabPane)
+            except NoMatches:
+                continue
+            stale_pane.query(VM).remove()
+            stale_pane.query_exactly_one(LoadingIndicator).display = True
+
+        if pane.query(VM):
+            return
+        machine = self.pane_machines[pane.id]
+        details = await self.poller.run("details:" + pane.id, self.cache.get, machine)
+        if details is None or pane.query(VM) or pane.id not in self.visited:
+            return  # Failed, built by another worker, or freed while fetching
+        history = self.histories.get(machine)
+        if history is None:
+            history = await self.poller.run(
+                "history:" + pane.id, self.load_history, details.id
+            )
+            history = self.histories.setdefault(machine, history or metric_histories())
+        if pane.query(VM) or pane.id not in self.visited:
+            return
+        pane.query_exactly_one(LoadingIndicator).display = False
+        pane.mount(
+            VM(
+                machine,
+                details,
+                self.api,
+                self.poller,
+                self.cache,
+                self.jobs,
+                self.snapshots,
+                history,
+                id="ID" + details.id,
+            )
+        )
+
+    async def prefetch_machines(self):
+        # Fetch everything the panes display in one background pass, then label tabs
+        await self.poller.run("prefetch", self.cache.prefetch, self.vms)
+        try:
+            tabs = self.query_exactly_one("#vms", TabbedContent)
+        except NoMatches:
+            return
+        for pane_id, vm in self.pane_machines.items():
+            details = self.cache.peek(vm)
+            if details is not None:
+                self.labels[pane_id] = details.name
+                tabs.get_tab(pane_id).label = details.name
+
+    async def keep_session(self):
+        logging.info(f"References held: {REFS.report()}")
+        recovered = await self.poller.run("session", self.session.keepalive)
+        if not recovered:
+            return
+        # The panes keep their Machine objects, only what was fetched through the
+        # old references has to go
+        self.cache.invalidate()
+        await self.poller.run("session_restore", self.restore_session, timeout=120)
+        if not self.events.is_alive():
+            self.events = EventWatcher(self.api, self.push_event)
+            self.events.start()
+        self.notify("Reconnected to vboxwebsrv")
+
+    def restore_session(self):
+        self.collector = self.api.performance_collector
+        self.setup_metrics(self.vms)
+        self.registry.forget_mediums()
+        self.registry.load(self.api, self.vms)
+
+    async def load_registry(self):
+        # Names and mediums for every machine on the host, so it can take a while
+        await self.poller.run(
+            "registry", self.registry.load, self.api, self.vms, timeout=120
+        )
 
     def on_mount(self):
         self.title = "VM List"
+        self.call_after_refresh(self.log_startup)
+        self.run_worker(self.load_machines(), group="machines")
         self.set_interval(2, self.query_metrics)
+        self.set_interval(2, self.poll_status)
+        # On its own timer, status polling stops while events are pushed
+        self.set_interval(self.COUNTER_INTERVAL, self.update_counters)
+        self.set_interval(self.session.interval, self.keep_session)
+        self.events.start()
+
+    def log_startup(self):
+        launched = psutil.Process().create_time()
+        logging.info(f"First VM list render {time.time() - launched:.2f}s after launch")
+
+    def on_unmount(self):
+        self.events.stop()
+        self.jobs.close()
+        self.poller.close()